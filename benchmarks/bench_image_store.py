@@ -0,0 +1,111 @@
+"""Замер времени сохранения изображения в зависимости от количества
+уже сохраненных файлов.
+
+Хранилище заполняется пустыми файлами в подкаталогах по хешу (как это
+делает ImageStore) до каждой контрольной точки, после чего замеряется
+среднее время сохранения новых изображений. Для сравнения замеряется
+прежняя схема: случайное имя img_<n> в одном каталоге с проверкой
+существования файла.
+
+Запуск из корня проекта:
+    python benchmarks/bench_image_store.py --max-files 1000000
+"""
+import argparse
+import hashlib
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+
+from parsing.images import ImageStore  # noqa: E402
+
+IMAGE = os.urandom(32 * 1024)
+
+
+def fill_sharded(store, start, stop):
+    for i in range(start, stop):
+        content_hash = hashlib.sha256(str(i).encode()).hexdigest()
+        path = store.get_path(content_hash, 'jpg')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, 'wb').close()
+
+
+def fill_flat(root, count, names):
+    """Заполняет каталог файлами со случайными именами прежней схемы"""
+    while len(names) < count:
+        random_num = random.randint(100, 10 ** 6)
+        if random_num not in names:
+            names.add(random_num)
+            open(os.path.join(root, f'img_{random_num}.jpg'), 'wb').close()
+
+
+def legacy_save(root):
+    """Прежняя схема: подбор случайного свободного имени"""
+    probes = 0
+    while True:
+        probes += 1
+        file_name = os.path.join(root, f'img_{random.randint(100, 10 ** 6)}.jpg')
+        if not os.path.exists(file_name):
+            break
+    with open(file_name, 'wb') as out:
+        out.write(IMAGE)
+    os.remove(file_name)
+    return probes
+
+
+def measure(func, repeat):
+    t = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - t) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--max-files', type=int, default=10 ** 6)
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--legacy-max-files', type=int, default=900000,
+                        help='Предел для прежней схемы (она не работает при 10^6 файлов)')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp()
+    store = ImageStore(os.path.join(root, 'sharded'))
+    flat_root = os.path.join(root, 'flat')
+    os.makedirs(flat_root)
+    flat_names = set()
+    checkpoints = []
+    count = 1000
+    while count <= args.max_files:
+        checkpoints.append(count)
+        count *= 10
+
+    print(f'{"Файлов":>10}{"ImageStore, мс":>18}{"прежняя схема, мс":>20}{"попыток":>10}')
+    filled = 0
+    try:
+        for count in checkpoints:
+            fill_sharded(store, filled, count)
+            filled = count
+
+            def save_new():
+                store.save(iter([IMAGE, os.urandom(16)]), 'jpg')
+            sharded_ms = measure(save_new, args.repeat)
+
+            legacy_ms = probes = float('nan')
+            if count <= args.legacy_max_files:
+                fill_flat(flat_root, count, flat_names)
+                probes_total = []
+                legacy_ms = measure(lambda: probes_total.append(legacy_save(flat_root)),
+                                    args.repeat)
+                probes = sum(probes_total) / len(probes_total)
+            print(f'{count:>10}{sharded_ms:>18.3f}{legacy_ms:>20.3f}{probes:>10.1f}')
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
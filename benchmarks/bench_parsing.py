@@ -0,0 +1,218 @@
+"""Замер производительности парсинга на локальной имитации магазинов.
+
+Для каждого магазина запускается MockShop (parsing/mock_shop.py), после
+чего при разном количестве потоков измеряются:
+    parse_data - Parsing.parse_data (страница, цена, фото);
+    download - PhotoDownloader.download;
+    refresh - массовое обновление цен (PriceRefresher).
+Для каждого замера выводятся страниц в секунду, задержки p50/p95/p99
+и пиковая память процесса. Результаты сохраняются в JSON, с которым
+можно сравнить следующий запуск (--compare).
+
+Запуск из корня проекта:
+    python benchmarks/bench_parsing.py --pages 200 --concurrency 1 4 16 \\
+        --latency 0.02 --output before.json
+    python benchmarks/bench_parsing.py --output after.json --compare before.json
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+
+
+def setup_django(db_path):
+    import config.settings
+    config.settings.DATABASES['default']['NAME'] = db_path
+    import django
+    django.setup()
+    from django.core.management import call_command
+    call_command('migrate', verbosity=0)
+
+
+def disable_throttling():
+    """Ограничение частоты запросов к магазинам не должно влиять на замер"""
+    from parsing import throttle
+    unlimited = {'rps': 10 ** 9, 'burst': 10 ** 9}
+    throttle._scheduler = throttle.DomainScheduler(limits={'default': unlimited})
+
+
+def percentile(values, percent):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))]
+
+
+def peak_memory_mb():
+    """Пиковый объем памяти процесса (МБ)"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # В Linux значение в КБ, в macOS - в байтах
+    return peak / 1024 ** 2 if platform.system() == 'Darwin' else peak / 1024
+
+
+def make_report(latencies, errors, elapsed):
+    report = {
+        'pages': len(latencies),
+        'errors': errors,
+        'elapsed': elapsed,
+        'pages_per_sec': len(latencies) / elapsed if elapsed else 0,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'rss_peak_mb': peak_memory_mb(),
+    }
+    if tracemalloc.is_tracing():
+        report['python_peak_mb'] = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+        tracemalloc.reset_peak()
+    return report
+
+
+def run_calls(func, args, concurrency):
+    """Вызывает func для каждого аргумента в concurrency потоках"""
+    def timed(arg):
+        start = time.perf_counter()
+        try:
+            error = not func(arg)
+        except Exception:
+            error = True
+        return time.perf_counter() - start, error
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(timed, args))
+    elapsed = time.perf_counter() - start
+    return make_report([r[0] for r in results], sum(r[1] for r in results), elapsed)
+
+
+def bench_parse_data(urls, concurrency):
+    from parsing.parsers import Parsing
+
+    def parse(url):
+        price, photo = Parsing(url).parse_data()
+        return price is not None and photo is not None
+    return run_calls(parse, urls, concurrency)
+
+
+def bench_download(image_urls, concurrency):
+    from parsing.parsers import PhotoDownloader
+    return run_calls(lambda url: PhotoDownloader(url).download()[0],
+                     image_urls, concurrency)
+
+
+def bench_refresh(site_ids, concurrency):
+    from parsing.models import Site
+    from parsing.refresh import refresh_prices
+
+    # Без сохраненных валидаторов все страницы загружаются заново
+    Site.objects.update(etag='', last_modified='', content_hash='')
+    summary = refresh_prices(site_ids, concurrency=concurrency, per_domain=concurrency,
+                             selenium_workers=concurrency)
+    return make_report(summary.latencies, summary.failed, summary.elapsed)
+
+
+def create_sites(urls):
+    from urllib.parse import urlparse
+    from django.contrib.auth.models import User
+    from parsing.models import Site
+
+    user = User.objects.create(username='bench')
+    Site.objects.bulk_create(Site(user=user, url=url, domain=urlparse(url).netloc)
+                             for url in urls)
+    return list(Site.objects.values_list('id', flat=True))
+
+
+def print_results(results, previous=None):
+    print(f'{"Замер":<12}{"потоков":>8}{"стр./сек.":>11}{"p50, с":>9}{"p95, с":>9}'
+          f'{"p99, с":>9}{"ошибок":>8}{"память, МБ":>12}'
+          + (f'{"изменение":>12}' if previous else ''))
+    for name, by_concurrency in results.items():
+        for concurrency, report in by_concurrency.items():
+            line = (f'{name:<12}{concurrency:>8}{report["pages_per_sec"]:>11.1f}'
+                    f'{report["p50"]:>9.3f}{report["p95"]:>9.3f}{report["p99"]:>9.3f}'
+                    f'{report["errors"]:>8}{report["rss_peak_mb"]:>12.1f}')
+            old = (previous or {}).get(name, {}).get(concurrency)
+            if old and old['pages_per_sec']:
+                change = report['pages_per_sec'] / old['pages_per_sec'] - 1
+                line += f'{change:>+12.1%}'
+            print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pages', type=int, default=200,
+                        help='Количество страниц каждого магазина')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='Задержка ответа магазина (сек.)')
+    parser.add_argument('--jitter', type=float, default=0.01)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--throttle', action='store_true',
+                        help='Соблюдать ограничение частоты запросов (RATE_LIMITS)')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='Замерять пиковую память Python (tracemalloc, замедляет работу)')
+    parser.add_argument('--output', default='bench_parsing.json')
+    parser.add_argument('--compare', help='JSON с результатами прошлого запуска')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp()
+    setup_django(os.path.join(root, 'bench.sqlite3'))
+    if not args.throttle:
+        disable_throttling()
+    if args.trace_memory:
+        tracemalloc.start()
+
+    from parsing.images import ImageStore
+    from parsing.mock_shop import MockShop
+    from parsing.parsers import PhotoDownloader
+    from parsing.sites import Lamoda, Wildberries
+
+    PhotoDownloader.store = ImageStore(os.path.join(root, 'images'))
+    shops = [MockShop(site_class, args.latency, args.jitter, args.error_rate, seed=1).start()
+             for site_class in (Wildberries, Lamoda)]
+    try:
+        urls = [f'{shop.base_url}/catalog/{i}/detail.aspx'
+                for i in range(args.pages) for shop in shops]
+        image_urls = [f'{shop.base_url}/img/{i}.jpg'
+                      for i in range(args.pages) for shop in shops]
+        site_ids = create_sites(urls)
+        results = {'parse_data': {}, 'download': {}, 'refresh': {}}
+        for concurrency in args.concurrency:
+            results['parse_data'][concurrency] = bench_parse_data(urls, concurrency)
+            results['download'][concurrency] = bench_download(image_urls, concurrency)
+            results['refresh'][concurrency] = bench_refresh(site_ids, concurrency)
+    finally:
+        for shop in shops:
+            shop.stop()
+        shutil.rmtree(root)
+
+    # Ключи JSON - строки, поэтому количество потоков хранится строкой
+    results = {name: {str(c): report for c, report in by_concurrency.items()}
+               for name, by_concurrency in results.items()}
+    previous = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as file:
+            previous = json.load(file)['results']
+    print_results(results, previous)
+    with open(args.output, 'w', encoding='utf-8') as file:
+        json.dump({
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'options': vars(args),
+            'python': platform.python_version(),
+            'results': results,
+        }, file, ensure_ascii=False, indent=2)
+    print(f'Результаты сохранены в {args.output}')
+
+
+if __name__ == '__main__':
+    main()
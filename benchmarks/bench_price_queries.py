@@ -0,0 +1,142 @@
+"""Замер времени запросов цен на большой истории.
+
+Создает отдельную БД SQLite, заполняет ее сайтами и ценами, после чего
+измеряет время запросов последней цены, истории за период и страницы
+списка товаров без индексов моделей Site и Price и с ними.
+
+Запуск из корня проекта:
+    python benchmarks/bench_price_queries.py --sites 1000 --prices-per-site 1000
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+
+
+def setup_django(db_path):
+    import config.settings
+    config.settings.DATABASES['default']['NAME'] = db_path
+    import django
+    django.setup()
+    from django.core.management import call_command
+    call_command('migrate', verbosity=0)
+
+
+def fill(sites_count, prices_per_site, batch_size=10000):
+    from django.contrib.auth.models import User
+    from django.utils import timezone
+    from parsing.models import Site, Price
+
+    user = User.objects.create(username='bench')
+    domains = ['www.wildberries.ru', 'www.lamoda.ru']
+    Site.objects.bulk_create(
+        Site(user=user, url=f'https://{domains[i % 2]}/p/{i}/',
+             domain=domains[i % 2])
+        for i in range(sites_count))
+    site_ids = list(Site.objects.values_list('id', flat=True))
+    start = timezone.now() - timedelta(hours=prices_per_site)
+    batch = []
+    for site_id in site_ids:
+        for i in range(prices_per_site):
+            date = start + timedelta(hours=i)
+            batch.append(Price(site_id=site_id, price=random.randint(100, 10000),
+                               date=date, valid_until=date))
+            if len(batch) >= batch_size:
+                Price.objects.bulk_create(batch)
+                batch = []
+    Price.objects.bulk_create(batch)
+    return site_ids, start
+
+
+def measure(func, repeat):
+    """Медианное время выполнения функции (мс)"""
+    timings = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - t) * 1000)
+    return statistics.median(timings)
+
+
+def run_queries(site_ids, start, repeat):
+    from parsing.helpers import get_sites_page
+    from parsing.models import Site
+
+    sites = Site.objects.in_bulk(random.sample(site_ids, min(repeat, len(site_ids))))
+    sites = list(sites.values())
+
+    def last_price():
+        random.choice(sites).get_prices().first()
+
+    def history():
+        site = random.choice(sites)
+        date_from = start + timedelta(hours=random.randint(0, 100))
+        list(site.get_price_history(date_from, date_from + timedelta(days=7)))
+
+    def listing():
+        get_sites_page(after=random.choice(site_ids) - 1, limit=100)
+
+    def listing_by_domain():
+        get_sites_page(after=random.choice(site_ids) - 1, limit=100,
+                       domain='www.lamoda.ru')
+
+    return {
+        'last_price': measure(last_price, repeat),
+        'history_range': measure(history, repeat),
+        'listing': measure(listing, repeat),
+        'listing_by_domain': measure(listing_by_domain, repeat),
+    }
+
+
+def set_indexes(enabled):
+    """Удаляет или создает индексы, объявленные в Meta моделей"""
+    from django.db import connection
+    from parsing.models import Site, Price
+
+    with connection.schema_editor() as editor:
+        for model in (Site, Price):
+            for index in model._meta.indexes:
+                if enabled:
+                    editor.add_index(model, index)
+                else:
+                    editor.remove_index(model, index)
+    with connection.cursor() as cursor:
+        cursor.execute('ANALYZE')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sites', type=int, default=1000)
+    parser.add_argument('--prices-per-site', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--db', help='Путь к файлу БД, по умолчанию - временный файл')
+    args = parser.parse_args()
+
+    db_path = args.db or os.path.join(tempfile.mkdtemp(), 'bench.sqlite3')
+    setup_django(db_path)
+    t = time.perf_counter()
+    site_ids, start = fill(args.sites, args.prices_per_site)
+    print(f'Заполнение БД ({args.sites * args.prices_per_site} цен): '
+          f'{time.perf_counter() - t:.1f} сек.')
+
+    set_indexes(False)
+    before = run_queries(site_ids, start, args.repeat)
+    set_indexes(True)
+    after = run_queries(site_ids, start, args.repeat)
+
+    print(f'{"Запрос":<20}{"без индексов, мс":>18}{"с индексами, мс":>18}')
+    for name in before:
+        print(f'{name:<20}{before[name]:>18.2f}{after[name]:>18.2f}')
+    if not args.db:
+        os.remove(db_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -131,3 +131,172 @@ STATICFILES_DIRS = [
 
 # Настройки для parsing
 GOODS_IMAGE_PATH = os.path.join(BASE_DIR, "static", 'goods_images')
+
+# Пул сессий WebDriver: максимальное количество браузеров, количество
+# использований сессии до пересоздания, время простоя до закрытия сессии (сек.)
+# и время ожидания свободной сессии (сек.)
+WEBDRIVER_POOL = {
+    'size': 2,
+    'max_uses': 50,
+    'idle_timeout': 300,
+    'acquire_timeout': 120,
+}
+
+# Массовое обновление цен: общее ограничение одновременно обрабатываемых
+# страниц, ограничение на один домен, количество потоков для сайтов,
+# требующих браузер (None - по размеру пула WebDriver), количество потоков
+# загрузки фото и размер пачки результатов, сохраняемой в одной транзакции
+PRICE_REFRESH = {
+    'concurrency': 32,
+    'per_domain': 4,
+    'selenium_workers': None,
+    'io_workers': 16,
+    'batch_size': 100,
+}
+
+# Очередь задач обновления цен: количество попыток, задержка перед повтором
+# (сек., растет с каждой попыткой), период опроса очереди обработчиком (сек.)
+# и время, после которого зависшая задача возвращается в очередь (сек.)
+PRICE_JOBS = {
+    'max_attempts': 3,
+    'retry_delay': 60,
+    'poll_interval': 2,
+    'stale_timeout': 600,
+}
+
+# Сжатие истории цен (compact_prices): цены старше raw_days дней заменяются
+# сводками по дням, сводки по дням старше daily_days дней - сводками по неделям
+PRICE_HISTORY = {
+    'raw_days': 90,
+    'daily_days': 365,
+}
+
+# Количество сайтов на одной странице списка товаров
+GOODS_PAGE_SIZE = 100
+
+# Общий HTTP-клиент: количество хостов с пулами соединений, размер пула
+# одного хоста (не меньше PRICE_REFRESH['per_domain']), таймауты (сек.)
+HTTP_CLIENT = {
+    'pool_connections': 20,
+    'pool_maxsize': 8,
+    'connect_timeout': 5,
+    'read_timeout': 30,
+    'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:72.0) Gecko/20100101 Firefox/72.0',
+}
+
+# Загрузка изображений товаров: максимальный размер файла и размер части,
+# которыми файл записывается на диск (байт)
+PHOTO_DOWNLOAD = {
+    'max_size': 10 * 1024 * 1024,
+    'chunk_size': 64 * 1024,
+}
+
+# Уменьшенные копии изображений товаров: высота копий (px) для таблицы
+# и плитки списка товаров, форматы и качество сжатия
+THUMBNAILS = {
+    'sizes': {'small': 80, 'large': 400},
+    'formats': ['webp', 'jpeg'],
+    'quality': 80,
+}
+
+# Как часто (сек.) процесс проверяет, не изменились ли описания сайтов в БД
+SHOP_CONFIG_TTL = 60
+
+# Ограничение частоты запросов к сайтам: rps - запросов в секунду в среднем,
+# burst - запросов подряд, respect_robots - учитывать Crawl-delay из robots.txt.
+# Ключи - домены (netloc), 'default' - для остальных доменов
+RATE_LIMITS = {
+    'default': {'rps': 2, 'burst': 4, 'respect_robots': False},
+    'www.wildberries.ru': {'rps': 1, 'burst': 2, 'respect_robots': False},
+    'www.lamoda.ru': {'rps': 1, 'burst': 2, 'respect_robots': False},
+}
+
+# Снижение частоты при ответах 429/503: частота уменьшается вдвое, но не ниже
+# min_factor от заданной, и после каждого успешного ответа увеличивается
+# на recovery; пауза по Retry-After - не больше max_retry_after сек.
+RATE_LIMIT_BACKOFF = {
+    'min_factor': 0.1,
+    'recovery': 0.05,
+    'max_retry_after': 300,
+}
+
+# Повторные попытки открытия страниц: attempts - всего попыток, задержка
+# растет от base_delay до max_delay сек. со случайным разбросом; повторы
+# сайта ограничены бюджетом (budget_max, пополняется на budget_ratio после
+# каждой успешной загрузки); после failure_threshold неудач подряд запросы
+# к сайту приостанавливаются на reset_timeout сек.
+RETRY = {
+    'attempts': 3,
+    'base_delay': 1,
+    'max_delay': 30,
+    'budget_ratio': 0.2,
+    'budget_max': 10,
+    'failure_threshold': 5,
+    'reset_timeout': 300,
+}
+
+# Явное ожидание элементов на страницах, открытых в браузере: timeout - сколько
+# секунд ждать элемент (если для идентификатора не задано свое время),
+# poll_frequency - интервал проверки страницы
+SELENIUM_WAIT = {
+    'timeout': 10,
+    'poll_frequency': 0.2,
+}
+
+# Облегченный профиль браузера (SiteParsing.lean_browser): без изображений,
+# стилей и шрифтов, запросы к blocked_hosts и их поддоменам блокируются,
+# страница считается загруженной после построения DOM
+LEAN_BROWSER = {
+    'headless': True,
+    'page_load_strategy': 'eager',
+    'block_images': True,
+    'block_css': True,
+    'block_fonts': True,
+    'blocked_hosts': [
+        'google-analytics.com',
+        'googletagmanager.com',
+        'doubleclick.net',
+        'googlesyndication.com',
+        'mc.yandex.ru',
+        'an.yandex.ru',
+        'top-fwz1.mail.ru',
+        'connect.facebook.net',
+        'criteo.com',
+        'criteo.net',
+    ],
+}
+
+# Адреса, с которых доступны метрики (/metrics)
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+
+# Записи о каждой обработанной странице (JSON) журнала parsing.metrics
+# и сообщения очереди задач (parsing.worker, parsing.helpers)
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'message': {'format': '%(message)s'},
+        'verbose': {'format': '%(asctime)s %(levelname)s %(name)s: %(message)s'},
+    },
+    'handlers': {
+        'metrics': {
+            'class': 'logging.StreamHandler',
+            'formatter': 'message',
+        },
+        'console': {
+            'class': 'logging.StreamHandler',
+            'formatter': 'verbose',
+        },
+    },
+    'loggers': {
+        'parsing': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+        'parsing.metrics': {
+            'handlers': ['metrics'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
+}
@@ -23,9 +23,11 @@ urlpatterns = [
     path('admin/', admin.site.urls),
     path('', parsing.views.index),
     path('show_goods', parsing.views.show_goods),
+    path('show_goods/stream', parsing.views.show_goods_stream),
     path('add_ref_link', parsing.views.add_ref_link),
     path('delete_link/<int:site_id>/', parsing.views.delete_link),
     path('add_ref', parsing.views.add_ref),
     path('run_price_task/<int:site_id>/', parsing.views.run_price_task),
+    path('metrics', parsing.views.metrics_view),
     # path('authentificate', user.views.authentificate)
 ]
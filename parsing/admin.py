@@ -3,4 +3,7 @@ from . import models
 
 
 admin.site.register(models.Price)
+admin.site.register(models.PriceAggregate)
 admin.site.register(models.Site)
+admin.site.register(models.PriceJob)
+admin.site.register(models.ShopConfig)
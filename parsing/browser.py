@@ -0,0 +1,70 @@
+import json
+from urllib.parse import quote
+
+from selenium.webdriver.chrome.options import Options as ChromeOptions
+from selenium.webdriver.firefox.options import Options as FirefoxOptions
+
+from config.settings import LEAN_BROWSER
+
+
+def get_pac_url(blocked_hosts):
+    """PAC-файл (data: URL), отправляющий запросы к blocked_hosts и их
+    поддоменам на несуществующий прокси, остальные - напрямую"""
+    hosts = json.dumps(list(blocked_hosts))
+    script = (
+        'function FindProxyForURL(url, host) {'
+        f' var blocked = {hosts};'
+        ' for (var i = 0; i < blocked.length; i++) {'
+        '  if (host == blocked[i] || dnsDomainIs(host, "." + blocked[i])) {'
+        '   return "PROXY 127.0.0.1:9"; } }'
+        ' return "DIRECT"; }')
+    return 'data:application/x-ns-proxy-autoconfig,' + quote(script)
+
+
+def apply_firefox_profile(options, profile):
+    if profile['block_images']:
+        options.set_preference('permissions.default.image', 2)
+    if profile['block_css']:
+        options.set_preference('permissions.default.stylesheet', 2)
+    if profile['block_fonts']:
+        options.set_preference('browser.display.use_document_fonts', 0)
+        options.set_preference('gfx.downloadable_fonts.enabled', False)
+    if profile['blocked_hosts']:
+        options.set_preference('network.proxy.type', 2)
+        options.set_preference('network.proxy.autoconfig_url',
+                               get_pac_url(profile['blocked_hosts']))
+
+
+def apply_chrome_profile(options, profile):
+    content_settings = {}
+    if profile['block_images']:
+        content_settings['images'] = 2
+    if profile['block_css']:
+        content_settings['stylesheets'] = 2
+    if profile['block_fonts']:
+        content_settings['fonts'] = 2
+    if content_settings:
+        options.add_experimental_option('prefs', {
+            f'profile.managed_default_content_settings.{name}': value
+            for name, value in content_settings.items()})
+    if profile['blocked_hosts']:
+        rules = ', '.join(f'MAP {pattern} ~NOTFOUND'
+                          for host in profile['blocked_hosts']
+                          for pattern in (host, f'*.{host}'))
+        options.add_argument(f'--host-resolver-rules={rules}')
+
+
+def apply_lean_profile(options, profile=LEAN_BROWSER):
+    """Настраивает браузер только на получение разметки страницы: без
+    изображений, стилей, шрифтов и запросов к счетчикам и рекламе.
+    Страница считается загруженной после построения DOM (eager)
+    :param options: FirefoxOptions или ChromeOptions
+    """
+    if profile['headless']:
+        options.headless = True
+    options.set_capability('pageLoadStrategy', profile['page_load_strategy'])
+    if isinstance(options, FirefoxOptions):
+        apply_firefox_profile(options, profile)
+    elif isinstance(options, ChromeOptions):
+        apply_chrome_profile(options, profile)
+    return options
@@ -40,4 +40,36 @@ class PageParserEnum(BaseEnumerate):
     }
 
 
-TypeAndId = namedtuple('TypeAndId', ['type', 'id'])
+# timeout - сколько секунд ждать появления элемента (None - значение
+# по умолчанию из SELENIUM_WAIT), учитывается SeleniumPageParser
+TypeAndId = namedtuple('TypeAndId', ['type', 'id', 'timeout'], defaults=(None,))
+
+# Валидаторы ответа, по которым повторный запрос может быть условным
+Validators = namedtuple('Validators', ['etag', 'last_modified', 'content_hash'])
+
+
+class JobStatusEnum(BaseEnumerate):
+    Pending = 0
+    Running = 1
+    Done = 2
+    Failed = 3
+
+    values = {
+        'Pending': Pending,
+        'Running': Running,
+        'Done': Done,
+        'Failed': Failed,
+    }
+
+    # Статусы задач, которые еще не завершены
+    active = (Pending, Running)
+
+
+class PricePeriodEnum(BaseEnumerate):
+    Day = 0
+    Week = 1
+
+    values = {
+        'Day': Day,
+        'Week': Week,
+    }
@@ -10,3 +10,31 @@ class FileNotDownloaded(BaseProjectException):
 class UnsupportedFileFormat(BaseProjectException):
     pass
 
+
+# Исключения, связанные с парсингом страниц
+class WebDriverPoolTimeout(BaseProjectException):
+    pass
+
+
+class ElementNotFound(BaseProjectException):
+    pass
+
+
+class PriceNotFound(BaseProjectException):
+    pass
+
+
+class UnsupportedSite(BaseProjectException):
+    pass
+
+
+class PageNotOpened(BaseProjectException):
+    """Страница не открылась. retryable - имеет ли смысл повторить загрузку позже"""
+
+    def __init__(self, message, retryable=True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class CircuitOpen(PageNotOpened):
+    pass
@@ -3,3 +3,17 @@ from django import forms
 
 class LinkForm(forms.Form):
     url = forms.URLField(label='URL')
+
+
+class GoodsListForm(forms.Form):
+    """Параметры списка товаров: курсор, размер страницы и фильтры"""
+
+    after = forms.IntegerField(required=False, min_value=0)
+    limit = forms.IntegerField(required=False, min_value=1, max_value=1000)
+    user = forms.IntegerField(required=False, min_value=1)
+    domain = forms.CharField(required=False, max_length=255)
+
+    def get_params(self):
+        """Возвращает параметры, некорректные значения игнорируются"""
+        self.is_valid()
+        return {name: self.cleaned_data.get(name) or None for name in self.fields}
@@ -1,23 +1,86 @@
-import time
+import logging
+from collections import namedtuple
 from datetime import datetime
+from urllib.parse import urlencode
 
+from django.template.loader import render_to_string
+
+from config.settings import GOODS_PAGE_SIZE
 from .constants import DEFAULT_IMG_PATH
+from .exceptions import PriceNotFound
 from .forms import LinkForm
-from .models import Site
-from .parsers import Parsing
-
-
-def get_sites_and_url_form():
-    sites = Site.objects.all()
-    for site in sites:
-        last_price = site.last_price
-        site.is_actual_price = datetime.date(last_price.date) == datetime.date(datetime.now()) if last_price else False
-        site.price_rub = f'{last_price.price} руб.' if last_price else '-'
-        site.photo_path = site.photo_path if site.photo_path else DEFAULT_IMG_PATH
-    data = {'sites': sites, 'form': LinkForm()}
+from .images import thumbnails
+from .metrics import stage, trace_page
+from .models import Site, PriceJob
+from .sites import SiteParsing
+
+logger = logging.getLogger(__name__)
+
+# Результат разбора страницы: цена, ссылка на фото и признак того,
+# что страница не изменилась с прошлой загрузки
+PageData = namedtuple('PageData', ['price', 'photo_url', 'not_modified'])
+
+
+def prepare_site(site):
+    """Подготавливает сайт с аннотациями with_last_price к выводу в таблице"""
+    # Цена хранится до изменения, актуальность определяется по последней проверке
+    last_checked = site.last_price_checked
+    site.is_actual_price = datetime.date(last_checked) == datetime.date(datetime.now()) if last_checked else False
+    site.price_rub = f'{site.last_price_value} руб.' if last_checked else '-'
+    site.photo_path = site.photo_path if site.photo_path else DEFAULT_IMG_PATH
+    site.thumbnails = thumbnails.get(site.photo_path, site.has_thumbnails)
+    return site
+
+
+def get_sites_page(after=None, limit=None, user=None, domain=None):
+    """Страница списка сайтов с курсором по id (keyset-пагинация)
+    :param after: id последнего сайта предыдущей страницы
+    :param limit: Размер страницы
+    :param user: id пользователя
+    :param domain: Домен сайта
+    :return: Список сайтов и id для следующей страницы (None, если это последняя)
+    """
+    limit = limit or GOODS_PAGE_SIZE
+    sites = Site.objects.with_job_state().with_last_price().order_by('id')
+    if user is not None:
+        sites = sites.filter(user_id=user)
+    if domain:
+        sites = sites.filter(domain=domain.lower())
+    if after is not None:
+        sites = sites.filter(id__gt=after)
+    sites = list(sites[:limit + 1])
+    next_cursor = sites[limit - 1].id if len(sites) > limit else None
+    return [prepare_site(site) for site in sites[:limit]], next_cursor
+
+
+def get_sites_and_url_form(after=None, limit=None, user=None, domain=None):
+    sites, next_cursor = get_sites_page(after, limit, user, domain)
+    filters = {key: value for key, value in
+               (('limit', limit), ('user', user), ('domain', domain)) if value}
+    data = {
+        'sites': sites,
+        'form': LinkForm(),
+        'next_url': f'?{urlencode(dict(filters, after=next_cursor))}' if next_cursor else None,
+        'first_url': f'?{urlencode(filters)}' if after is not None else None,
+    }
     return data
 
 
+def stream_goods(request, user=None, domain=None, chunk_size=None):
+    """Построчно формирует HTML таблицы сайтов. Сайты выбираются из БД
+    страницами по chunk_size, поэтому память не зависит от их количества"""
+    yield render_to_string('show_goods_stream_head.html', request=request)
+    after = None
+    while True:
+        sites, after = get_sites_page(after, chunk_size, user, domain)
+        yield ''.join(render_to_string('goods_row.html', {'site': site}, request)
+                      for site in sites)
+        if after is None:
+            break
+    yield render_to_string('show_goods_stream_tail.html',
+                           {'form': LinkForm()}, request)
+
+
 def add_message_to_context(context, message=None):
     context['has_message'] = False if message is None else True
     if message:
@@ -26,6 +89,8 @@ def add_message_to_context(context, message=None):
 
 
 def add_link(url):
+    if not SiteParsing.is_supported(url):
+        return False, 'Ссылка не была добавлена: сайт не поддерживается!'
     site = Site.add_ref_link(url)
     if site:
         message = 'Ссылка успешно добавлена!'
@@ -43,32 +108,69 @@ def delete_site(id):
     return message
 
 
-def calculate_time(fun):
-    def calculate(url_param):
-        t = time.time()
-        result = fun(url_param)
-        print(f'Время на обработку запроса - {time.time() - t} секунд')
-        return result
-    return calculate
-
-
-def price_task(site_id):
-    try:
-        site = Site.objects.get(id=site_id)
-    except Site.DoesNotExist:
-        print(f'Сайт с id = {site_id} не существует!')
-        return
-    if site.is_running:
-        print('Задача уже запущена!')
-        return
-    print('---------------------------------------------')
-    print(f'Задача обновления данных сайта (id={site_id}) была запущена!')
-    Site.objects.filter(id=site_id).update(is_running=True)
-    try:
-        price, photo_name = Parsing(site.url).parse_data()
-        site.add_price_and_photo(price, photo_name)
-    except Exception as e:
-        print(f'Произошла ошибка при обновлении данных сайта (id={site_id}). {e}')
-    finally:
-        Site.objects.filter(id=site_id).update(is_running=False)
-        print('---------------------------------------------')
\ No newline at end of file
+def enqueue_price_task(site_id):
+    job = PriceJob.enqueue(site_id)
+    if job is None:
+        logger.warning('Сайт с id = %s не существует', site_id)
+    return job
+
+
+def parse_site(site, price_only=False):
+    """Парсит страницу сайта с учетом валидаторов прошлой загрузки
+    (если фото сайта уже загружено) и обновляет валидаторы сайта. Фото не загружается (см. get_photo_path),
+    поэтому сессия браузера освобождается сразу после разбора страницы.
+    Сайт должен быть получен с with_last_price
+    :param price_only: Не искать ссылку на фото
+    :return: PageData; если страница не изменилась - сохраненная цена
+    """
+    # Парсеры (selenium, lxml, requests) загружаются только при парсинге,
+    # а не при запуске веб-приложения
+    from .parsers import Parsing
+
+    # Если фото нет (например, его загрузка не удалась), страница разбирается
+    # заново даже без изменений, иначе ссылка на фото не будет получена
+    has_photo = price_only or site.has_photo(site.photo_url)
+    parsing = Parsing(site.url, site.validators if has_photo else None)
+    price, photo_url = parsing.parse_page(with_photo=not price_only)
+    if parsing.not_modified:
+        return PageData(site.last_price_value, None, True)
+    if parsing.validators:
+        site.validators = parsing.validators
+    return PageData(price, photo_url, False)
+
+
+def get_photo_path(site, page):
+    """Путь к фото сайта: прежний, если страница не изменилась или ссылка
+    на изображение та же и файл на месте, иначе - загруженного по ссылке
+    со страницы. Ссылка загруженного фото запоминается в сайте.
+    Недостающие уменьшенные копии фото создаются, их наличие отмечается
+    в сайте (has_thumbnails)"""
+    from .parsers import PhotoDownloader, download_photo
+
+    if page.not_modified or site.has_photo(page.photo_url):
+        photo_path = site.photo_path
+        if site.has_thumbnails:
+            return photo_path
+    else:
+        photo_path = download_photo(page.photo_url, SiteParsing.get_site_class(site.url).__name__)
+        # После ошибки загрузки фото будет загружено заново при следующем обновлении
+        site.photo_url = page.photo_url if photo_path and photo_path != DEFAULT_IMG_PATH else ''
+    site.has_thumbnails = bool(photo_path and photo_path != DEFAULT_IMG_PATH
+                               and PhotoDownloader.make_thumbnails(photo_path))
+    return photo_path
+
+
+def update_site_price(site_id):
+    """Обновляет цену и фото сайта. Ошибки не перехватываются,
+    чтобы обработчик очереди мог повторить задачу
+    :raise: Site.DoesNotExist, PriceNotFound, PageNotOpened
+    """
+    site = Site.objects.with_last_price().get(id=site_id)
+    # Запись в БД входит в замер страницы: ошибка записи - ошибка обработки
+    with trace_page(SiteParsing.get_site_class(site.url).__name__, site.url):
+        page = parse_site(site)
+        photo_name = get_photo_path(site, page)
+        with stage('db_write'):
+            saved = site.add_price_and_photo(page.price, photo_name)
+    if not saved:
+        raise PriceNotFound(f'Не удалось получить цену или фото сайта (id={site_id})')
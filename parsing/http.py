@@ -0,0 +1,127 @@
+import hashlib
+import threading
+from collections import Counter
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config.settings import HTTP_CLIENT
+from .constants import Validators
+from .throttle import get_scheduler
+
+EMPTY_VALIDATORS = Validators('', '', '')
+
+
+def get_content_hash(content):
+    return hashlib.sha256(content).hexdigest()
+
+
+def conditional_headers(validators):
+    """Заголовки условного запроса по сохраненным валидаторам"""
+    headers = {}
+    if validators and validators.etag:
+        headers['If-None-Match'] = validators.etag
+    if validators and validators.last_modified:
+        headers['If-Modified-Since'] = validators.last_modified
+    return headers
+
+
+def get_validators(response, content_hash):
+    return Validators(response.headers.get('ETag', ''),
+                      response.headers.get('Last-Modified', ''),
+                      content_hash)
+
+
+def is_not_modified(response, validators, content_hash=None):
+    """Проверяет, что ресурс не изменился: сервер вернул 304
+    или содержимое совпадает с сохраненным"""
+    if response.status_code == 304:
+        return bool(validators)
+    return bool(validators and content_hash
+                and validators.content_hash == content_hash)
+
+
+class HttpClient:
+    """Общий HTTP-клиент для загрузки страниц и изображений.
+
+    Использует одну сессию requests: соединения с каждым хостом хранятся
+    в пуле и переиспользуются (keep-alive), у всех запросов есть таймаут.
+    Частота запросов к каждому домену ограничивается планировщиком
+    (DomainScheduler), которому сообщается о каждом ответе.
+    """
+
+    def __init__(self, pool_connections=10, pool_maxsize=10,
+                 connect_timeout=5, read_timeout=30, user_agent=None,
+                 scheduler=None):
+        """
+        :param pool_connections: Количество хостов, для которых хранятся пулы
+        :param pool_maxsize: Количество соединений в пуле одного хоста
+        :param connect_timeout: Таймаут установки соединения (сек.)
+        :param read_timeout: Таймаут ожидания данных (сек.)
+        :param user_agent: Значение заголовка User-Agent
+        :param scheduler: Планировщик запросов, по умолчанию - общий для процесса
+        """
+        self.timeout = (connect_timeout, read_timeout)
+        self.scheduler = scheduler
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_connections,
+                              pool_maxsize=pool_maxsize)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if user_agent:
+            self.session.headers['User-Agent'] = user_agent
+        self._requests = Counter()
+        self._lock = threading.Lock()
+
+    def get(self, url, throttle=True, **kwargs):
+        """
+        :param throttle: Соблюдать ограничение частоты запросов к домену
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        scheduler = (self.scheduler or get_scheduler()) if throttle else None
+        if scheduler:
+            scheduler.acquire(url)
+        with self._lock:
+            self._requests[urlparse(url).netloc] += 1
+        response = self.session.get(url, **kwargs)
+        if scheduler:
+            scheduler.report(url, response.status_code,
+                             response.headers.get('Retry-After'))
+        return response
+
+    def stats(self):
+        """Статистика по хостам: количество запросов, открытых соединений
+        и свободных соединений в пуле"""
+        stats = {host: {'requests': count, 'connections': 0, 'idle': 0}
+                 for host, count in self._requests.items()}
+        for adapter in set(self.session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                host = pool.host if pool.port in (None, 80, 443) else f'{pool.host}:{pool.port}'
+                host_stats = stats.setdefault(
+                    host, {'requests': 0, 'connections': 0, 'idle': 0})
+                host_stats['connections'] += pool.num_connections
+                if pool.pool is not None:
+                    host_stats['idle'] += sum(
+                        1 for conn in list(pool.pool.queue) if conn is not None)
+        return stats
+
+    def close(self):
+        self.session.close()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_http_client():
+    """Общий для процесса HTTP-клиент, настраивается через HTTP_CLIENT"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = HttpClient(**HTTP_CLIENT)
+        return _client
@@ -0,0 +1,187 @@
+import hashlib
+import os
+import tempfile
+import time
+
+from config.settings import PHOTO_DOWNLOAD, THUMBNAILS
+from .exceptions import FileNotDownloaded
+
+
+class ImageStore:
+    """Хранилище изображений, адресуемых по содержимому.
+
+    Файл сохраняется под именем sha256 своего содержимого в подкаталогах
+    по первым символам хеша: <root>/ab/cd/abcd....jpg. Одинаковые
+    изображения хранятся один раз, повторная загрузка ничего не меняет.
+
+    Имя файла не подбирается, поэтому стоимость сохранения не зависит от
+    количества файлов. Несколько процессов могут сохранять изображения
+    одновременно: у каждой загрузки свой временный файл (mkstemp), а
+    переименование в итоговый файл атомарно.
+    """
+
+    temp_suffix = '.part'
+
+    def __init__(self, root, max_size=PHOTO_DOWNLOAD['max_size']):
+        self.root = root
+        self.max_size = max_size
+
+    def get_path(self, content_hash, img_format):
+        return os.path.join(self.root, content_hash[:2], content_hash[2:4],
+                            f'{content_hash}.{img_format}')
+
+    def save(self, chunks, img_format):
+        """Сохраняет изображение, получаемое частями. Данные пишутся
+        во временный файл, который затем переименовывается в итоговый
+        :param chunks: Итератор по частям содержимого
+        :param img_format: Расширение файла изображения
+        :return: Хеш содержимого и путь к файлу
+        :raise: FileNotDownloaded
+        """
+        os.makedirs(self.root, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.root, suffix=self.temp_suffix)
+        try:
+            content_hash, size = self._write(fd, chunks)
+            if not size:
+                raise FileNotDownloaded('Изображение пустое!')
+            path = self.get_path(content_hash, img_format)
+            if os.path.exists(path):
+                os.remove(temp_path)
+            else:
+                # mkstemp создает файл, доступный только владельцу
+                os.chmod(temp_path, 0o644)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(temp_path, path)
+            return content_hash, path
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def _write(self, fd, chunks):
+        hasher = hashlib.sha256()
+        size = 0
+        with os.fdopen(fd, 'wb') as out:
+            for chunk in chunks:
+                size += len(chunk)
+                if size > self.max_size:
+                    raise FileNotDownloaded(
+                        f'Размер изображения превышает {self.max_size} байт!')
+                hasher.update(chunk)
+                out.write(chunk)
+        return hasher.hexdigest(), size
+
+    def iter_files(self):
+        for dir_path, _, file_names in os.walk(self.root):
+            for file_name in file_names:
+                yield os.path.normpath(os.path.join(dir_path, file_name))
+
+    def collect_garbage(self, referenced, min_age=3600, dry_run=False):
+        """Удаляет файлы, на которые нет ссылок. Недавно измененные файлы
+        не трогаются: они могут принадлежать загрузке, которая еще
+        не сохранена в БД
+        :param referenced: Множество абсолютных путей используемых файлов
+        :param min_age: Минимальный возраст удаляемого файла (сек.)
+        :return: Список удаленных файлов
+        """
+        removed = []
+        now = time.time()
+        for path in self.iter_files():
+            if path in referenced:
+                continue
+            try:
+                if now - os.path.getmtime(path) < min_age:
+                    continue
+                if not dry_run:
+                    os.remove(path)
+            except FileNotFoundError:
+                continue
+            removed.append(path)
+        return removed
+
+
+class Thumbnails:
+    """Уменьшенные копии изображений для списка товаров.
+
+    Копии сохраняются рядом с оригиналом под именем <хеш>_h<высота>.<формат>,
+    поэтому для одного изображения и размера они создаются один раз.
+    JPEG создается всегда, остальные форматы - если указаны в настройках.
+    Pillow загружается только при создании копий, поэтому вывод списка
+    товаров его не загружает.
+    """
+
+    pillow_formats = {'jpeg': 'JPEG', 'webp': 'WEBP'}
+
+    def __init__(self, sizes=THUMBNAILS['sizes'], formats=THUMBNAILS['formats'],
+                 quality=THUMBNAILS['quality']):
+        """
+        :param sizes: Названия размеров и высота копии (px)
+        :param formats: Форматы копий
+        :param quality: Качество сжатия
+        """
+        self.sizes = sizes
+        self.formats = list(formats) if 'jpeg' in formats else [*formats, 'jpeg']
+        self.quality = quality
+
+    @staticmethod
+    def get_path(photo_path, height, img_format):
+        return f'{os.path.splitext(photo_path)[0]}_h{height}.{img_format}'
+
+    def get_paths(self, photo_path):
+        """Пути всех копий изображения"""
+        return [self.get_path(photo_path, height, img_format)
+                for height in self.sizes.values() for img_format in self.formats]
+
+    def exist(self, photo_path):
+        """Созданы ли все копии изображения"""
+        return all(os.path.exists(path) for path in self.get_paths(photo_path))
+
+    def make(self, photo_path):
+        """Создает недостающие копии изображения"""
+        if self.exist(photo_path):
+            return
+        from PIL import Image, features
+
+        if 'webp' in self.formats and not features.check('webp'):
+            # Копии считаются созданными, только если есть все форматы
+            raise ValueError('Pillow собран без поддержки WebP, '
+                             'уберите webp из THUMBNAILS["formats"]')
+
+        with Image.open(photo_path) as image:
+            image = image.convert('RGB')
+            for height in self.sizes.values():
+                thumbnail = image.copy()
+                thumbnail.thumbnail((height * 10, height))
+                for img_format in self.formats:
+                    path = self.get_path(photo_path, height, img_format)
+                    if not os.path.exists(path):
+                        self._save(thumbnail, path, img_format)
+
+    def _save(self, thumbnail, path, img_format):
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                thumbnail.save(out, self.pillow_formats[img_format],
+                               quality=self.quality)
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def get(self, photo_path, made):
+        """Пути копий для вывода в шаблоне: {размер: {формат: путь}}.
+        Файлы не проверяются, чтобы не обращаться к диску при выводе списка
+        :param made: Созданы ли копии (Site.has_thumbnails); если нет,
+        для всех размеров возвращается оригинал
+        """
+        if not made:
+            return {name: {'jpeg': photo_path} for name in self.sizes}
+        return {name: {img_format: self.get_path(photo_path, height, img_format)
+                       for img_format in self.formats}
+                for name, height in self.sizes.items()}
+
+
+# Копии изображений товаров с настройками THUMBNAILS
+thumbnails = Thumbnails()
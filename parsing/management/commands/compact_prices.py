@@ -0,0 +1,25 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from config.settings import PRICE_HISTORY
+from parsing.models import PriceAggregate
+
+
+class Command(BaseCommand):
+    help = 'Заменяет старую историю цен сводками по дням и неделям (минимум, максимум, последняя цена)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--raw-days', type=int, default=PRICE_HISTORY['raw_days'],
+                            help='Хранить все изменения цен за указанное количество дней')
+        parser.add_argument('--daily-days', type=int, default=PRICE_HISTORY['daily_days'],
+                            help='Хранить сводки по дням за указанное количество дней')
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        prices, days = PriceAggregate.compact(
+            raw_before=now - timedelta(days=options['raw_days']),
+            daily_before=now - timedelta(days=options['daily_days']))
+        self.stdout.write(f'Цен заменено сводками по дням: {prices}; '
+                          f'сводок по дням заменено сводками по неделям: {days}')
@@ -0,0 +1,39 @@
+import os
+
+from django.core.management.base import BaseCommand
+
+from config.settings import BASE_DIR
+from parsing.constants import DEFAULT_IMG_PATH
+from parsing.models import Site, PhotoCache
+from parsing.parsers import PhotoDownloader
+
+
+def get_abs_path(path):
+    return os.path.normpath(path if os.path.isabs(path) else os.path.join(BASE_DIR, path))
+
+
+class Command(BaseCommand):
+    help = 'Удаляет изображения товаров, на которые не ссылается ни один сайт'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-age', type=int, default=3600,
+                            help='Не удалять файлы, измененные менее указанного времени назад (сек.)')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Только вывести файлы, которые будут удалены')
+
+    def handle(self, *args, **options):
+        referenced = {get_abs_path(DEFAULT_IMG_PATH)}
+        photo_paths = Site.objects.exclude(photo_path=None).values_list(
+            'photo_path', flat=True)
+        thumbnails = PhotoDownloader.thumbnails
+        for path in photo_paths.iterator():
+            referenced.add(get_abs_path(path))
+            referenced.update(get_abs_path(p) for p in thumbnails.get_paths(path))
+        removed = PhotoDownloader.store.collect_garbage(
+            referenced, options['min_age'], options['dry_run'])
+        for path in removed:
+            self.stdout.write(path)
+        if not options['dry_run']:
+            for i in range(0, len(removed), 500):
+                PhotoCache.objects.filter(path__in=removed[i:i + 500]).delete()
+        self.stdout.write(f'Удалено файлов: {len(removed)}')
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from parsing.constants import DEFAULT_IMG_PATH
+from parsing.models import Site
+from parsing.parsers import PhotoDownloader
+
+
+class Command(BaseCommand):
+    help = 'Создает недостающие уменьшенные копии фото товаров и отмечает их в сайтах'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help='Проверить и сайты, у которых копии уже отмечены')
+
+    def handle(self, *args, **options):
+        sites = Site.objects.exclude(photo_path=None).exclude(
+            photo_path__in=['', DEFAULT_IMG_PATH])
+        if not options['all']:
+            sites = sites.filter(has_thumbnails=False)
+        made, missing = [], []
+        for site_id, photo_path in sites.values_list('id', 'photo_path').iterator():
+            ids = made if PhotoDownloader.make_thumbnails(photo_path) else missing
+            ids.append(site_id)
+        for ids, value in ((made, True), (missing, False)):
+            for i in range(0, len(ids), 500):
+                Site.objects.filter(id__in=ids[i:i + 500]).update(has_thumbnails=value)
+        self.stdout.write(f'Сайтов с копиями фото: {len(made)}; '
+                          f'не удалось создать копии: {len(missing)}')
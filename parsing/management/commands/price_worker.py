@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from parsing.metrics import serve_metrics
+from parsing.parsers import SeleniumPageParser
+from parsing.worker import PriceWorker
+
+
+class Command(BaseCommand):
+    help = 'Обработчик очереди задач обновления цен'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--name', help='Имя обработчика, по умолчанию - host:pid')
+        parser.add_argument('--poll-interval', type=float,
+                            help='Период опроса пустой очереди (сек.)')
+        parser.add_argument('--max-jobs', type=int,
+                            help='Завершиться после выполнения указанного количества задач')
+        parser.add_argument('--burst', action='store_true',
+                            help='Завершиться, когда очередь опустеет')
+        parser.add_argument('--metrics-port', type=int,
+                            help='Отдавать метрики по адресу http://<хост>:<порт>/metrics')
+
+    def handle(self, *args, **options):
+        if options['metrics_port']:
+            serve_metrics(options['metrics_port'])
+        worker = PriceWorker(name=options['name'],
+                             poll_interval=options['poll_interval'])
+        try:
+            done = worker.run(max_jobs=options['max_jobs'],
+                              burst=options['burst'])
+        except KeyboardInterrupt:
+            return
+        finally:
+            SeleniumPageParser.close_pools()
+        self.stdout.write(f'Выполнено задач: {done}')
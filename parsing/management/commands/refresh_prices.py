@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand
+
+from parsing.http import get_http_client
+from parsing.metrics import metrics
+from parsing.parsers import SeleniumPageParser
+from parsing.refresh import refresh_prices
+
+
+class Command(BaseCommand):
+    help = 'Массовое обновление цен для всех (или выбранных) сайтов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('site_ids', nargs='*', type=int,
+                            help='id сайтов, по умолчанию - все сайты')
+        parser.add_argument('--concurrency', type=int,
+                            help='Максимум одновременно обрабатываемых страниц')
+        parser.add_argument('--per-domain', type=int,
+                            help='Максимум одновременно обрабатываемых страниц одного домена')
+        parser.add_argument('--selenium-workers', type=int,
+                            help='Количество потоков для сайтов, требующих браузер')
+        parser.add_argument('--io-workers', type=int,
+                            help='Количество потоков загрузки фото')
+        parser.add_argument('--batch-size', type=int,
+                            help='Количество результатов, сохраняемых в одной транзакции')
+        parser.add_argument('--price-only', action='store_true',
+                            help='Обновлять только цены, не загружая фото')
+
+    def handle(self, *args, **options):
+        try:
+            summary = refresh_prices(
+                site_ids=options['site_ids'] or None,
+                concurrency=options['concurrency'],
+                per_domain=options['per_domain'],
+                selenium_workers=options['selenium_workers'],
+                io_workers=options['io_workers'],
+                batch_size=options['batch_size'],
+                price_only=options['price_only'],
+            )
+        finally:
+            SeleniumPageParser.close_pools()
+        self.stdout.write(str(summary))
+        for host, stats in sorted(get_http_client().stats().items()):
+            self.stdout.write(f'{host}: запросов - {stats["requests"]}, '
+                              f'соединений - {stats["connections"]}')
+        self.stdout.write('Время этапов:')
+        stages = metrics.get_histograms('parsing_stage_seconds')
+        for labels, (total, count) in sorted(stages.items()):
+            labels = dict(labels)
+            self.stdout.write(f'{labels["site"]} - {labels["stage"]}: {count} раз, '
+                              f'в среднем {total / count * 1000:.1f} мс, всего {total:.1f} сек.')
@@ -0,0 +1,240 @@
+"""Метрики обработки страниц.
+
+Время этапов (получение браузера, открытие страницы, поиск цены и фото,
+загрузка изображения, запись в БД) и количество обработанных страниц
+по классу сайта и результату накапливаются в памяти процесса и отдаются
+в текстовом формате Prometheus: представлением /metrics веб-приложения или
+HTTP-сервером обработчика очереди (price_worker --metrics-port).
+По каждой странице в журнал parsing.metrics пишется запись в JSON.
+"""
+import json
+import logging
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger('parsing.metrics')
+
+# Границы интервалов гистограмм (сек.)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+DESCRIPTIONS = {
+    'parsing_pages_total': ('counter', 'Обработано страниц по сайту и результату'),
+    'parsing_errors_total': ('counter', 'Ошибки обработки страниц по сайту и типу ошибки'),
+    'parsing_page_seconds': ('histogram', 'Время обработки страницы'),
+    'parsing_stage_seconds': ('histogram', 'Время этапа обработки страницы (без вложенных этапов)'),
+}
+
+
+def format_labels(labels, **extra):
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in items) + '}'
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics:
+    """Счетчики и гистограммы с метками. Значения хранятся в памяти процесса"""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = defaultdict(float)
+            # (имя, метки) -> [количество по интервалам, сумма, количество]
+            self.histograms = {}
+
+    @staticmethod
+    def get_key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self.get_key(name, labels)
+        with self._lock:
+            self.counters[key] += value
+
+    def observe(self, name, value, **labels):
+        key = self.get_key(name, labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def get_counter(self, name, **labels):
+        return self.counters.get(self.get_key(name, labels), 0)
+
+    def get_histogram(self, name, **labels):
+        """Сумма и количество наблюдений"""
+        histogram = self.histograms.get(self.get_key(name, labels))
+        return (histogram[1], histogram[2]) if histogram else (0, 0)
+
+    def get_histograms(self, name):
+        """Сумма и количество наблюдений для всех меток: {метки: (сумма, количество)}"""
+        with self._lock:
+            return {dict_labels: (h[1], h[2]) for (metric, dict_labels), h
+                    in self.histograms.items() if metric == name}
+
+    def render(self):
+        """Значения в текстовом формате Prometheus"""
+        with self._lock:
+            counters = dict(self.counters)
+            histograms = {key: (list(h[0]), h[1], h[2]) for key, h in self.histograms.items()}
+        series = defaultdict(list)
+        for (name, labels), value in sorted(counters.items()):
+            series[name].append(f'{name}{format_labels(labels)} {format_value(value)}')
+        for (name, labels), (counts, total, count) in sorted(histograms.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                series[name].append(
+                    f'{name}_bucket{format_labels(labels, le=bound)} {cumulative}')
+            series[name].append(f'{name}_sum{format_labels(labels)} {format_value(total)}')
+            series[name].append(f'{name}_count{format_labels(labels)} {count}')
+        lines = []
+        for name in sorted(series):
+            metric_type, description = DESCRIPTIONS.get(name, ('untyped', name))
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            lines.extend(series[name])
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+_local = threading.local()
+
+
+class PageTrace:
+    """Замер обработки одной страницы. Время этапа учитывается без
+    вложенных этапов: например, загрузка изображения не входит в поиск фото"""
+
+    def __init__(self, site, url):
+        self.site = site
+        self.url = url
+        self.stages = defaultdict(float)
+        self.outcome = 'ok'
+        self.start = time.perf_counter()
+        # Время вложенных этапов для каждого открытого этапа
+        self._nested = []
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        self._nested.append(0.0)
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            own = elapsed - self._nested.pop()
+            if self._nested:
+                self._nested[-1] += elapsed
+            self.stages[name] += own
+            metrics.observe('parsing_stage_seconds', own, site=self.site, stage=name)
+
+    def finish(self, outcome, error=None, elapsed=None):
+        """:param elapsed: Время обработки, если оно считается не до вызова finish"""
+        if elapsed is None:
+            elapsed = time.perf_counter() - self.start
+        metrics.inc('parsing_pages_total', site=self.site, outcome=outcome)
+        metrics.observe('parsing_page_seconds', elapsed, site=self.site)
+        if error is not None:
+            metrics.inc('parsing_errors_total', site=self.site, error=type(error).__name__)
+        logger.info(json.dumps({
+            'event': 'page_parsed',
+            'site': self.site,
+            'url': self.url,
+            'outcome': outcome,
+            'error': str(error) if error is not None else None,
+            'seconds': round(elapsed, 4),
+            'stages': {name: round(value, 4) for name, value in self.stages.items()},
+        }, ensure_ascii=False))
+
+
+@contextmanager
+def use_trace(trace):
+    """Относит этапы, запущенные в этом потоке, к замеру trace. Нужен, если
+    страница обрабатывается в нескольких потоках; замер завершается вызовом
+    trace.finish"""
+    previous = getattr(_local, 'trace', None)
+    _local.trace = trace
+    try:
+        yield trace
+    finally:
+        _local.trace = previous
+
+
+@contextmanager
+def trace_page(site, url):
+    """Замер обработки страницы сайта site (имя класса). Этапы, запущенные
+    в этом потоке через stage(), относятся к этой странице. Результат
+    задается через trace.outcome; при исключении результат - error.
+    Если замер этой страницы уже идет (например, вместе с записью в БД),
+    используется он"""
+    current = getattr(_local, 'trace', None)
+    if current is not None and current.url == url:
+        yield current
+        return
+    with use_trace(PageTrace(site, url)) as trace:
+        try:
+            yield trace
+        except Exception as e:
+            trace.finish('error', e)
+            raise
+        else:
+            trace.finish(trace.outcome)
+
+
+@contextmanager
+def stage(name, site=None):
+    """Замер этапа. Вне trace_page нужно указать сайт"""
+    trace = getattr(_local, 'trace', None)
+    if trace is not None and site is None:
+        with trace.stage(name):
+            yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.observe('parsing_stage_seconds', time.perf_counter() - start,
+                        site=site or 'unknown', stage=name)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve_metrics(port, host=''):
+    """Отдает метрики процесса по адресу http://<host>:<port>/metrics
+    в фоновом потоке (для процессов без веб-сервера)"""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
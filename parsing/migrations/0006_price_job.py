@@ -0,0 +1,39 @@
+# Generated by Django 3.0.3 on 2026-10-18 13:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parsing', '0005_site_is_running'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='site',
+            name='is_running',
+        ),
+        migrations.CreateModel(
+            name='PriceJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.IntegerField(choices=[(0, 'Pending'), (1, 'Running'), (2, 'Done'), (3, 'Failed')], default=0)),
+                ('attempts', models.IntegerField(default=0)),
+                ('max_attempts', models.IntegerField(default=3)),
+                ('run_after', models.DateTimeField(default=django.utils.timezone.now)),
+                ('locked_by', models.CharField(blank=True, max_length=100)),
+                ('locked_at', models.DateTimeField(blank=True, null=True)),
+                ('error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('site', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='jobs', to='parsing.Site')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='pricejob',
+            index=models.Index(fields=['status', 'run_after'], name='parsing_pri_status_0d0a2f_idx'),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 3.0.3 on 2026-10-18 13:21
+
+from urllib.parse import urlparse
+
+from django.db import migrations, models
+
+
+def fill_domain(apps, schema_editor):
+    Site = apps.get_model('parsing', 'Site')
+    for site in Site.objects.all():
+        site.domain = urlparse(site.url).netloc.lower()
+        site.save(update_fields=['domain'])
+
+
+class Migration(migrations.Migration):
+
+    replaces = [
+        ('parsing', '0007_site_domain'),
+        ('parsing', '0008_indexes'),
+    ]
+
+    dependencies = [
+        ('parsing', '0006_price_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='site',
+            name='domain',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.RunPython(fill_domain, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='price',
+            index=models.Index(fields=['site', '-date'], name='price_site_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='site',
+            index=models.Index(fields=['user', 'id'], name='site_user_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='site',
+            index=models.Index(fields=['domain', 'id'], name='site_domain_id_idx'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 3.0.3 on 2026-10-18 13:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parsing', '0007_site_domain_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PhotoCache',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('url', models.URLField(max_length=500, unique=True)),
+                ('path', models.CharField(max_length=200)),
+                ('etag', models.CharField(blank=True, max_length=255)),
+                ('last_modified', models.CharField(blank=True, max_length=100)),
+                ('content_hash', models.CharField(blank=True, max_length=64)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='site',
+            name='content_hash',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='site',
+            name='etag',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='site',
+            name='last_modified',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+    ]
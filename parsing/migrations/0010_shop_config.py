@@ -0,0 +1,30 @@
+# Generated by Django 3.0.3 on 2026-10-18 13:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parsing', '0009_http_validators'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShopConfig',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('main_url', models.URLField()),
+                ('aliases', models.CharField(blank=True, max_length=500)),
+                ('page_parser_type', models.IntegerField(choices=[(0, 'Selenium'), (1, 'Requests')], default=1)),
+                ('price_src', models.TextField()),
+                ('photo_src', models.TextField()),
+                ('price_index', models.IntegerField(default=0)),
+                ('photo_index', models.IntegerField(default=0)),
+                ('photo_attribute', models.CharField(default='src', max_length=50)),
+                ('is_active', models.BooleanField(default=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
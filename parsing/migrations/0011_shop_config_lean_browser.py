@@ -0,0 +1,18 @@
+# Generated by Django 3.0.3 on 2026-10-18 13:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parsing', '0010_shop_config'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='shopconfig',
+            name='lean_browser',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.3 on 2026-10-18 13:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parsing', '0011_shop_config_lean_browser'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='site',
+            name='photo_url',
+            field=models.URLField(blank=True, max_length=500),
+        ),
+    ]
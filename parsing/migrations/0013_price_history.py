@@ -0,0 +1,50 @@
+# Generated by Django 3.0.3 on 2026-10-18 13:54
+
+from django.db import migrations, models
+from django.db.models import F
+import django.db.models.deletion
+
+
+def set_valid_until(apps, schema_editor):
+    """Существующие цены подтверждены только в момент получения"""
+    Price = apps.get_model('parsing', 'Price')
+    Price.objects.update(valid_until=F('date'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parsing', '0012_site_photo_url'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='price',
+            name='valid_until',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.RunPython(set_valid_until, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='price',
+            name='valid_until',
+            field=models.DateTimeField(),
+        ),
+        migrations.CreateModel(
+            name='PriceAggregate',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.IntegerField(choices=[(0, 'Day'), (1, 'Week')])),
+                ('start', models.DateTimeField()),
+                ('min_price', models.IntegerField()),
+                ('max_price', models.IntegerField()),
+                ('last_price', models.IntegerField()),
+                ('last_date', models.DateTimeField()),
+                ('valid_until', models.DateTimeField()),
+                ('site', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='price_aggregates', to='parsing.Site')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='priceaggregate',
+            constraint=models.UniqueConstraint(fields=('site', 'period', 'start'), name='price_aggregate_site_period_start'),
+        ),
+    ]
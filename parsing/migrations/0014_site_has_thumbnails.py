@@ -0,0 +1,18 @@
+# Generated by Django 3.0.3 on 2026-10-18 18:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parsing', '0013_price_history'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='site',
+            name='has_thumbnails',
+            field=models.BooleanField(default=False),
+        ),
+    ]
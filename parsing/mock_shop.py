@@ -0,0 +1,175 @@
+"""Локальный сервер, имитирующий страницы товаров и изображения магазинов.
+
+Используется в тестах и бенчмарках вместо настоящих сайтов. Для каждого
+класса сайта (SiteParsing) запускается свой сервер: страница товара
+собирается из записанной страницы магазина (fixtures/mock_shop/<сайт>.html),
+изображения генерируются. Задержку ответа и долю ошибок можно настроить.
+
+    with MockShop(Wildberries, latency=0.05) as shop:
+        Parsing(shop.url_for(site.url)).parse_data()
+"""
+import io
+import os
+import random
+import threading
+import time
+import types
+import zlib
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from string import Template
+from urllib.parse import urlparse
+
+from PIL import Image
+
+from .constants import PageParserEnum
+from .sites import SiteParsing
+
+PAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'fixtures', 'mock_shop')
+
+
+@lru_cache(maxsize=None)
+def get_template(page_name):
+    with open(os.path.join(PAGES_DIR, f'{page_name}.html'), encoding='utf-8') as file:
+        return Template(file.read())
+
+
+@lru_cache(maxsize=1)
+def get_base_image(width, height):
+    return Image.effect_noise((width, height), 64).convert('RGB')
+
+
+@lru_cache(maxsize=1024)
+def make_image(image_id, width=600, height=800):
+    """JPEG-изображение товара. Для разных image_id содержимое различается"""
+    image = get_base_image(width, height).copy()
+    color = (image_id * 67 % 256, image_id * 131 % 256, image_id * 197 % 256)
+    image.paste(color, (0, 0, width // 4, height // 4))
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=85)
+    return buffer.getvalue()
+
+
+class MockShopHandler(BaseHTTPRequestHandler):
+    """/img/<число>.jpg - изображение, любой другой путь - страница товара"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        shop = self.server.shop
+        shop.count_request()
+        shop.wait()
+        if shop.should_fail():
+            return self.respond(503, b'Service Unavailable', 'text/plain')
+        path = urlparse(self.path).path
+        if path.startswith('/img/'):
+            image_id = os.path.splitext(os.path.basename(path))[0]
+            if not image_id.isdigit():
+                return self.respond(404, b'Not Found', 'text/plain')
+            return self.respond(200, make_image(int(image_id)), 'image/jpeg')
+        self.respond(200, shop.get_page(path).encode(), 'text/html; charset=utf-8')
+
+    def respond(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class QuietServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Клиент может прервать загрузку, например, из-за ограничения размера
+        pass
+
+
+class MockShop:
+    """Сервер-имитация магазина site_class.
+
+    На время работы в реестре сайтов регистрируется подкласс site_class
+    с адресом сервера (mock_class), который загружает страницы через
+    requests, поэтому браузер не нужен.
+    """
+
+    def __init__(self, site_class, latency=0, jitter=0, error_rate=0,
+                 page_name=None, seed=None):
+        """
+        :param latency: Задержка ответа (сек.)
+        :param jitter: Случайная добавка к задержке, от 0 до jitter (сек.)
+        :param error_rate: Доля ответов 503
+        :param page_name: Имя записанной страницы, по умолчанию - имя класса сайта
+        """
+        self.site_class = site_class
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.page_name = page_name or site_class.__name__.lower()
+        self.random = random.Random(seed)
+        self.requests = 0
+        self._lock = threading.Lock()
+        self.server = None
+        self.base_url = None
+        self.mock_class = None
+
+    def count_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def wait(self):
+        with self._lock:
+            delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+
+    def should_fail(self):
+        with self._lock:
+            return self.random.random() < self.error_rate
+
+    @staticmethod
+    def get_product(path):
+        """Идентификатор, цена и изображение товара, одинаковые для одного пути"""
+        checksum = zlib.crc32(path.encode())
+        price = 500 + checksum % 20000
+        return dict(product_id=checksum % 10 ** 8, title=f'Кроссовки {checksum % 1000}',
+                    price=price, old_price=price * 2, photo_url=f'/img/{checksum % 1000}.jpg')
+
+    def get_page(self, path):
+        return get_template(self.page_name).substitute(self.get_product(path))
+
+    def url_for(self, url):
+        """Адрес страницы url на этом сервере"""
+        parsed = urlparse(url)
+        return parsed._replace(scheme='http', netloc=urlparse(self.base_url).netloc).geturl()
+
+    def make_site_class(self):
+        attrs = dict(main_url=f'{self.base_url}/', aliases=(),
+                     page_parser_type=PageParserEnum.Requests, lean_browser=False)
+        return types.new_class(f'Mock{self.site_class.__name__}', (self.site_class,),
+                               {'register': False}, lambda ns: ns.update(attrs))
+
+    def start(self):
+        self.server = QuietServer(('127.0.0.1', 0), MockShopHandler)
+        self.server.shop = self
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = f'http://127.0.0.1:{self.server.server_port}'
+        self.mock_class = self.make_site_class()
+        SiteParsing.register(self.mock_class)
+        return self
+
+    def stop(self):
+        netloc = SiteParsing.normalize_netloc(urlparse(self.base_url).netloc)
+        SiteParsing.registry.pop(netloc, None)
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
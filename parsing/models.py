@@ -1,35 +1,144 @@
+import json
+import os
 import pytz
+import threading
+import time
+import types
+from datetime import timedelta
+from urllib.parse import urlparse
 
 from django.utils import timezone
 from django.contrib.auth.models import User
-from django.db import models, transaction
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, models, transaction
+from django.db.models import Count, Exists, F, Max, OuterRef, Subquery
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from config.settings import PRICE_JOBS, PRICE_REFRESH, SHOP_CONFIG_TTL
+from .constants import JobStatusEnum, IdentifierEnum, PageParserEnum, PricePeriodEnum, TypeAndId, Validators
+
+
+class SiteQuerySet(models.QuerySet):
+    def with_job_state(self):
+        """Добавляет признак is_running - есть ли у сайта незавершенная задача"""
+        active_jobs = PriceJob.objects.filter(
+            site=OuterRef('pk'), status__in=JobStatusEnum.active)
+        return self.annotate(is_running=Exists(active_jobs))
+
+    def with_last_price(self):
+        """Добавляет последнюю цену (last_price_value), дату ее получения
+        (last_price_date) и последней проверки (last_price_checked)
+        подзапросами, без отдельных запросов на каждый сайт"""
+        last_prices = Price.objects.filter(
+            site=OuterRef('pk')).order_by('-date')
+        return self.annotate(
+            last_price_value=Subquery(last_prices.values('price')[:1]),
+            last_price_date=Subquery(last_prices.values('date')[:1]),
+            last_price_checked=Subquery(last_prices.values('valid_until')[:1]))
 
 
 class Site(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sites')
     url = models.URLField()
     photo_path = models.CharField(max_length=200, null=True, blank=True)
-    is_running = models.BooleanField(default=False)
+    # Ссылка на изображение на странице, по которой загружено фото photo_path
+    photo_url = models.URLField(max_length=500, blank=True)
+    # Созданы ли уменьшенные копии фото photo_path (см. Thumbnails)
+    has_thumbnails = models.BooleanField(default=False)
+    domain = models.CharField(max_length=255, blank=True)
+    # Валидаторы последней загруженной страницы для условных запросов
+    etag = models.CharField(max_length=255, blank=True)
+    last_modified = models.CharField(max_length=100, blank=True)
+    content_hash = models.CharField(max_length=64, blank=True)
+
+    objects = SiteQuerySet.as_manager()
+
+    # Поля, обновляемые при сохранении результатов парсинга
+    result_fields = ['photo_path', 'photo_url', 'has_thumbnails',
+                     'etag', 'last_modified', 'content_hash']
+
+    class Meta:
+        # Индексы для keyset-пагинации списка с фильтрами по пользователю и домену
+        indexes = [
+            models.Index(fields=['user', 'id'], name='site_user_id_idx'),
+            models.Index(fields=['domain', 'id'], name='site_domain_id_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.domain = urlparse(self.url).netloc.lower()
+        super().save(*args, **kwargs)
+
+    @property
+    def validators(self):
+        return Validators(self.etag, self.last_modified, self.content_hash)
+
+    @validators.setter
+    def validators(self, validators):
+        self.etag, self.last_modified, self.content_hash = validators
 
     def get_prices(self):
         return Price.objects.filter(site=self).order_by('-date')
 
+    def get_price_history(self, date_from, date_to):
+        """Цены, действовавшие в период, от новых к старым: записи Price
+        хранятся до изменения цены, поэтому выбираются те, что пересекаются
+        с периодом. Старая история сжата в сводки PriceAggregate (compact_prices),
+        поэтому для сжатой части периода к ценам добавляются сводки
+        :return: Список записей Price и PriceAggregate
+        """
+        prices = list(self.get_prices().filter(date__lte=date_to, valid_until__gte=date_from))
+        # Сводки старше всех оставшихся записей Price
+        if prices and prices[-1].date <= date_from:
+            return prices
+        aggregates = self.price_aggregates.filter(
+            start__lte=date_to, valid_until__gte=date_from).order_by('-start')
+        return prices + list(aggregates)
+
     @property
     def last_price(self):
-        prices = self.get_prices()
-        return prices.first() if prices.exists() else None
+        return self.get_prices().first()
+
+    def has_photo(self, photo_url):
+        """Загружено ли уже фото по ссылке photo_url"""
+        return bool(photo_url and photo_url == self.photo_url
+                    and self.photo_path and os.path.exists(self.photo_path))
 
-    @transaction.atomic
     def add_price_and_photo(self, price, photoname):
-        if price and photoname:
-            Price.add(site=self, price=price)
-            self.photo_path = photoname
-            self.save()
-            return True
-        else:
-            print(f'Цена - {price}  и фото - {photoname} '
-                  f'не были добавлены для сайта (id={self.id})')
-            return False
+        return self.apply_results([(self, price, photoname)]) == 1
+
+    @classmethod
+    def apply_results(cls, results, batch_size=PRICE_REFRESH['batch_size'],
+                      require_photo=True):
+        """Сохраняет результаты парсинга: цены добавляются через bulk_create,
+        пути к фото обновляются через bulk_update, каждые batch_size
+        записей сохраняются в отдельной транзакции
+        :param results: Тройки (сайт, цена, путь к фото)
+        :param require_photo: Не сохранять цену без фото
+        :return: Количество сохраненных цен
+        """
+        saved = 0
+        batch = []
+        for site, price, photoname in results:
+            if price and (photoname or not require_photo):
+                site.photo_path = photoname
+                batch.append((site, price))
+            else:
+                print(f'Цена - {price}  и фото - {photoname} '
+                      f'не были добавлены для сайта (id={site.id})')
+            if len(batch) >= batch_size:
+                saved += cls._save_batch(batch)
+                batch = []
+        if batch:
+            saved += cls._save_batch(batch)
+        return saved
+
+    @classmethod
+    def _save_batch(cls, batch):
+        with transaction.atomic():
+            Price.bulk_add(batch)
+            cls.objects.bulk_update([site for site, _ in batch], cls.result_fields)
+        return len(batch)
 
     @classmethod
     def add_ref_link(cls, link):
@@ -51,18 +160,470 @@ class Site(models.Model):
             return None
 
     def run_task_for_price(self):
-        pass
+        return PriceJob.enqueue(self.id)
 
 
 class Price(models.Model):
+    """Цена сайта, действовавшая с date до valid_until (последней проверки).
+    Новая запись добавляется только при изменении цены"""
+
     site = models.ForeignKey(Site, on_delete=models.CASCADE)
     price = models.IntegerField()
     date = models.DateTimeField()
+    valid_until = models.DateTimeField()
+
+    class Meta:
+        # Последняя цена и история цен сайта выбираются по (site, -date)
+        indexes = [
+            models.Index(fields=['site', '-date'], name='price_site_date_idx'),
+        ]
 
     @classmethod
     def add(cls, site, price):
-        cls.objects.create(site=site, price=price, date=timezone.now())
+        cls.bulk_add([(site, price)])
+
+    @classmethod
+    def get_last(cls, site_ids):
+        """Последние цены сайтов одним запросом"""
+        last_ids = cls.objects.filter(site=OuterRef('site')).order_by('-date').values('id')[:1]
+        return cls.objects.filter(site_id__in=site_ids, id=Subquery(last_ids))
+
+    @classmethod
+    def bulk_add(cls, items):
+        """Сохраняет цены: если цена сайта не изменилась, у последней
+        записи продлевается valid_until, иначе добавляется новая запись.
+        Последние цены выбираются, продлеваются и добавляются
+        одним запросом каждое
+        :param items: Пары (сайт, цена)
+        :return: Добавленные записи
+        """
+        now = timezone.now()
+        items = [(site, int(price)) for site, price in items]
+        last_prices = {price.site_id: price for price in
+                       cls.get_last({site.id for site, _ in items}).only('site_id', 'price')}
+        unchanged = []
+        created = []
+        for site, price in items:
+            last = last_prices.get(site.id)
+            if last is not None and last.price == price:
+                unchanged.append(last.id)
+            else:
+                created.append(cls(site=site, price=price, date=now, valid_until=now))
+        if unchanged:
+            cls.objects.filter(id__in=unchanged).update(valid_until=now)
+        return cls.objects.bulk_create(created) if created else []
+
+
+class PriceAggregate(models.Model):
+    """Сводка истории цен сайта за день или неделю: минимальная,
+    максимальная и последняя из цен, установленных в этот период.
+    Сводки создаются из старых записей Price (compact_prices). Периоды,
+    в которые цена не менялась, не хранятся: в них действует last_price
+    предыдущего периода"""
+
+    site = models.ForeignKey(Site, on_delete=models.CASCADE, related_name='price_aggregates')
+    period = models.IntegerField(choices=PricePeriodEnum.get_choices())
+    start = models.DateTimeField()
+    min_price = models.IntegerField()
+    max_price = models.IntegerField()
+    last_price = models.IntegerField()
+    # Когда последняя цена была установлена и когда проверена в последний раз
+    last_date = models.DateTimeField()
+    valid_until = models.DateTimeField()
+
+    summary_fields = ['min_price', 'max_price', 'last_price', 'last_date', 'valid_until']
+
+    # Для истории цен (Site.get_price_history) сводка выглядит как запись Price
+    @property
+    def price(self):
+        return self.last_price
+
+    @property
+    def date(self):
+        return self.start
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['site', 'period', 'start'],
+                                    name='price_aggregate_site_period_start'),
+        ]
+
+    @staticmethod
+    def get_start(date, period):
+        """Начало дня или недели (с понедельника), на которые приходится date"""
+        start = timezone.localtime(date).replace(hour=0, minute=0, second=0, microsecond=0)
+        if period == PricePeriodEnum.Week:
+            start -= timedelta(days=start.weekday())
+        return start
+
+    @classmethod
+    def from_price(cls, price):
+        day = PricePeriodEnum.Day
+        return cls(site_id=price.site_id, period=day, start=cls.get_start(price.date, day),
+                   min_price=price.price, max_price=price.price, last_price=price.price,
+                   last_date=price.date, valid_until=price.valid_until)
+
+    def to_period(self, period):
+        """Сводка за более длинный период, в который входит эта"""
+        return PriceAggregate(site_id=self.site_id, period=period,
+                              start=self.get_start(self.start, period),
+                              **{field: getattr(self, field) for field in self.summary_fields})
+
+    def merge(self, other):
+        """Добавляет к сводке цены другой сводки того же периода"""
+        self.min_price = min(self.min_price, other.min_price)
+        self.max_price = max(self.max_price, other.max_price)
+        if other.last_date >= self.last_date:
+            self.last_price = other.last_price
+            self.last_date = other.last_date
+        self.valid_until = max(self.valid_until, other.valid_until)
+
+    @classmethod
+    def rollup(cls, period, summaries):
+        """Объединяет сводки по сайту и началу периода и сохраняет их,
+        добавляя к уже сохраненным сводкам тех же периодов"""
+        grouped = {}
+        for summary in summaries:
+            key = (summary.site_id, summary.start)
+            if key in grouped:
+                grouped[key].merge(summary)
+            else:
+                grouped[key] = summary
+        if not grouped:
+            return
+        starts = [start for _, start in grouped]
+        existing = cls.objects.filter(period=period, site_id__in={site_id for site_id, _ in grouped},
+                                      start__range=(min(starts), max(starts)))
+        updated = []
+        for aggregate in existing:
+            summary = grouped.pop((aggregate.site_id, aggregate.start), None)
+            if summary is not None:
+                aggregate.merge(summary)
+                updated.append(aggregate)
+        cls.objects.bulk_update(updated, cls.summary_fields)
+        cls.objects.bulk_create(grouped.values())
+
+    @staticmethod
+    def delete_ids(model, ids, batch_size=500):
+        for i in range(0, len(ids), batch_size):
+            model.objects.filter(id__in=ids[i:i + batch_size]).delete()
+
+    @classmethod
+    def compact(cls, raw_before, daily_before, sites_per_batch=100):
+        """Сжимает историю цен: записи Price, действовавшие до raw_before,
+        заменяются сводками по дням, сводки по дням, закончившимся до
+        daily_before, - сводками по неделям. Последняя цена сайта остается
+        в Price. Каждые sites_per_batch сайтов обрабатываются в отдельной транзакции
+        :return: Количество удаленных записей Price и сводок по дням
+        """
+        prices_removed = days_removed = 0
+        site_ids = list(Site.objects.order_by('id').values_list('id', flat=True))
+        for i in range(0, len(site_ids), sites_per_batch):
+            batch = site_ids[i:i + sites_per_batch]
+            with transaction.atomic():
+                prices = list(Price.objects.filter(
+                    site_id__in=batch, valid_until__lt=raw_before).exclude(
+                    id__in=Price.get_last(batch).values('id')))
+                cls.rollup(PricePeriodEnum.Day, map(cls.from_price, prices))
+                cls.delete_ids(Price, [price.id for price in prices])
+                days = list(cls.objects.filter(
+                    site_id__in=batch, period=PricePeriodEnum.Day,
+                    start__lte=daily_before - timedelta(days=1)))
+                cls.rollup(PricePeriodEnum.Week,
+                           (day.to_period(PricePeriodEnum.Week) for day in days))
+                cls.delete_ids(cls, [day.id for day in days])
+            prices_removed += len(prices)
+            days_removed += len(days)
+        return prices_removed, days_removed
+
+
+class PhotoCache(models.Model):
+    """Загруженное изображение и валидаторы ответа для условных запросов"""
+
+    url = models.URLField(max_length=500, unique=True)
+    path = models.CharField(max_length=200)
+    etag = models.CharField(max_length=255, blank=True)
+    last_modified = models.CharField(max_length=100, blank=True)
+    content_hash = models.CharField(max_length=64, blank=True)
+
+    @property
+    def validators(self):
+        return Validators(self.etag, self.last_modified, self.content_hash)
+
+    @classmethod
+    def store(cls, url, path, validators):
+        """Сохраняет запись отдельными запросами без общей транзакции:
+        в SQLite update_or_create из нескольких потоков приводит
+        к ошибке "database is locked" при повышении блокировки"""
+        fields = dict(path=path, **validators._asdict())
+        if cls.objects.filter(url=url).update(**fields):
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(url=url, **fields)
+        except IntegrityError:
+            cls.objects.filter(url=url).update(**fields)
+
+
+class PriceJob(models.Model):
+    """Задача обновления цены сайта в очереди, хранящейся в БД"""
+
+    site = models.ForeignKey(Site, on_delete=models.CASCADE, related_name='jobs')
+    status = models.IntegerField(choices=JobStatusEnum.get_choices(),
+                                 default=JobStatusEnum.Pending)
+    attempts = models.IntegerField(default=0)
+    max_attempts = models.IntegerField(default=PRICE_JOBS['max_attempts'])
+    run_after = models.DateTimeField(default=timezone.now)
+    locked_by = models.CharField(max_length=100, blank=True)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'run_after'])]
+
+    @classmethod
+    def enqueue(cls, site_id):
+        """Ставит задачу в очередь. Если у сайта уже есть незавершенная
+        задача, новая не создается
+        :return: Задача или None, если сайт не существует
+        """
+        with transaction.atomic():
+            site = Site.objects.select_for_update().filter(id=site_id).first()
+            if site is None:
+                return None
+            job = cls.objects.filter(
+                site=site, status__in=JobStatusEnum.active).first()
+            return job or cls.objects.create(site=site)
+
+    @classmethod
+    def dequeue(cls, worker):
+        """Забирает из очереди первую готовую к выполнению задачу.
+        Строка блокируется (select_for_update там, где это поддерживается),
+        а смена статуса выполняется условным UPDATE, поэтому одну задачу
+        не получат два обработчика
+        :param worker: Имя обработчика
+        :return: Задача или None, если очередь пуста
+        """
+        now = timezone.now()
+        with transaction.atomic():
+            job = (cls.objects.select_for_update(skip_locked=True)
+                   .filter(status=JobStatusEnum.Pending, run_after__lte=now)
+                   .order_by('run_after', 'id').first())
+            if job is None:
+                return None
+            locked = cls.objects.filter(
+                id=job.id, status=JobStatusEnum.Pending).update(
+                status=JobStatusEnum.Running, locked_by=worker,
+                locked_at=now, attempts=F('attempts') + 1)
+        if not locked:
+            return None
+        job.refresh_from_db()
+        return job
+
+    @classmethod
+    def requeue_stale(cls, timeout=PRICE_JOBS['stale_timeout']):
+        """Возвращает в очередь задачи, обработчик которых перестал отвечать.
+        Как и в fail, задачи с исчерпанными попытками завершаются с ошибкой,
+        чтобы страница, на которой обработчик зависает, не обрабатывалась бесконечно
+        :return: Количество возвращенных в очередь задач
+        """
+        now = timezone.now()
+        stale = cls.objects.filter(status=JobStatusEnum.Running,
+                                   locked_at__lt=now - timedelta(seconds=timeout))
+        stale.filter(attempts__gte=F('max_attempts')).update(
+            status=JobStatusEnum.Failed, finished_at=now, locked_by='', locked_at=None,
+            error='Обработчик перестал отвечать, попытки исчерпаны')
+        return stale.filter(attempts__lt=F('max_attempts')).update(
+            status=JobStatusEnum.Pending, locked_by='', locked_at=None)
+
+    @classmethod
+    def claim(cls, sites, worker):
+        """Занимает сайты без незавершенных задач для обработки вне очереди
+        (массовое обновление цен): для каждого создается выполняемая задача,
+        поэтому обработчики очереди и другие обновления эти сайты не возьмут.
+        Задачи завершаются через release
+        :param sites: QuerySet сайтов
+        :param worker: Имя обработчика
+        :return: Количество занятых сайтов
+        """
+        now = timezone.now()
+        with transaction.atomic():
+            site_ids = list(sites.select_for_update().exclude(
+                jobs__status__in=JobStatusEnum.active).values_list('id', flat=True))
+            cls.objects.bulk_create(
+                [cls(site_id=site_id, status=JobStatusEnum.Running, attempts=1,
+                     locked_by=worker, locked_at=now) for site_id in site_ids],
+                batch_size=500)
+        return len(site_ids)
+
+    @classmethod
+    def release(cls, worker, site_ids=None, error=None):
+        """Завершает задачи, созданные claim
+        :param site_ids: id сайтов, None - все задачи обработчика
+        :param error: Ошибка, с которой завершается обработка сайтов
+        """
+        jobs = cls.objects.filter(status=JobStatusEnum.Running, locked_by=worker)
+        fields = dict(status=JobStatusEnum.Failed if error else JobStatusEnum.Done,
+                      finished_at=timezone.now(), locked_at=None,
+                      error=str(error) if error else '')
+        if site_ids is None:
+            return jobs.update(**fields)
+        site_ids = list(site_ids)
+        return sum(jobs.filter(site_id__in=site_ids[i:i + 500]).update(**fields)
+                   for i in range(0, len(site_ids), 500))
+
+    def complete(self):
+        self._finish(JobStatusEnum.Done)
+
+    def fail(self, error, retry=True):
+        """Отмечает попытку как неудачную. Пока попытки не исчерпаны,
+        задача возвращается в очередь с увеличивающейся задержкой"""
+        self.error = str(error)
+        if retry and self.attempts < self.max_attempts:
+            delay = PRICE_JOBS['retry_delay'] * self.attempts
+            self.status = JobStatusEnum.Pending
+            self.run_after = timezone.now() + timedelta(seconds=delay)
+            self.locked_by = ''
+            self.locked_at = None
+            self.save()
+        else:
+            self._finish(JobStatusEnum.Failed)
+
+    def _finish(self, status):
+        self.status = status
+        self.finished_at = timezone.now()
+        self.locked_at = None
+        self.save()
+
+    def __str__(self):
+        return f'Задача {self.id} (сайт {self.site_id}, статус {self.status})'
+
+
+class ShopConfig(models.Model):
+    """Описание сайта в БД. Позволяет добавлять сайты без изменения кода.
+    Записи компилируются в подклассы ConfiguredSite один раз и хранятся
+    в кеше процесса до изменения таблицы"""
+
+    name = models.CharField(max_length=100)
+    main_url = models.URLField()
+    # Дополнительные домены через запятую
+    aliases = models.CharField(max_length=500, blank=True)
+    page_parser_type = models.IntegerField(choices=PageParserEnum.get_choices(),
+                                           default=PageParserEnum.Requests)
+    # Списки идентификаторов в JSON: [["class_", "final-cost"], ["xpath", "//span"]],
+    # третьим элементом можно указать время ожидания элемента (сек.)
+    price_src = models.TextField()
+    photo_src = models.TextField()
+    price_index = models.IntegerField(default=0)
+    photo_index = models.IntegerField(default=0)
+    photo_attribute = models.CharField(max_length=50, default='src')
+    lean_browser = models.BooleanField(default=False)
+    is_active = models.BooleanField(default=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    _registry = None
+    _version = None
+    _checked_at = 0
+    _lock = threading.Lock()
+
+    def __str__(self):
+        return self.name
+
+    @staticmethod
+    def parse_selectors(value):
+        """Преобразует JSON со списком идентификаторов в список TypeAndId
+        :raise: ValueError
+        """
+        selectors = []
+        for type_name, identifier, *timeout in json.loads(value):
+            if type_name not in IdentifierEnum.values:
+                raise ValueError(f'Неизвестный тип идентификатора: {type_name}')
+            if len(timeout) > 1:
+                raise ValueError('Лишние элементы в идентификаторе')
+            timeout = float(timeout[0]) if timeout else None
+            selectors.append(TypeAndId(IdentifierEnum.values[type_name], identifier, timeout))
+        if not selectors:
+            raise ValueError('Не задан ни один идентификатор')
+        return selectors
+
+    def clean(self):
+        from lxml import etree
+
+        for field in ('price_src', 'photo_src'):
+            try:
+                selectors = self.parse_selectors(getattr(self, field))
+            except (ValueError, TypeError) as e:
+                raise ValidationError({field: f'Некорректный список идентификаторов: {e}'})
+            for selector in selectors:
+                if selector.type == IdentifierEnum.xpath:
+                    try:
+                        etree.XPath(selector.id)
+                    except etree.XPathSyntaxError as e:
+                        raise ValidationError({field: f'Некорректный XPath: {e}'})
+
+    def compile(self):
+        """Создает класс сайта по описанию. XPath-выражения компилируются сразу"""
+        from .parsers import compile_xpath
+        from .sites import ConfiguredSite
+
+        attrs = dict(
+            config_id=self.id,
+            main_url=self.main_url,
+            aliases=tuple(a.strip() for a in self.aliases.split(',') if a.strip()),
+            page_parser_type=self.page_parser_type,
+            price_src=self.parse_selectors(self.price_src),
+            photo_src=self.parse_selectors(self.photo_src),
+            price_index=self.price_index,
+            photo_index=self.photo_index,
+            photo_attribute=self.photo_attribute,
+            lean_browser=self.lean_browser,
+        )
+        if self.page_parser_type == PageParserEnum.Requests:
+            for selector in attrs['price_src'] + attrs['photo_src']:
+                if selector.type == IdentifierEnum.xpath:
+                    compile_xpath(selector.id)
+        return types.new_class(f'ConfiguredSite{self.id}', (ConfiguredSite,),
+                               {'register': False}, lambda ns: ns.update(attrs))
+
+    @classmethod
+    def get_version(cls):
+        return tuple(cls.objects.aggregate(Count('id'), Max('updated_at')).values())
+
+    @classmethod
+    def build_registry(cls):
+        from .sites import SiteParsing
+
+        registry = {}
+        for config in cls.objects.filter(is_active=True).order_by('id'):
+            try:
+                SiteParsing.register(config.compile(), registry)
+            except (ValueError, TypeError) as e:
+                print(f'Описание сайта {config} содержит ошибку: {e}')
+        return registry
+
+    @classmethod
+    def get_registry(cls):
+        """Домен -> класс сайта для всех активных описаний. Изменения в этом
+        процессе сбрасывают кеш сразу, изменения из других процессов
+        обнаруживаются не позже чем через SHOP_CONFIG_TTL секунд"""
+        with cls._lock:
+            now = time.monotonic()
+            if cls._registry is None or now - cls._checked_at > SHOP_CONFIG_TTL:
+                version = cls.get_version()
+                if cls._registry is None or version != cls._version:
+                    cls._registry = cls.build_registry()
+                    cls._version = version
+                cls._checked_at = now
+            return cls._registry
+
+    @classmethod
+    def invalidate(cls):
+        with cls._lock:
+            cls._registry = None
 
 
-# class RunningTask(models.Model):
-#     site = models.OneToOneField(Site)
+@receiver([post_save, post_delete], sender=ShopConfig)
+def invalidate_shop_configs(**kwargs):
+    ShopConfig.invalidate()
@@ -1,44 +1,50 @@
 import os
 import requests
-import random
-from time import sleep
+import threading
+import time
+from functools import lru_cache, partial, wraps
 
 from abc import ABCMeta, abstractmethod
-from bs4 import BeautifulSoup
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options as ChromeOptions
-from selenium.webdriver.firefox.options import Options as FirefoxOptions
-from urllib.parse import urlparse
-
-from config.settings import ADDITIONAL_FILES_DIR
-from parsing.exceptions import UnsupportedFileFormat, FileNotDownloaded
+import lxml.html
+from lxml import etree
+from urllib.parse import urljoin, urlparse
+
+from config.settings import ADDITIONAL_FILES_DIR, WEBDRIVER_POOL, PHOTO_DOWNLOAD, SELENIUM_WAIT
+from parsing.exceptions import UnsupportedFileFormat, FileNotDownloaded, ElementNotFound, PageNotOpened
+from .http import conditional_headers, get_content_hash, get_validators, is_not_modified, get_http_client
+from .images import ImageStore, thumbnails
+from .metrics import stage, trace_page
+from .models import PhotoCache
 from .sites import SiteParsing
+from .webdriver_pool import WebDriverPool
+from .retry import RETRYABLE_STATUSES, get_retrier, is_driver_crash
+from .throttle import get_scheduler
 from .constants import IdentifierEnum, PageParserEnum, GOODS_IMAGE_PATH, DEFAULT_IMG_PATH
 
 
 def open_parser(function):
-    """Декоратор для открытия парсера с возможностью повторной попытки"""
+    """Декоратор для открытия страницы с повторными попытками (см. Retrier).
+    Если страница так и не открылась, вызывающему передается PageNotOpened"""
+    @wraps(function)
     def fun(self):
-        for i in range(2):
-            try:
-                function(self)
-                break
-            except:
-                print('Произошла ошибка при открытии сайта!')
-            sleep(1)
+        return get_retrier().call(self.url, lambda: function(self),
+                                  on_error=self.on_open_error)
     return fun
 
 
 class PageParser(metaclass=ABCMeta):
     url = None
+    # Валидаторы страницы для условного запроса и признак того,
+    # что страница не изменилась с прошлой загрузки
+    validators = None
+    not_modified = False
 
     @staticmethod
-    def get_parser(parser_type, url):
-        parser_class = {
-            PageParserEnum.Selenium: SeleniumPageParser,
-            PageParserEnum.Requests: RequestsPageParser
-        }[parser_type]
-        return parser_class(url)
+    def get_parser(parser_type, url, validators=None, lean_browser=False):
+        """:param lean_browser: Открывать страницу в облегченном профиле браузера"""
+        if parser_type == PageParserEnum.Selenium:
+            return SeleniumPageParser(url, validators, lean_browser)
+        return RequestsPageParser(url, validators)
 
     def try_get_element_on_page(self, elem_src):
         """Безопасное получение элемента на странице
@@ -52,6 +58,11 @@ class PageParser(metaclass=ABCMeta):
                   f'(type={elem_src.type}, id={elem_src.id})')
             return None
 
+    def get_page_elems(self, elem_srcs):
+        """Элементы для нескольких идентификаторов (или списков идентификаторов),
+        например, цены и фото. Не требует переопределения"""
+        return [self.get_page_elem(elem_src) for elem_src in elem_srcs]
+
     def get_page_elem(self, elem_src):
         """Расширенная обработка элемента. Позволяет задавать несколько типов
         идентификаторов, будет выбран первый ненулевой результат.
@@ -70,6 +81,10 @@ class PageParser(metaclass=ABCMeta):
     def open(self):
         pass
 
+    def on_open_error(self, error):
+        """Вызывается перед повторной попыткой открытия страницы"""
+        pass
+
     @abstractmethod
     def get_element_on_page(self, elem_src):
         pass
@@ -78,43 +93,163 @@ class PageParser(metaclass=ABCMeta):
         pass
 
 
+class RequestsElement:
+    """Элемент страницы, разобранной lxml. Повторяет ту часть интерфейса
+    WebElement Selenium, которая используется при обработке элементов"""
+
+    # Атрибуты, значения которых Selenium возвращает в виде абсолютных ссылок
+    url_attributes = ('href', 'src')
+
+    def __init__(self, element, base_url=None):
+        self.element = element
+        self.base_url = base_url
+
+    @property
+    def text(self):
+        return ' '.join(self.element.text_content().split())
+
+    def get_attribute(self, name):
+        value = self.element.get(name)
+        if value is not None and self.base_url and name in self.url_attributes:
+            value = urljoin(self.base_url, value)
+        return value
+
+
+@lru_cache(maxsize=None)
+def compile_xpath(expression):
+    """Компилирует XPath-выражение один раз на процесс"""
+    return etree.XPath(expression)
+
+
 class RequestsPageParser(PageParser):
+    # Выражения для поиска по идентификатору, значение передается в $value
+    selectors = {
+        IdentifierEnum.id: '//*[@id=$value]',
+        IdentifierEnum.class_: "//*[contains(concat(' ', normalize-space(@class), ' '), concat(' ', $value, ' '))]",
+        IdentifierEnum.tag: '//*[local-name()=$value]',
+    }
+
     url = None
+    tree = None
 
-    def __init__(self, url):
+    def __init__(self, url, validators=None):
         self.url = url
+        self.validators = validators
 
     @staticmethod
     def return_bs(url):
-        response = requests.get(url)
+        from bs4 import BeautifulSoup
+
+        response = get_http_client().get(url)
         return BeautifulSoup(response.text, "html.parser")
 
     @open_parser
     def open(self):
         print(f'Открытие сайта {self.url}')
-        self.response = requests.get(self.url)
-        self.bs = BeautifulSoup(self.response.text, "html.parser")
+        self.response = get_http_client().get(
+            self.url, headers=conditional_headers(self.validators))
+        self.response.raise_for_status()
+        content_hash = get_content_hash(self.response.content)
+        if is_not_modified(self.response, self.validators, content_hash):
+            print('Страница не изменилась с прошлой загрузки')
+            self.not_modified = True
+            return
+        self.validators = get_validators(self.response, content_hash)
+        self.load_html(self.response.content)
+
+    def load_html(self, content):
+        """Разбирает HTML страницы. Кодировка определяется lxml по meta-тегам"""
+        self.tree = lxml.html.fromstring(content)
+
+    def find_elements(self, elem_src):
+        if elem_src.type == IdentifierEnum.xpath:
+            nodes = compile_xpath(elem_src.id)(self.tree)
+        else:
+            value = elem_src.id
+            if elem_src.type == IdentifierEnum.tag:
+                value = value.lower()
+            nodes = compile_xpath(self.selectors[elem_src.type])(
+                self.tree, value=value)
+        return [RequestsElement(node, self.url) for node in nodes
+                if isinstance(node, etree.ElementBase)]
 
     def get_element_on_page(self, elem_src):
-        # TODO: доработать функционал
-        raise NotImplementedError()
+        """ Получение элемента на странице согласно идентификатору.
+        Как и в SeleniumPageParser, для класса возвращается список элементов,
+        для остальных типов - первый найденный элемент
+        :param elem_src: Тип идентификатора и сам идентификатор
+        :type elem_src: TypeAndId
+        :raise: ElementNotFound
+        """
+        elements = self.find_elements(elem_src)
+        if elem_src.type == IdentifierEnum.class_:
+            return elements
+        if not elements:
+            raise ElementNotFound(
+                f'Элемент не найден (type={elem_src.type}, id={elem_src.id})')
+        return elements[0]
+
+
+# Поиск элементов за один проход по DOM. Аргумент - группы идентификаторов
+# (например, цены и фото); для каждой группы возвращается номер первого
+# найденного идентификатора и его элементы или null
+FIND_ELEMENTS_SCRIPT = """
+function find(type, value) {
+    if (type === 'id') {
+        var element = document.getElementById(value);
+        return element ? [element] : [];
+    } else if (type === 'class_') {
+        return Array.prototype.slice.call(document.getElementsByClassName(value));
+    } else if (type === 'tag') {
+        return Array.prototype.slice.call(document.getElementsByTagName(value));
+    } else if (type === 'xpath') {
+        var node = document.evaluate(value, document, null,
+            XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue;
+        return node && node.nodeType === 1 ? [node] : [];
+    }
+    return [];
+}
+var groups = arguments[0], result = [];
+for (var g = 0; g < groups.length; g++) {
+    var match = null;
+    for (var i = 0; i < groups[g].length && !match; i++) {
+        var found = find(groups[g][i][0], groups[g][i][1]);
+        if (found.length) {
+            match = [i, found];
+        }
+    }
+    result.push(match);
+}
+return result;
+"""
+
+# Код ответа на загрузку страницы (Navigation Timing). Браузеры, которые
+# его не сообщают, возвращают 0 или undefined
+RESPONSE_STATUS_SCRIPT = """
+var entry = performance.getEntriesByType('navigation')[0];
+return entry ? entry.responseStatus : null;
+"""
 
 
 class SeleniumPageParser(PageParser):
+    """Парсер страниц в браузере. Selenium загружается при первом запуске
+    браузера, а не при импорте модуля"""
+
     class SeleniumProgram:
         Chrome = 0
         Firefox = 1
 
+        # Классы WebDriver и параметров браузера - имена в selenium.webdriver
         settings = {
             Chrome: dict(
-                webdriver_class=webdriver.Chrome,
-                option_class=ChromeOptions,
+                webdriver_class='Chrome',
+                option_class='ChromeOptions',
                 path=r'{}'.format(os.path.join(ADDITIONAL_FILES_DIR,
                                                'chromedriver.exe'))
             ),
             Firefox: dict(
-                webdriver_class=webdriver.Firefox,
-                option_class=FirefoxOptions,
+                webdriver_class='Firefox',
+                option_class='FirefoxOptions',
                 path=r'{}'.format(os.path.join(ADDITIONAL_FILES_DIR,
                                                'geckodriver.exe'))
             )
@@ -125,33 +260,189 @@ class SeleniumPageParser(PageParser):
     program = SeleniumProgram.Firefox
 
     @classmethod
-    def get_webdriver(cls):
+    def get_webdriver(cls, lean=False):
+        """Запускает браузер. lean - облегченный профиль (см. apply_lean_profile)"""
+        from selenium import webdriver
+        from .browser import apply_lean_profile
+
         setting = cls.SeleniumProgram.settings[cls.program]
-        if cls.invisible:
-            driver_options = setting['option_class']()
-            driver_options.add_argument("--headless")
-            driver_options.add_argument("--window-size=1366x768")
-            driver = setting['webdriver_class'](
+        webdriver_class = getattr(webdriver, setting['webdriver_class'])
+        if cls.invisible or lean:
+            driver_options = getattr(webdriver, setting['option_class'])()
+            if cls.invisible:
+                driver_options.add_argument("--headless")
+                driver_options.add_argument("--window-size=1366x768")
+            if lean:
+                apply_lean_profile(driver_options)
+            driver = webdriver_class(
                 executable_path=setting['path'], options=driver_options)
         else:
-            driver = setting['webdriver_class'](executable_path=setting['path'])
+            driver = webdriver_class(executable_path=setting['path'])
         return driver
 
-    def __init__(self, url):
+    # Пулы сессий по профилю браузера: обычный и облегченный
+    _pools = {}
+    _pool_lock = threading.Lock()
+
+    @classmethod
+    def get_pool(cls, lean=False):
+        """Общий для процесса пул сессий WebDriver с профилем lean,
+        создается при первом обращении"""
+        with cls._pool_lock:
+            pool = SeleniumPageParser._pools.get(lean)
+            if pool is None:
+                pool = WebDriverPool(partial(cls.get_webdriver, lean), **WEBDRIVER_POOL)
+                SeleniumPageParser._pools[lean] = pool
+            return pool
+
+    @classmethod
+    def evict_idle_pools(cls):
+        """Закрывает простаивающие сессии во всех пулах
+        :return: Количество закрытых сессий
+        """
+        with cls._pool_lock:
+            pools = list(SeleniumPageParser._pools.values())
+        return sum(pool.evict_idle() for pool in pools)
+
+    @classmethod
+    def close_pools(cls):
+        """Закрывает все пулы сессий WebDriver. Вызывается при завершении
+        процесса, чтобы не оставлять запущенные браузеры"""
+        with cls._pool_lock:
+            pools = list(SeleniumPageParser._pools.values())
+            SeleniumPageParser._pools.clear()
+        for pool in pools:
+            pool.close()
+
+    def __init__(self, url, validators=None, lean_browser=False):
         self.url = url
-        self.driver = self.get_webdriver()
+        self.lean_browser = lean_browser
+        self.driver = None
+        self.pooled_driver = None
+
+    def acquire_driver(self):
+        """Берет сессию WebDriver из пула, если она еще не была получена"""
+        if self.pooled_driver is None:
+            with stage('acquire'):
+                self.pooled_driver = self.get_pool(self.lean_browser).acquire()
+            self.driver = self.pooled_driver.driver
 
-    @open_parser
     def open(self):
-        print(f'Открытие сайта {self.url}')
-        self.driver.get(self.url)
+        """Разрешение планировщика на запрос получается до того, как
+        сессия взята из пула, чтобы ожидание не занимало браузер. Сессия
+        берется до повторных попыток открытия страницы, поэтому ожидание
+        свободной сессии не повторяется"""
+        get_scheduler().acquire(self.url)
+        self.acquire_driver()
+        self.load_attempts = 0
+        self.load()
 
-    def close(self):
+    @open_parser
+    def load(self):
+        """Ответ сайта (код ответа или таймаут) сообщается планировщику
+        для адаптивного изменения частоты запросов"""
+        from selenium.common.exceptions import TimeoutException
+
+        scheduler = get_scheduler()
+        # Разрешение на первую попытку получено в open
+        if self.load_attempts:
+            scheduler.acquire(self.url)
+        self.load_attempts += 1
+        print(f'Открытие сайта {self.url}')
+        try:
+            self.driver.get(self.url)
+        except TimeoutException:
+            scheduler.report_timeout(self.url)
+            raise
+        # Браузер открывает и страницы с ошибкой, код ответа проверяется
+        # отдельно; если браузер его не сообщает, загрузка считается успешной
+        status = self.driver.execute_script(RESPONSE_STATUS_SCRIPT)
+        scheduler.report(self.url, status or 200)
+        if status and status >= 400:
+            raise PageNotOpened(f'Сайт ответил кодом {status}',
+                                retryable=status >= 500 or status in RETRYABLE_STATUSES)
+
+    def on_open_error(self, error):
+        """Сломанная сессия закрывается, повторная попытка получит новую.
+        Если свободной сессии нет, WebDriverPoolTimeout передается вызывающему"""
+        if is_driver_crash(error):
+            self.close(broken=True)
+            self.acquire_driver()
+
+    def close(self, broken=False):
+        """Возвращает сессию WebDriver в пул"""
+        if self.pooled_driver is None:
+            return
         print('Закрытие сайта')
-        self.driver.close()
+        self.get_pool(self.lean_browser).release(self.pooled_driver, broken=broken)
+        self.pooled_driver = None
+        self.driver = None
+
+    identifier_names = {value: name for name, value in IdentifierEnum.values.items()}
+
+    @staticmethod
+    def get_timeout(elem_src):
+        return SELENIUM_WAIT['timeout'] if elem_src.timeout is None else elem_src.timeout
+
+    def get_page_elem(self, elem_src):
+        return self.get_page_elems([elem_src])[0]
+
+    def get_page_elems(self, elem_srcs):
+        """Поиск элементов с явным ожиданием. Все идентификаторы проверяются
+        за один проход по DOM (FIND_ELEMENTS_SCRIPT), проходы повторяются,
+        пока для каждого списка идентификаторов не будет найден хотя бы один
+        элемент. Из найденных выбирается первый по порядку идентификатор;
+        каждый идентификатор проверяется не дольше своего timeout.
+        Для класса возвращается список элементов, для остальных типов -
+        первый найденный элемент, если ничего не найдено - None"""
+        from selenium.common.exceptions import TimeoutException, WebDriverException
+        from selenium.webdriver.support.ui import WebDriverWait
+
+        groups = [src if isinstance(src, list) else [src] for src in elem_srcs]
+        matches = [None] * len(groups)
+        start = time.monotonic()
+
+        def find(driver):
+            elapsed = time.monotonic() - start
+            pending = []
+            for index, group in enumerate(groups):
+                active = [s for s in group if elapsed <= self.get_timeout(s)]
+                if matches[index] is None and active:
+                    pending.append((index, active))
+            if not pending:
+                return True
+            found = driver.execute_script(FIND_ELEMENTS_SCRIPT, [
+                [[self.identifier_names[s.type], s.id] for s in active]
+                for _, active in pending])
+            for (index, active), match in zip(pending, found):
+                if match:
+                    matches[index] = active[match[0]], match[1]
+            return all(matches[index] is not None for index, _ in pending)
+
+        timeout = max(self.get_timeout(s) for group in groups for s in group)
+        wait = WebDriverWait(self.driver, timeout,
+                             poll_frequency=SELENIUM_WAIT['poll_frequency'])
+        try:
+            wait.until(find)
+        except TimeoutException:
+            pass
+        except WebDriverException as e:
+            # Ошибка скрипта или навигация во время ожидания: оставшиеся
+            # элементы считаются не найденными, найденные ранее сохраняются
+            print(f'Ошибка при поиске элементов на странице {self.url}: {e}')
+        elements = []
+        for group, match in zip(groups, matches):
+            if match is None:
+                print('Не удалось найти элемент на странице ('
+                      + '; '.join(f'type={s.type}, id={s.id}' for s in group) + ')')
+                elements.append(None)
+                continue
+            selector, found = match
+            elements.append(found if selector.type == IdentifierEnum.class_ else found[0])
+        return elements
 
     def get_element_on_page(self, elem_src, where=None):
-        """ Получение элемента на странице согласно идентификатору
+        """ Получение элемента на странице согласно идентификатору, без ожидания
         :param elem_src: Тип идентификатора и сам идентификатор
         :type elem_src: TypeAndId
         :param where: Элемент, с которого начинается поиск
@@ -173,27 +464,69 @@ class SeleniumPageParser(PageParser):
 class Parsing:
     """Основной класс, соединяющий парсеры с сайтами"""
 
-    def __init__(self, url):
+    def __init__(self, url, validators=None):
+        """
+        :param validators: Валидаторы прошлой загрузки страницы. Если страница
+        не изменилась, parse_data возвращает (None, None), а not_modified - True
+        """
         self.site = SiteParsing.get_site(url)
-        self.parser = PageParser.get_parser(self.site.page_parser_type, url)
+        self.parser = PageParser.get_parser(
+            self.site.page_parser_type, url, validators, self.site.lean_browser)
+
+    @property
+    def not_modified(self):
+        return self.parser.not_modified
+
+    @property
+    def validators(self):
+        return self.parser.validators
+
+    @property
+    def site_name(self):
+        return type(self.site).__name__
+
+    def parse_page(self, with_photo=True):
+        """Открывает страницу, за один проход находит цену и ссылку на фото
+        и сразу освобождает парсер (сессию браузера), не дожидаясь загрузки фото
+        :param with_photo: Искать ли ссылку на фото
+        :return: Цена и ссылка на фото; (None, None), если страница не изменилась
+        """
+        site = self.site
+        photo_url = None
+        with trace_page(self.site_name, site.url) as trace:
+            try:
+                with stage('open'):
+                    self.parser.open()
+                if self.not_modified:
+                    trace.outcome = 'not_modified'
+                    return None, None
+                with stage('lookup'):
+                    sources = [site.price_src, site.photo_src] if with_photo else [site.price_src]
+                    price_elem, *photo_elem = self.parser.get_page_elems(sources)
+                    price = site.process_price_element(price_elem) if price_elem else None
+                    if photo_elem and photo_elem[0]:
+                        photo_url = site.get_photo_url(photo_elem[0])
+            finally:
+                self.parser.close()
+            if not price:
+                trace.outcome = 'no_price'
+        return price, photo_url
 
     def parse_data(self):
+        """:return: Цена и путь к загруженному фото"""
         # TODO: проверить соединение с сайтом,
         # только после этого приступать к парсингу (это также удостовериться, что ссылка правильная)
-        self.parser.open()
-        site = self.site
-        price = self.process_element(
-            site.price_src, site.process_price_element)
-        photo_name = self.process_element(
-            site.photo_src, site.process_photo_element)
-        self.parser.close()
-        return price, photo_name
-
-    def process_element(self, elem_source, processing_func):
-        element = self.parser.get_page_elem(elem_source)
-        if not element:
-            return None
-        return processing_func(element)
+        price, photo_url = self.parse_page()
+        return price, download_photo(photo_url, self.site_name)
+
+
+def download_photo(photo_url, site_name='unknown'):
+    """Загружает фото товара, возвращает путь к файлу
+    (None, если ссылки нет, или путь к изображению по умолчанию при ошибке)"""
+    if not photo_url:
+        return None
+    with stage('download', site=site_name):
+        return PhotoDownloader(photo_url).download()[1]
 
 
 class PhotoDownloader:
@@ -201,6 +534,8 @@ class PhotoDownloader:
 
     photo_url = None
     supported_formats = ['jpg', 'png', 'jpeg']
+    store = ImageStore(GOODS_IMAGE_PATH)
+    thumbnails = thumbnails
 
     def __init__(self, url=None):
         self.photo_url = url
@@ -217,42 +552,54 @@ class PhotoDownloader:
                 return f
         raise UnsupportedFileFormat('Неподдерживаемый тип файла!')
 
-    @staticmethod
-    def generate_file_name(img_format):
-        """Генерирует имя файла изображения, проверяет, что имя уникально
-        :param img_format: Расширение файла изображения
-        """
-        is_unique = False
-        file_name = None
-        while not is_unique:
-            random_num = random.randint(100, 10 ** 6)
-            file_name = os.path.join(
-                GOODS_IMAGE_PATH, f'img_{random_num}.{img_format}')
-            is_unique = not os.path.exists(file_name)
-        return file_name
-
-    def get_file_name(self):
-        """Определяет формат изображения и возвращает путь к новому файлу"""
-        image_format = self.get_file_format()
-        file_name = self.generate_file_name(image_format)
-        return file_name
-
     def _download(self):
         """Загружает изображение по ссылке и возвращает 2 значения:
-        признак успешного завершения и путь до файла, если не было ошибок
+        признак успешного завершения и путь до файла, если не было ошибок.
+        Изображение загружается по частям и сохраняется под хешем
+        своего содержимого
         :raise: FileNotDownloaded"""
 
-        img = requests.get(self.photo_url)
-        if img.status_code != 200 or not img.content:
-            raise FileNotDownloaded('Ссылка на изображение некорректна!')
-        file_name = self.get_file_name()
+        image_format = self.get_file_format()
+        cache = PhotoCache.objects.filter(url=self.photo_url).first()
+        if cache and not os.path.exists(cache.path):
+            cache = None
+        validators = cache.validators if cache else None
+        with get_http_client().get(
+                self.photo_url, headers=conditional_headers(validators),
+                stream=True) as img:
+            if is_not_modified(img, validators):
+                # Копии могли быть не созданы или удалены - создаются недостающие
+                self.make_thumbnails(cache.path)
+                return True, cache.path
+            if img.status_code != 200:
+                raise FileNotDownloaded('Ссылка на изображение некорректна!')
+            content_length = int(img.headers.get('Content-Length') or 0)
+            if content_length > self.store.max_size:
+                raise FileNotDownloaded(
+                    f'Размер изображения превышает {self.store.max_size} байт!')
+            try:
+                content_hash, file_name = self.store.save(
+                    img.iter_content(PHOTO_DOWNLOAD['chunk_size']), image_format)
+            except OSError as e:
+                print(f'Произошла ошибка при сохранении картинки: {e}')
+                return False, None
+        PhotoCache.store(self.photo_url, file_name,
+                         get_validators(img, content_hash))
+        self.make_thumbnails(file_name)
+        return True, file_name
+
+    @classmethod
+    def make_thumbnails(cls, file_name):
+        """Создает недостающие уменьшенные копии. Ошибка при их создании
+        не мешает использовать загруженное изображение
+        :return: Признак того, что все копии созданы
+        """
         try:
-            with open(file_name, "wb") as out:
-                out.write(img.content)
-            return True, file_name
+            cls.thumbnails.make(file_name)
+            return True
         except Exception as e:
-            print(f'Произошла ошибка при сохранении картинки: {e}')
-            return False, None
+            print(f'Не удалось создать уменьшенные копии изображения {file_name}: {e}')
+            return False
 
     def download(self):
         """Скачивает изображение по ссылке и возвращает признак успешного
@@ -0,0 +1,250 @@
+import asyncio
+import os
+import socket
+import time
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import urlparse
+
+from django.db import connections
+
+from config.settings import PRICE_REFRESH, WEBDRIVER_POOL
+from .constants import JobStatusEnum, PageParserEnum
+from .exceptions import UnsupportedSite
+from .helpers import get_photo_path, parse_site
+from .metrics import PageTrace, stage, use_trace
+from .models import PriceJob, Site
+from .sites import SiteParsing
+from .throttle import interleave_by_domain
+
+RefreshResult = namedtuple(
+    'RefreshResult', ['site', 'price', 'photo_path', 'error', 'elapsed', 'trace'])
+
+
+class RefreshSummary:
+    """Итоги массового обновления цен: количество, пропускная способность
+    и задержки обработки страниц"""
+
+    def __init__(self):
+        self.succeeded = 0
+        self.failed = 0
+        self.saved = 0
+        self.latencies = []
+        self.elapsed = 0
+
+    @property
+    def total(self):
+        return self.succeeded + self.failed
+
+    @property
+    def throughput(self):
+        """Количество обработанных страниц в секунду"""
+        return self.total / self.elapsed if self.elapsed else 0
+
+    def percentile(self, percent):
+        if not self.latencies:
+            return 0
+        latencies = sorted(self.latencies)
+        index = min(len(latencies) - 1,
+                    int(round(percent / 100 * (len(latencies) - 1))))
+        return latencies[index]
+
+    def add(self, result):
+        self.latencies.append(result.elapsed)
+        if result.error is None and result.price:
+            self.succeeded += 1
+        else:
+            self.failed += 1
+
+    def __str__(self):
+        return (f'Обработано страниц: {self.total} '
+                f'(успешно - {self.succeeded}, с ошибкой - {self.failed}, '
+                f'сохранено - {self.saved}) за {self.elapsed:.1f} сек.; '
+                f'{self.throughput:.2f} стр./сек.; задержка '
+                f'p50={self.percentile(50):.2f}, '
+                f'p95={self.percentile(95):.2f}, '
+                f'max={self.percentile(100):.2f} сек.')
+
+
+def write_results(batch, require_photo=True, worker=None):
+    """Сохраняет пачку результатов отдельно по классам сайтов и завершает
+    замеры страниц: ошибка записи в БД учитывается как ошибка обработки
+    страницы. Возвращает количество сохраненных цен
+    :param worker: Имя, под которым сайты заняты (PriceJob.claim);
+    задачи сайтов пачки завершаются
+    """
+    errors = defaultdict(list)
+    by_site = defaultdict(list)
+    for result in batch:
+        by_site[result.trace.site].append(result)
+    saved = 0
+    for site_name, results in by_site.items():
+        write_error = None
+        try:
+            with stage('db_write', site=site_name):
+                saved += Site.apply_results(
+                    ((r.site, r.price, r.photo_path) for r in results if r.error is None),
+                    require_photo=require_photo)
+        except Exception as e:
+            print(f'Не удалось сохранить результаты сайтов {site_name}. {e}')
+            write_error = e
+        for result in results:
+            error = result.error or write_error
+            outcome = 'error' if error is not None else result.trace.outcome
+            result.trace.finish(outcome, error, elapsed=result.elapsed)
+            errors[str(error) if error is not None else None].append(result.site.id)
+    if worker is not None:
+        for error, site_ids in errors.items():
+            PriceJob.release(worker, site_ids, error)
+    return saved
+
+
+class PriceRefresher:
+    """Конкурентное обновление цен для множества сайтов.
+
+    Страницы загружаются в пулах потоков под управлением asyncio:
+    отдельный ограниченный пул для сайтов, требующих браузер, и общий
+    для сайтов, которые загружаются через requests. Одновременно
+    обрабатывается не больше concurrency страниц и не больше per_domain
+    страниц одного домена. Фото загружаются в отдельном пуле после того,
+    как страница разобрана и сессия браузера освобождена; в режиме
+    price_only фото не ищутся и не загружаются. Результаты сохраняются
+    пачками по batch_size в отдельном потоке.
+    """
+
+    def __init__(self, concurrency=None, per_domain=None, selenium_workers=None,
+                 io_workers=None, batch_size=None, price_only=False,
+                 parse_func=parse_site, photo_func=get_photo_path, worker=None):
+        """
+        :param price_only: Обновлять только цены, фото сайтов не меняются
+        :param parse_func: Разбор страницы сайта, возвращает PageData
+        :param photo_func: Путь к фото по сайту и PageData
+        :param worker: Имя, под которым сайты заняты (PriceJob.claim),
+        задачи сайтов завершаются при записи результатов
+        """
+        self.concurrency = concurrency or PRICE_REFRESH['concurrency']
+        self.per_domain = per_domain or PRICE_REFRESH['per_domain']
+        self.selenium_workers = (selenium_workers
+                                 or PRICE_REFRESH['selenium_workers']
+                                 or WEBDRIVER_POOL['size'])
+        self.io_workers = io_workers or PRICE_REFRESH['io_workers']
+        self.batch_size = batch_size or PRICE_REFRESH['batch_size']
+        self.price_only = price_only
+        self.parse_func = partial(parse_func, price_only=True) if price_only else parse_func
+        self.photo_func = photo_func
+        self.worker = worker
+
+    def run(self, sites):
+        """
+        :param sites: Список сайтов с аннотациями with_last_price
+        :return: RefreshSummary
+        """
+        # Классы сайтов определяются до запуска цикла событий, так как
+        # для сайтов, описанных в БД, может потребоваться запрос к ней
+        resolved = []
+        for site in sites:
+            try:
+                resolved.append((site, SiteParsing.get_site_class(site.url), None))
+            except UnsupportedSite as e:
+                resolved.append((site, None, e))
+        # Сайты чередуются по доменам, чтобы запросы ко всем доменам
+        # начинались сразу и каждый загружался с разрешенной частотой
+        resolved = interleave_by_domain(resolved, lambda item: item[0].url)
+        return asyncio.run(self._run(resolved))
+
+    def call(self, site, trace, func, *args):
+        """Вызывает func в рамках замера страницы trace,
+        ошибка возвращается вместо исключения"""
+        try:
+            with use_trace(trace):
+                return func(*args), None
+        except Exception as e:
+            print(f'Произошла ошибка при обновлении данных сайта (id={site.id}). {e}')
+            return None, e
+        finally:
+            # Потоки пулов живут до конца обновления, соединения с БД не копятся
+            connections.close_all()
+
+    async def _run(self, sites):
+        loop = asyncio.get_running_loop()
+        summary = RefreshSummary()
+        global_limit = asyncio.Semaphore(self.concurrency)
+        domain_limits = defaultdict(lambda: asyncio.Semaphore(self.per_domain))
+        executors = {
+            PageParserEnum.Selenium: ThreadPoolExecutor(
+                self.selenium_workers, thread_name_prefix='refresh-selenium'),
+            PageParserEnum.Requests: ThreadPoolExecutor(
+                self.concurrency, thread_name_prefix='refresh-requests'),
+        }
+        kind_limits = {
+            PageParserEnum.Selenium: asyncio.Semaphore(self.selenium_workers),
+            PageParserEnum.Requests: asyncio.Semaphore(self.concurrency),
+        }
+        io_executor = ThreadPoolExecutor(self.io_workers, thread_name_prefix='refresh-io')
+        db_executor = ThreadPoolExecutor(1, thread_name_prefix='refresh-db')
+        batch = []
+        writes = []
+
+        def flush():
+            if batch:
+                writes.append(loop.run_in_executor(
+                    db_executor, write_results, list(batch), not self.price_only, self.worker))
+                batch.clear()
+
+        async def process(site, site_class, error):
+            if error is not None:
+                summary.add(RefreshResult(site, None, None, error, 0, None))
+                return
+            parser_type = site_class.page_parser_type
+            async with kind_limits[parser_type], \
+                    domain_limits[urlparse(site.url).netloc], global_limit:
+                start = time.perf_counter()
+                trace = PageTrace(site_class.__name__, site.url)
+                page, error = await loop.run_in_executor(
+                    executors[parser_type], self.call, site, trace, self.parse_func, site)
+            photo_path = None
+            if self.price_only:
+                photo_path = site.photo_path
+            elif error is None:
+                photo_path, error = await loop.run_in_executor(
+                    io_executor, self.call, site, trace, self.photo_func, site, page)
+            result = RefreshResult(site, page.price if page else None, photo_path,
+                                   error, time.perf_counter() - start, trace)
+            summary.add(result)
+            batch.append(result)
+            if len(batch) >= self.batch_size:
+                flush()
+
+        start = time.perf_counter()
+        try:
+            await asyncio.gather(*(process(*site) for site in sites))
+            flush()
+            for saved in await asyncio.gather(*writes):
+                summary.saved += saved
+        finally:
+            for executor in (*executors.values(), io_executor):
+                executor.shutdown(wait=True)
+            db_executor.submit(connections.close_all).result()
+            db_executor.shutdown(wait=True)
+        summary.elapsed = time.perf_counter() - start
+        return summary
+
+
+def refresh_prices(site_ids=None, **options):
+    """Массовое обновление цен. Без site_ids обновляются все сайты,
+    для которых сейчас не выполняется задача. На время обновления сайты
+    заняты (PriceJob.claim), поэтому обработчики очереди их не обновляют
+    :param options: Параметры PriceRefresher
+    :return: RefreshSummary
+    """
+    worker = f'refresh:{socket.gethostname()}:{os.getpid()}'
+    sites = Site.objects.all() if site_ids is None else Site.objects.filter(id__in=site_ids)
+    PriceJob.claim(sites, worker)
+    try:
+        claimed = Site.objects.with_last_price().filter(
+            jobs__status=JobStatusEnum.Running, jobs__locked_by=worker)
+        return PriceRefresher(worker=worker, **options).run(claimed)
+    finally:
+        # Сайты, результаты которых не записаны (например, сайт не поддерживается)
+        PriceJob.release(worker, error='Результат обновления не сохранен')
@@ -0,0 +1,236 @@
+import random
+import socket
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from selenium.common.exceptions import TimeoutException, WebDriverException
+
+from config.settings import RETRY
+from .exceptions import CircuitOpen, PageNotOpened, WebDriverPoolTimeout
+
+# Ответы, после которых запрос имеет смысл повторить
+RETRYABLE_STATUSES = (408, 429)
+# Признаки того, что браузер не смог найти сайт
+BROWSER_DNS_ERRORS = ('dnsNotFound', 'ERR_NAME_NOT_RESOLVED')
+
+
+def iter_causes(error):
+    """Ошибка и все ошибки, которые к ней привели"""
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        yield error
+        reason = getattr(error, 'reason', None)
+        if not isinstance(reason, BaseException):
+            reason = next((arg for arg in getattr(error, 'args', ())
+                           if isinstance(arg, BaseException)), None)
+        error = error.__cause__ or reason or error.__context__
+
+
+def is_dns_error(error):
+    if isinstance(error, WebDriverException):
+        return any(text in str(error.msg) for text in BROWSER_DNS_ERRORS)
+    return any(isinstance(e, socket.gaierror) for e in iter_causes(error))
+
+
+def is_driver_crash(error):
+    """Сессия WebDriver больше не пригодна для работы"""
+    return (isinstance(error, WebDriverException)
+            and not isinstance(error, TimeoutException)
+            and not is_dns_error(error))
+
+
+def is_retryable(error):
+    """Классификация ошибок открытия страницы: повторяются таймауты,
+    обрывы соединения, ответы 5xx, 408 и 429, сбои браузера.
+    Ошибки DNS, остальные ответы 4xx и прочие ошибки не повторяются.
+    Нехватка сессий в пуле WebDriver (WebDriverPoolTimeout) тоже не
+    повторяется: это не ошибка сайта, задача будет повторена позже"""
+    if isinstance(error, PageNotOpened):
+        return error.retryable
+    if is_dns_error(error):
+        return False
+    if isinstance(error, requests.HTTPError):
+        status = error.response.status_code if error.response is not None else 500
+        return status >= 500 or status in RETRYABLE_STATUSES
+    return isinstance(error, (requests.Timeout, requests.ConnectionError,
+                              WebDriverException))
+
+
+def is_site_failure(error):
+    """Ошибка говорит о проблеме с сайтом целиком, а не с одной страницей
+    (например, товар удален - 404). Такие ошибки учитывает CircuitBreaker.
+    Нехватка сессий в пуле WebDriver к сайту отношения не имеет"""
+    if isinstance(error, WebDriverPoolTimeout):
+        return False
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        status = error.response.status_code
+        return status >= 500 or status in RETRYABLE_STATUSES
+    return is_dns_error(error) or is_retryable(error)
+
+
+class RetryBudget:
+    """Бюджет повторных попыток для сайта: каждая успешная загрузка
+    пополняет его на ratio, каждая повторная попытка расходует единицу.
+    Если сайт постоянно отвечает с ошибкой, бюджет заканчивается
+    и запросы больше не повторяются"""
+
+    def __init__(self, ratio, max_tokens):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+
+    def deposit(self):
+        self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self):
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class CircuitBreaker:
+    """Прерыватель для сайта: после failure_threshold неудачных загрузок
+    подряд запросы к сайту не отправляются reset_timeout секунд. Затем
+    пропускается одна пробная загрузка: при успехе запросы возобновляются,
+    при ошибке прерыватель снова размыкается"""
+
+    closed, opened, half_opened = 'closed', 'open', 'half-open'
+
+    def __init__(self, failure_threshold, reset_timeout, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = self.closed
+        self.failures = 0
+        self.opened_at = None
+
+    def allow(self):
+        if self.state == self.opened:
+            if self.clock() - self.opened_at < self.reset_timeout:
+                return False
+            self.state = self.half_opened
+            return True
+        # Пока идет пробная загрузка, остальные запросы не пропускаются
+        return self.state == self.closed
+
+    def record_success(self):
+        self.state = self.closed
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.half_opened or self.failures >= self.failure_threshold:
+            self.state = self.opened
+            self.opened_at = self.clock()
+
+
+class Retrier:
+    """Выполнение загрузок с повторными попытками.
+
+    Задержка между попытками растет экспоненциально (base_delay * 2^n,
+    не больше max_delay) со случайным разбросом (full jitter). Бюджет
+    повторов и прерыватель ведутся отдельно для каждого сайта (домена).
+    """
+
+    def __init__(self, attempts=3, base_delay=1, max_delay=30, budget_ratio=0.2,
+                 budget_max=10, failure_threshold=5, reset_timeout=300,
+                 clock=time.monotonic, sleep=time.sleep):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget_ratio = budget_ratio
+        self.budget_max = budget_max
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.sleep = sleep
+        self.budgets = {}
+        self.breakers = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_key(url):
+        from .sites import SiteParsing
+        return SiteParsing.normalize_netloc(urlparse(url).netloc)
+
+    def get_delay(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def _get_state(self, key):
+        if key not in self.breakers:
+            self.budgets[key] = RetryBudget(self.budget_ratio, self.budget_max)
+            self.breakers[key] = CircuitBreaker(
+                self.failure_threshold, self.reset_timeout, self.clock)
+        return self.budgets[key], self.breakers[key]
+
+    @staticmethod
+    def _record_error(breaker, error):
+        """Учитывает в прерывателе последнюю неудачную попытку.
+        Вызывается под блокировкой"""
+        if is_site_failure(error):
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+
+    def call(self, url, func, on_error=None):
+        """Выполняет загрузку url
+        :param func: Функция загрузки без аргументов
+        :param on_error: Вызывается с ошибкой перед повторной попыткой
+        :raise: PageNotOpened, CircuitOpen
+        """
+        key = self.get_key(url)
+        with self._lock:
+            budget, breaker = self._get_state(key)
+            if not breaker.allow():
+                raise CircuitOpen(f'Запросы к сайту {key} временно приостановлены '
+                                  f'из-за постоянных ошибок')
+        attempt = 0
+        while True:
+            try:
+                result = func()
+            except Exception as e:
+                retryable = is_retryable(e)
+                with self._lock:
+                    retry = (retryable and attempt + 1 < self.attempts
+                             and budget.withdraw())
+                    if not retry:
+                        self._record_error(breaker, e)
+                if not retry:
+                    raise PageNotOpened(f'Не удалось открыть страницу {url}: {e}',
+                                        retryable=retryable) from e
+                delay = self.get_delay(attempt)
+                print(f'Ошибка при открытии страницы {url} ({e}), '
+                      f'повтор через {delay:.1f} сек.')
+                try:
+                    if on_error is not None:
+                        on_error(e)
+                    self.sleep(delay)
+                except BaseException:
+                    # Повтора не будет: результат попытки учитывается, иначе
+                    # прерыватель остался бы в состоянии пробной загрузки
+                    with self._lock:
+                        self._record_error(breaker, e)
+                    raise
+                attempt += 1
+            else:
+                with self._lock:
+                    budget.deposit()
+                    breaker.record_success()
+                return result
+
+
+_retrier = None
+_retrier_lock = threading.Lock()
+
+
+def get_retrier():
+    """Общий для процесса Retrier, настраивается через RETRY"""
+    global _retrier
+    with _retrier_lock:
+        if _retrier is None:
+            _retrier = Retrier(**RETRY)
+        return _retrier
@@ -2,6 +2,7 @@ from urllib.parse import urlparse
 from abc import ABCMeta, abstractmethod
 
 from .constants import IdentifierEnum,TypeAndId, PageParserEnum
+from .exceptions import UnsupportedSite
 
 
 def get_only_digits(string):
@@ -9,18 +10,82 @@ def get_only_digits(string):
 
 
 class SiteParsing(metaclass=ABCMeta):
-    #TODO: сделать загрузку полей из отдельного файла конфига или из бд
+    # Сайты описываются подклассами или записями ShopConfig в БД
     main_url = None
+    # Дополнительные домены сайта (зеркала, региональные домены)
+    aliases = ()
     page_parser_type = None
+    # Открывать страницы в облегченном профиле браузера: без изображений,
+    # стилей, шрифтов и счетчиков (только для PageParserEnum.Selenium)
+    lean_browser = False
     price_src = None
     photo_src = None
 
+    # Домен -> класс сайта. Заполняется автоматически при объявлении
+    # подкласса с main_url
+    registry = {}
+    # Префиксы поддоменов, которые не отличают один сайт от другого
+    ignored_prefixes = ('www.', 'm.')
+
+    def __init_subclass__(cls, register=True, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if register and cls.main_url:
+            cls.register(cls)
+
+    @classmethod
+    def normalize_netloc(cls, netloc):
+        """Приводит домен к виду, в котором он хранится в реестре"""
+        host = netloc.lower().rsplit('@', 1)[-1]
+        for default_port in (':80', ':443'):
+            if host.endswith(default_port):
+                host = host[:-len(default_port)]
+        for prefix in cls.ignored_prefixes:
+            if host.startswith(prefix):
+                host = host[len(prefix):]
+        return host
+
+    @classmethod
+    def register(cls, site_class, registry=None):
+        registry = SiteParsing.registry if registry is None else registry
+        for netloc in (urlparse(site_class.main_url).netloc, *site_class.aliases):
+            registry[cls.normalize_netloc(netloc)] = site_class
+
     @staticmethod
-    def get_site(url):
-        base_url = urlparse(url).netloc
-        for site in all_sites:
-            if base_url == urlparse(site.main_url).netloc:
-                return site(url)
+    def find_in_registry(registry, host):
+        labels = host.split('.')
+        for i in range(max(len(labels) - 1, 1)):
+            site_class = registry.get('.'.join(labels[i:]))
+            if site_class:
+                return site_class
+        return None
+
+    @classmethod
+    def get_site_class(cls, url):
+        """Определяет класс сайта по ссылке. Поддомены (например,
+        региональные) относятся к сайту основного домена. Сначала
+        проверяются сайты, описанные в коде, затем - описанные в БД
+        :raise: UnsupportedSite
+        """
+        from parsing.models import ShopConfig
+        host = cls.normalize_netloc(urlparse(url).netloc)
+        site_class = (cls.find_in_registry(cls.registry, host)
+                      or cls.find_in_registry(ShopConfig.get_registry(), host))
+        if site_class:
+            return site_class
+        raise UnsupportedSite(f'Сайт {url} не поддерживается!')
+
+    @classmethod
+    def get_site(cls, url):
+        """:raise: UnsupportedSite"""
+        return cls.get_site_class(url)(url)
+
+    @classmethod
+    def is_supported(cls, url):
+        try:
+            cls.get_site_class(url)
+            return True
+        except UnsupportedSite:
+            return False
 
     def set_url(self, url):
         self.url = url
@@ -36,13 +101,20 @@ class SiteParsing(metaclass=ABCMeta):
         pass
 
     @abstractmethod
-    def process_photo_element(self, element):
+    def get_photo_url(self, element):
+        """Ссылка на фото товара. Вызывается, пока страница открыта"""
         pass
 
+    def process_photo_element(self, element):
+        """Загружает фото товара, возвращает путь к файлу"""
+        from parsing.parsers import download_photo
+        return download_photo(self.get_photo_url(element))
+
 
 class Wildberries(SiteParsing):
     main_url = 'https://www.wildberries.ru/'
     page_parser_type = PageParserEnum.Selenium
+    lean_browser = True
     price_src = TypeAndId(IdentifierEnum.class_, 'final-cost')
     photo_src = TypeAndId(IdentifierEnum.xpath, '//*[@id="Azoom"]')
 
@@ -50,15 +122,14 @@ class Wildberries(SiteParsing):
         price_elem = element[0]
         return get_only_digits(price_elem.text)
 
-    def process_photo_element(self, element):
-        from parsing.parsers import PhotoDownloader
-        photo_url = element.get_attribute('href')
-        return PhotoDownloader(photo_url).download()[1]
+    def get_photo_url(self, element):
+        return element.get_attribute('href')
 
 
 class Lamoda(SiteParsing):
     main_url = 'https://www.lamoda.ru/'
     page_parser_type = PageParserEnum.Selenium
+    lean_browser = True
     price_src = [
         TypeAndId(IdentifierEnum.class_, 'ii-product__price-current_red'),
         TypeAndId(IdentifierEnum.class_, 'ii-product__price-discount_second'),
@@ -70,14 +141,26 @@ class Lamoda(SiteParsing):
         price_elem = element[0]
         return get_only_digits(price_elem.text)
 
-    def process_photo_element(self, element):
-        # TODO: исправить зависимости от парсера
-        from parsing.parsers import PhotoDownloader
-        photo_elem = element[0]
-        photo_url = photo_elem.get_attribute('src')
-        return PhotoDownloader(photo_url).download()[1]
+    def get_photo_url(self, element):
+        return element[0].get_attribute('src')
 
 
-all_sites = [
-    Wildberries, Lamoda
-]
+class ConfiguredSite(SiteParsing, register=False):
+    """Базовый класс сайтов, описанных в БД (ShopConfig).
+    Подклассы создаются методом ShopConfig.compile"""
+
+    config_id = None
+    # Индекс элемента в списке (для поиска по классу) и атрибут со ссылкой на фото
+    price_index = 0
+    photo_index = 0
+    photo_attribute = 'src'
+
+    @staticmethod
+    def get_item(element, index):
+        return element[index] if isinstance(element, list) else element
+
+    def process_price_element(self, element):
+        return get_only_digits(self.get_item(element, self.price_index).text)
+
+    def get_photo_url(self, element):
+        return self.get_item(element, self.photo_index).get_attribute(self.photo_attribute)
@@ -1,14 +1,87 @@
-from django.test import TestCase
+import hashlib
+import io
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+import urllib3
+from PIL import Image
+from selenium.common.exceptions import JavascriptException, TimeoutException, WebDriverException
+from selenium.webdriver.chrome.options import Options as ChromeOptions
+from selenium.webdriver.firefox.options import Options as FirefoxOptions
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import DatabaseError
+from django.test import TestCase, SimpleTestCase, TransactionTestCase
+from django.utils import timezone
+from unittest import mock, skipUnless
 from django.contrib.auth.models import User
-from urllib.parse import urlparse
+from urllib.parse import unquote, urlparse
 
-from parsing.constants import DEFAULT_IMG_PATH
-from .models import Site
-from .parsers import Parsing, PhotoDownloader
+from config.settings import PRICE_JOBS
+from parsing.constants import DEFAULT_IMG_PATH, IdentifierEnum, PricePeriodEnum, TypeAndId, JobStatusEnum
+from .models import Site, Price, PriceAggregate, PriceJob, ShopConfig
+from .exceptions import CircuitOpen, PageNotOpened, WebDriverPoolTimeout, UnsupportedSite
+from .parsers import Parsing, PhotoDownloader, RequestsPageParser, SeleniumPageParser
+from .helpers import PageData, enqueue_price_task, get_sites_and_url_form, update_site_price
+from .browser import apply_lean_profile, get_pac_url
+from .images import ImageStore, Thumbnails
+from .metrics import metrics, stage, trace_page
+from .mock_shop import MockShop
+from .http import HttpClient, Validators
+from .refresh import refresh_prices
+from .retry import CircuitBreaker, Retrier, RetryBudget, is_retryable, is_site_failure
+from .sites import Lamoda, SiteParsing, Wildberries
+from .throttle import DomainScheduler, TokenBucket, interleave_by_domain
+from .webdriver_pool import WebDriverPool
+from .worker import PriceWorker
+
+# Тесты, обращающиеся к настоящим сайтам, запускаются только по запросу
+LIVE_TESTS = bool(os.environ.get('PARSING_LIVE_TESTS'))
 
 
 # Create your tests here.
-class TestParsing(TestCase):
+class MockShopMixin:
+    """Запускает имитации магазинов (MockShop) вместо настоящих сайтов,
+    изображения сохраняются во временный каталог"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.shops = {site_class: MockShop(site_class).start()
+                     for site_class in (Wildberries, Lamoda)}
+        cls.image_root = tempfile.mkdtemp()
+        cls.store_patcher = mock.patch.object(
+            PhotoDownloader, 'store', ImageStore(cls.image_root))
+        cls.store_patcher.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.store_patcher.stop()
+        shutil.rmtree(cls.image_root)
+        for shop in cls.shops.values():
+            shop.stop()
+        super().tearDownClass()
+
+    def get_url(self, url):
+        """Адрес страницы url на имитации магазина"""
+        return self.shops[SiteParsing.get_site_class(url)].url_for(url)
+
+
+class TestParsing(MockShopMixin, TestCase):
     fixtures = ['sites.json']
 
     def get_one_site_from_each(self):
@@ -37,27 +110,37 @@ class TestParsing(TestCase):
         """Тесты для уникальных сайтов"""
         for url in self.unique_sites.values():
             print('--------------------------------')
-            price, photo = Parsing(url).parse_data()
+            price, photo = Parsing(self.get_url(url)).parse_data()
             print(f'Price - {price}; Photo - {photo}')
             print('--------------------------------')
             self.assertIsNotNone(price)
             self.assertIsNotNone(photo)
 
 
-class TestPhotoDownloader(TestCase):
+@skipUnless(LIVE_TESTS, 'Проверка на настоящих сайтах: PARSING_LIVE_TESTS=1')
+class TestLiveParsing(TestParsing):
+    def get_url(self, url):
+        return url
+
+
+class TestPhotoDownloader(MockShopMixin, TestCase):
     image_urls = dict(
-        correct='https://img2.wbstatic.net/big/new/8660000/8661404-1.jpg',
-        wrong='https://img2.wbstatic.net/big/new/8660000/agigdigdaggdg-1.jpg',
+        correct='/img/8661404.jpg',
+        wrong='/img/agigdigdaggdg-1.jpg',
         unsupported_format=''
     )
 
+    def get_image_url(self, name):
+        path = self.image_urls[name]
+        return self.shops[Wildberries].base_url + path if path else path
+
     def test_correct_url(self):
-        success, photo = PhotoDownloader(self.image_urls['correct']).download()
+        success, photo = PhotoDownloader(self.get_image_url('correct')).download()
         self.assertTrue(success)
         self.assertNotEqual(photo, DEFAULT_IMG_PATH)
 
     def test_wrong_url(self):
-        success, photo = PhotoDownloader(self.image_urls['wrong']).download()
+        success, photo = PhotoDownloader(self.get_image_url('wrong')).download()
         self.assertFalse(success)
         self.assertEqual(photo, DEFAULT_IMG_PATH)
 
@@ -65,3 +148,1427 @@ class TestPhotoDownloader(TestCase):
         success, photo = PhotoDownloader('').download()
         self.assertFalse(success)
         self.assertEqual(photo, DEFAULT_IMG_PATH)
+
+
+@skipUnless(LIVE_TESTS, 'Проверка на настоящих сайтах: PARSING_LIVE_TESTS=1')
+class TestLivePhotoDownloader(TestPhotoDownloader):
+    image_urls = dict(
+        correct='https://img2.wbstatic.net/big/new/8660000/8661404-1.jpg',
+        wrong='https://img2.wbstatic.net/big/new/8660000/agigdigdaggdg-1.jpg',
+        unsupported_format=''
+    )
+
+    def get_image_url(self, name):
+        return self.image_urls[name]
+
+
+class TestPhotoReuse(MockShopMixin, TestCase):
+    fixtures = ['sites.json']
+
+    def setUp(self):
+        self.shop = self.shops[Lamoda]
+        self.site = Site.objects.filter(domain='www.lamoda.ru').first()
+        self.site.url = self.shop.url_for(self.site.url)
+        self.site.save()
+
+    def refresh_page(self):
+        """Обновляет цену, сбросив валидаторы, чтобы страница была разобрана
+        заново. Возвращает количество запросов к магазину"""
+        Site.objects.filter(id=self.site.id).update(etag='', last_modified='', content_hash='')
+        requests_before = self.shop.requests
+        update_site_price(self.site.id)
+        return self.shop.requests - requests_before
+
+    def test_same_photo_url(self):
+        self.assertEqual(self.refresh_page(), 2)
+        site = Site.objects.get(id=self.site.id)
+        self.assertTrue(site.photo_url.endswith('.jpg'))
+        self.assertTrue(os.path.exists(site.photo_path))
+        self.assertTrue(site.has_thumbnails)
+        # Копии удалены - создаются заново без загрузки изображения
+        for path in Thumbnails().get_paths(site.photo_path):
+            os.remove(path)
+        Site.objects.filter(id=self.site.id).update(has_thumbnails=False)
+        self.assertEqual(self.refresh_page(), 1)
+        self.assertTrue(Site.objects.get(id=self.site.id).has_thumbnails)
+        self.assertTrue(Thumbnails().exist(site.photo_path))
+        # Ссылка на изображение не изменилась - загружается только страница
+        self.assertEqual(self.refresh_page(), 1)
+        self.assertEqual(Site.objects.get(id=self.site.id).photo_path, site.photo_path)
+        # Файла нет - изображение загружается заново
+        os.remove(site.photo_path)
+        self.assertEqual(self.refresh_page(), 2)
+        self.assertTrue(os.path.exists(Site.objects.get(id=self.site.id).photo_path))
+
+    def update(self):
+        """Обновляет цену с валидаторами прошлой загрузки, возвращает
+        количество запросов к магазину"""
+        requests_before = self.shop.requests
+        update_site_price(self.site.id)
+        return self.shop.requests - requests_before
+
+    def test_failed_photo_retried(self):
+        with mock.patch('parsing.parsers.download_photo', return_value=DEFAULT_IMG_PATH):
+            self.update()
+        self.assertEqual(Site.objects.get(id=self.site.id).photo_path, DEFAULT_IMG_PATH)
+        # Страница не изменилась, но фото нет - страница разбирается и фото загружается
+        self.assertEqual(self.update(), 2)
+        photo_path = Site.objects.get(id=self.site.id).photo_path
+        self.assertNotEqual(photo_path, DEFAULT_IMG_PATH)
+        self.assertTrue(os.path.exists(photo_path))
+        # Фото на месте - неизмененная страница не разбирается
+        self.assertEqual(self.update(), 1)
+        self.assertEqual(Site.objects.get(id=self.site.id).photo_path, photo_path)
+
+
+class FakeDriver:
+    """Заглушка WebDriver для проверки пула без запуска браузера"""
+
+    def __init__(self):
+        self.is_alive = True
+        self.is_quit = False
+
+    @property
+    def current_url(self):
+        if not self.is_alive:
+            raise ConnectionError('Браузер не отвечает')
+        return 'about:blank'
+
+    def quit(self):
+        self.is_quit = True
+
+
+class FakePageDriver:
+    """Имитирует страницу, на которой элементы появляются не сразу:
+    elements - {(тип, идентификатор): (через сколько сек. появится, элементы)}"""
+
+    def __init__(self, elements):
+        self.elements = elements
+        self.start = time.monotonic()
+        self.scripts = []
+
+    def execute_script(self, script, groups):
+        self.scripts.append(groups)
+        elapsed = time.monotonic() - self.start
+        result = []
+        for selectors in groups:
+            match = None
+            for index, (type_name, identifier) in enumerate(selectors):
+                appears, found = self.elements.get((type_name, identifier), (None, None))
+                if appears is not None and elapsed >= appears:
+                    match = [index, found]
+                    break
+            result.append(match)
+        return result
+
+
+@mock.patch.dict('parsing.parsers.SELENIUM_WAIT', {'timeout': 0.3, 'poll_frequency': 0.01})
+class TestSeleniumWaits(SimpleTestCase):
+    def get_parser(self, elements):
+        parser = SeleniumPageParser('https://www.lamoda.ru/p/1/')
+        parser.driver = FakePageDriver(elements)
+        return parser
+
+    def test_waits_for_element(self):
+        parser = self.get_parser({('class_', 'price'): (0.05, ['750'])})
+        self.assertEqual(parser.get_page_elem(TypeAndId(IdentifierEnum.class_, 'price')), ['750'])
+        self.assertGreater(len(parser.driver.scripts), 1)
+
+    def test_single_pass_and_order(self):
+        src = [TypeAndId(IdentifierEnum.class_, 'red'),
+               TypeAndId(IdentifierEnum.class_, 'second'),
+               TypeAndId(IdentifierEnum.xpath, '//img')]
+        parser = self.get_parser({('class_', 'second'): (0, ['500']),
+                                  ('xpath', '//img'): (0, ['img'])})
+        self.assertEqual(parser.get_page_elem(src), ['500'])
+        self.assertEqual(parser.driver.scripts,
+                         [[[['class_', 'red'], ['class_', 'second'], ['xpath', '//img']]]])
+        self.assertEqual(parser.get_page_elem(src[2]), 'img')
+
+    def test_price_and_photo_in_one_pass(self):
+        parser = self.get_parser({('class_', 'price'): (0, ['750']),
+                                  ('xpath', '//img'): (0.05, ['img'])})
+        self.assertEqual(parser.get_page_elems([TypeAndId(IdentifierEnum.class_, 'price'),
+                                                TypeAndId(IdentifierEnum.xpath, '//img')]),
+                         [['750'], 'img'])
+        # Цена найдена в первом проходе, дальше проверяется только фото
+        self.assertEqual(parser.driver.scripts[0],
+                         [[['class_', 'price']], [['xpath', '//img']]])
+        self.assertEqual(parser.driver.scripts[-1], [[['xpath', '//img']]])
+
+    def test_per_selector_timeout(self):
+        src = [TypeAndId(IdentifierEnum.id, 'optional', timeout=0),
+               TypeAndId(IdentifierEnum.id, 'price', timeout=0.1)]
+        parser = self.get_parser({})
+        start = time.monotonic()
+        self.assertIsNone(parser.get_page_elem(src))
+        self.assertLess(time.monotonic() - start, 0.3)
+        self.assertEqual(parser.driver.scripts[-1], [[['id', 'price']]])
+
+    def test_script_error(self):
+        parser = self.get_parser({('class_', 'price'): (0, ['750']),
+                                  ('xpath', '//img'): (0.05, ['img'])})
+        execute_script = parser.driver.execute_script
+
+        def failing_script(script, groups):
+            if parser.driver.scripts:
+                raise JavascriptException('Страница перезагружена')
+            return execute_script(script, groups)
+        parser.driver.execute_script = failing_script
+        self.assertEqual(parser.get_page_elems([TypeAndId(IdentifierEnum.class_, 'price'),
+                                                TypeAndId(IdentifierEnum.xpath, '//img')]),
+                         [['750'], None])
+
+
+class TestLeanBrowser(SimpleTestCase):
+    def test_firefox_profile(self):
+        options = apply_lean_profile(FirefoxOptions())
+        caps = options.to_capabilities()
+        self.assertEqual(caps['pageLoadStrategy'], 'eager')
+        self.assertTrue(options.headless)
+        prefs = caps['moz:firefoxOptions']['prefs']
+        self.assertEqual(prefs['permissions.default.image'], 2)
+        self.assertEqual(prefs['network.proxy.type'], 2)
+        self.assertTrue(prefs['network.proxy.autoconfig_url'].startswith('data:'))
+
+    def test_chrome_profile(self):
+        options = apply_lean_profile(ChromeOptions())
+        caps = options.to_capabilities()
+        self.assertEqual(caps['pageLoadStrategy'], 'eager')
+        chrome = caps['goog:chromeOptions']
+        self.assertEqual(chrome['prefs']['profile.managed_default_content_settings.images'], 2)
+        rules = next(arg for arg in chrome['args'] if arg.startswith('--host-resolver-rules='))
+        self.assertIn('MAP *.doubleclick.net ~NOTFOUND', rules)
+
+    def test_pac_script(self):
+        script = unquote(get_pac_url(['mc.yandex.ru']).split(',', 1)[1])
+        self.assertIn('["mc.yandex.ru"]', script)
+        self.assertIn('FindProxyForURL', script)
+
+    def test_site_profile(self):
+        parser = Parsing('https://www.lamoda.ru/p/1/').parser
+        self.assertTrue(parser.lean_browser)
+        with mock.patch.dict(SeleniumPageParser._pools, clear=True):
+            self.assertIsNot(SeleniumPageParser.get_pool(True),
+                             SeleniumPageParser.get_pool(False))
+            self.assertIs(SeleniumPageParser.get_pool(True),
+                          SeleniumPageParser.get_pool(True))
+
+
+class TestWebDriverPool(SimpleTestCase):
+    def get_pool(self, **kwargs):
+        self.created = []
+
+        def factory():
+            driver = FakeDriver()
+            self.created.append(driver)
+            return driver
+        return WebDriverPool(factory, **kwargs)
+
+    def test_session_reused(self):
+        pool = self.get_pool(size=2)
+        for _ in range(5):
+            pool.release(pool.acquire())
+        self.assertEqual(len(self.created), 1)
+        self.assertEqual(pool.idle, 1)
+
+    def test_size_limit(self):
+        pool = self.get_pool(size=1)
+        item = pool.acquire()
+        with self.assertRaises(WebDriverPoolTimeout):
+            pool.acquire(timeout=0.01)
+        pool.release(item)
+        self.assertIs(pool.acquire(timeout=0.01), item)
+
+    def test_max_uses(self):
+        pool = self.get_pool(size=1, max_uses=2)
+        first = pool.acquire()
+        pool.release(first)
+        pool.release(pool.acquire())
+        self.assertTrue(first.driver.is_quit)
+        self.assertIsNot(pool.acquire().driver, first.driver)
+        self.assertEqual(len(self.created), 2)
+
+    def test_unhealthy_session_recreated(self):
+        pool = self.get_pool(size=1)
+        item = pool.acquire()
+        pool.release(item)
+        item.driver.is_alive = False
+        self.assertIsNot(pool.acquire().driver, item.driver)
+        self.assertTrue(item.driver.is_quit)
+        self.assertEqual(pool.live, 1)
+
+    def test_idle_eviction(self):
+        pool = self.get_pool(size=2, idle_timeout=0.01)
+        item = pool.acquire()
+        pool.release(item)
+        time.sleep(0.02)
+        self.assertEqual(pool.evict_idle(), 1)
+        self.assertTrue(item.driver.is_quit)
+        self.assertEqual(pool.live, 0)
+
+    def test_close_pools(self):
+        idle_pool = self.get_pool(size=1, idle_timeout=0.01)
+        idle_pool.release(idle_pool.acquire())
+        pool = self.get_pool(size=2)
+        idle, busy = pool.acquire(), pool.acquire()
+        pool.release(idle)
+        with mock.patch.dict(SeleniumPageParser._pools, {True: idle_pool, False: pool},
+                             clear=True):
+            time.sleep(0.02)
+            self.assertEqual(SeleniumPageParser.evict_idle_pools(), 1)
+            SeleniumPageParser.close_pools()
+            self.assertEqual(SeleniumPageParser._pools, {})
+        self.assertTrue(idle.driver.is_quit)
+        # Выданная сессия закрывается при возврате в закрытый пул
+        self.assertFalse(busy.driver.is_quit)
+        pool.release(busy)
+        self.assertTrue(busy.driver.is_quit)
+        self.assertEqual(pool.live, 0)
+
+
+class FakeLoadingDriver(FakeDriver):
+    """Заглушка WebDriver, открывающая страницы. Ошибки из errors
+    выбрасываются при первых открытиях (общие для всех сессий)"""
+
+    def __init__(self, errors, events, statuses):
+        super().__init__()
+        self.errors = errors
+        self.events = events
+        self.statuses = statuses
+
+    def get(self, url):
+        self.events.append('get')
+        if self.errors:
+            raise self.errors.pop(0)
+
+    def execute_script(self, script):
+        return self.statuses.pop(0) if self.statuses else 200
+
+
+class TestSeleniumOpen(SimpleTestCase):
+    def setUp(self):
+        self.errors = []
+        self.events = []
+        self.created = []
+        self.statuses = []
+        self.reports = []
+
+        def factory():
+            self.events.append('driver')
+            driver = FakeLoadingDriver(self.errors, self.events, self.statuses)
+            self.created.append(driver)
+            return driver
+
+        self.pool = WebDriverPool(factory, size=1, acquire_timeout=0.01)
+        clock = FakeClock()
+        self.retrier = Retrier(attempts=3, base_delay=1, max_delay=4, budget_ratio=0.5,
+                               budget_max=2, failure_threshold=1, reset_timeout=60,
+                               clock=clock, sleep=clock.sleep)
+        scheduler = mock.Mock()
+        scheduler.acquire.side_effect = lambda url: self.events.append('token')
+        scheduler.report.side_effect = lambda url, status: self.reports.append(status)
+        scheduler.report_timeout.side_effect = lambda url: self.reports.append('timeout')
+        for target, kwargs in (('parsing.parsers.get_retrier', dict(return_value=self.retrier)),
+                               ('parsing.parsers.get_scheduler', dict(return_value=scheduler)),
+                               ('parsing.parsers.SeleniumPageParser.get_pool',
+                                dict(return_value=self.pool))):
+            patcher = mock.patch(target, **kwargs)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_token_before_session(self):
+        parser = SeleniumPageParser('https://www.wildberries.ru/catalog/1/detail.aspx')
+        parser.open()
+        # Ожидание разрешения на запрос не занимает сессию браузера
+        self.assertEqual(self.events, ['token', 'driver', 'get'])
+
+    def test_busy_pool(self):
+        held = self.pool.acquire()
+        parser = SeleniumPageParser('https://www.wildberries.ru/catalog/1/detail.aspx')
+        with self.assertRaises(WebDriverPoolTimeout):
+            parser.open()
+        self.assertNotIn('get', self.events)
+        # Занятый пул не считается ошибкой сайта
+        error = WebDriverPoolTimeout('Нет свободной сессии')
+        self.assertFalse(is_retryable(error))
+        self.assertFalse(is_site_failure(error))
+        self.pool.release(held)
+        parser.open()
+        self.assertEqual(self.events.count('get'), 1)
+
+    def test_driver_crash(self):
+        self.errors.append(WebDriverException('Браузер закрылся'))
+        parser = SeleniumPageParser('https://www.wildberries.ru/catalog/1/detail.aspx')
+        parser.open()
+        self.assertEqual(self.events, ['token', 'driver', 'get', 'driver', 'token', 'get'])
+        self.assertEqual(len(self.created), 2)
+        self.assertTrue(self.created[0].is_quit)
+        self.assertIs(parser.driver, self.created[1])
+        self.assertEqual(self.events.count('get'), 2)
+
+    def test_scheduler_feedback(self):
+        # Таймаут и ответ 429 снижают частоту запросов, успешная загрузка - восстанавливает
+        self.errors.append(TimeoutException('Страница не загрузилась'))
+        self.statuses.extend([429, None])
+        parser = SeleniumPageParser('https://www.wildberries.ru/catalog/1/detail.aspx')
+        parser.open()
+        self.assertEqual(self.reports, ['timeout', 429, 200])
+        self.assertEqual(self.events.count('token'), 3)
+        # Сессия после таймаута и ошибки сайта не пересоздается
+        self.assertEqual(len(self.created), 1)
+
+    def test_not_found_status(self):
+        self.statuses.append(404)
+        parser = SeleniumPageParser('https://www.wildberries.ru/catalog/1/detail.aspx')
+        with self.assertRaises(PageNotOpened) as context:
+            parser.open()
+        self.assertFalse(context.exception.retryable)
+        self.assertEqual(self.reports, [404])
+
+
+class TestRequestsPageParser(SimpleTestCase):
+    html = """
+    <html><head><meta charset="utf-8"></head><body>
+        <div id="content">
+            <span class="price ii-product__price-current_red"> 1 999 ₽ </span>
+            <span class="price-old">2 500 ₽</span>
+            <img class="gallery-image" src="/img/1.jpg">
+            <img class="gallery-image" src="https://cdn.example.com/2.jpg">
+        </div>
+    </body></html>
+    """.encode('utf-8')
+
+    def setUp(self):
+        self.parser = RequestsPageParser('https://www.lamoda.ru/p/item/')
+        self.parser.load_html(self.html)
+
+    def test_id(self):
+        elem = self.parser.get_element_on_page(
+            TypeAndId(IdentifierEnum.id, 'content'))
+        self.assertIn('1 999', elem.text)
+
+    def test_class(self):
+        elems = self.parser.get_element_on_page(
+            TypeAndId(IdentifierEnum.class_, 'gallery-image'))
+        self.assertEqual(len(elems), 2)
+        self.assertEqual(elems[0].get_attribute('src'),
+                         'https://www.lamoda.ru/img/1.jpg')
+        self.assertEqual(elems[1].get_attribute('src'),
+                         'https://cdn.example.com/2.jpg')
+        # Класс должен совпадать целиком, а не как подстрока
+        prices = self.parser.get_element_on_page(
+            TypeAndId(IdentifierEnum.class_, 'price'))
+        self.assertEqual(len(prices), 1)
+
+    def test_xpath_and_tag(self):
+        elem = self.parser.get_element_on_page(
+            TypeAndId(IdentifierEnum.xpath, '//span[@class="price-old"]'))
+        self.assertEqual(elem.text, '2 500 ₽')
+        elem = self.parser.get_element_on_page(
+            TypeAndId(IdentifierEnum.tag, 'IMG'))
+        self.assertEqual(elem.get_attribute('class'), 'gallery-image')
+
+    def test_not_found(self):
+        self.assertIsNone(self.parser.get_page_elem(
+            TypeAndId(IdentifierEnum.id, 'missing')))
+        self.assertFalse(self.parser.get_page_elem(
+            TypeAndId(IdentifierEnum.class_, 'missing')))
+
+    def test_site_processing(self):
+        site = Lamoda(self.parser.url)
+        elem = self.parser.get_page_elem(site.price_src)
+        self.assertEqual(site.process_price_element(elem), '1999')
+
+
+class FakeRefreshMixin:
+    """Разбор страниц и загрузка фото без обращения к сайтам,
+    с подсчетом одновременно обрабатываемых страниц"""
+
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.running = Counter()
+        self.max_running = Counter()
+        self.photo_urls = []
+
+    def fake_parse(self, site):
+        netloc = urlparse(site.url).netloc
+        with self.lock:
+            self.running[netloc] += 1
+            self.running['total'] += 1
+            for key in (netloc, 'total'):
+                self.max_running[key] = max(
+                    self.max_running[key], self.running[key])
+        time.sleep(0.02)
+        with self.lock:
+            self.running[netloc] -= 1
+            self.running['total'] -= 1
+        return PageData('1234', f'https://img.test/{site.id}.jpg', False)
+
+    def fake_photo(self, site, page):
+        with self.lock:
+            self.photo_urls.append(page.photo_url)
+        return 'static/goods_images/img.jpg'
+
+
+class TestRefreshPrices(FakeRefreshMixin, TransactionTestCase):
+    fixtures = ['sites.json']
+
+    def test_refresh(self):
+        sites_count = Site.objects.count()
+        prices_count = Price.objects.count()
+        summary = refresh_prices(concurrency=3, per_domain=2,
+                                 selenium_workers=3, batch_size=3,
+                                 parse_func=self.fake_parse, photo_func=self.fake_photo)
+        self.assertEqual(summary.total, sites_count)
+        self.assertEqual(summary.saved, sites_count)
+        self.assertEqual(Price.objects.count(), prices_count + sites_count)
+        self.assertEqual(sorted(self.photo_urls), sorted(
+            f'https://img.test/{site_id}.jpg'
+            for site_id in Site.objects.values_list('id', flat=True)))
+        self.assertLessEqual(self.max_running['total'], 3)
+        for netloc in ('www.wildberries.ru', 'www.lamoda.ru'):
+            self.assertLessEqual(self.max_running[netloc], 2)
+        self.assertGreater(summary.throughput, 0)
+
+
+class TestRefreshJobs(FakeRefreshMixin, TransactionTestCase):
+    # Как и в TestPriceOnlyRefresh, без фикстур: сайты создаются в setUp
+    available_apps = ['django.contrib.auth', 'django.contrib.contenttypes', 'parsing']
+
+    def setUp(self):
+        super().setUp()
+        metrics.reset()
+        user = User.objects.create(username='admin')
+        self.sites = [Site.objects.create(user=user, url=url) for url in (
+            'https://www.wildberries.ru/catalog/1/detail.aspx',
+            'https://www.wildberries.ru/catalog/2/detail.aspx',
+            'https://www.wildberries.ru/catalog/3/detail.aspx',
+            'https://www.lamoda.ru/p/1/',
+            'https://www.lamoda.ru/p/2/',
+        )]
+
+    def test_sites_claimed(self):
+        busy = PriceJob.enqueue(self.sites[0].id)
+        claimed = []
+
+        def parse(site):
+            job = PriceJob.objects.get(site=site, status=JobStatusEnum.Running)
+            claimed.append(job.locked_by)
+            # Занятый сайт не достанется обработчику очереди
+            self.assertIsNone(PriceJob.objects.filter(
+                site=site, status=JobStatusEnum.Pending).first())
+            if site.id == self.sites[1].id:
+                raise PageNotOpened('404', retryable=False)
+            return self.fake_parse(site)
+
+        summary = refresh_prices(batch_size=2, parse_func=parse, photo_func=self.fake_photo)
+        self.assertEqual(summary.total, len(self.sites) - 1)
+        self.assertEqual(summary.saved, len(self.sites) - 2)
+        self.assertTrue(all(name.startswith('refresh:') for name in claimed))
+        # Задача из очереди осталась, задачи обновления завершены
+        busy.refresh_from_db()
+        self.assertEqual(busy.status, JobStatusEnum.Pending)
+        self.assertFalse(Price.objects.filter(site=self.sites[0]).exists())
+        failed = PriceJob.objects.get(site=self.sites[1])
+        self.assertEqual((failed.status, failed.error), (JobStatusEnum.Failed, '404'))
+        self.assertEqual(PriceJob.objects.filter(status=JobStatusEnum.Done).count(),
+                         len(self.sites) - 2)
+
+    def test_write_error_metrics(self):
+        with mock.patch.object(Site, 'apply_results', side_effect=DatabaseError('disk I/O error')), \
+                self.assertLogs('parsing.metrics'):
+            summary = refresh_prices(batch_size=3, parse_func=self.fake_parse,
+                                     photo_func=self.fake_photo)
+        self.assertEqual(summary.saved, 0)
+        self.assertEqual(PriceJob.objects.filter(status=JobStatusEnum.Failed,
+                                                 error='disk I/O error').count(),
+                         len(self.sites))
+        for site_name in ('Wildberries', 'Lamoda'):
+            pages = Site.objects.filter(domain=f'www.{site_name.lower()}.ru').count()
+            # Запись замеряется по классу сайта, ее ошибка - ошибка обработки страницы
+            self.assertGreater(metrics.get_histogram('parsing_stage_seconds', site=site_name,
+                                                     stage='db_write')[1], 0)
+            self.assertEqual(metrics.get_counter('parsing_pages_total',
+                                                 site=site_name, outcome='error'), pages)
+            self.assertEqual(metrics.get_counter('parsing_errors_total',
+                                                 site=site_name, error='DatabaseError'), pages)
+            self.assertEqual(metrics.get_counter('parsing_pages_total',
+                                                 site=site_name, outcome='ok'), 0)
+
+
+class TestPriceOnlyRefresh(MockShopMixin, TransactionTestCase):
+    # Без повторного создания типов содержимого после очистки БД,
+    # иначе они не дадут загрузить фикстуры в следующих тестах
+    available_apps = ['django.contrib.auth', 'django.contrib.contenttypes', 'parsing']
+
+    def setUp(self):
+        self.shop = self.shops[Lamoda]
+        self.site = Site.objects.create(
+            user=User.objects.create(username='admin'),
+            url=self.shop.url_for('https://www.lamoda.ru/p/re160ameeac8/'),
+            photo_path='static/goods_images/img.jpg')
+
+    def test_price_only(self):
+        summary = refresh_prices([self.site.id], price_only=True)
+        self.assertEqual(summary.saved, 1)
+        # Загружена только страница, фото не искалось и не загружалось
+        self.assertEqual(self.shop.requests, 1)
+        self.assertEqual(Price.objects.filter(site=self.site).count(), 1)
+        site = Site.objects.get(id=self.site.id)
+        self.assertEqual(site.photo_path, 'static/goods_images/img.jpg')
+        self.assertEqual(site.photo_url, '')
+
+
+class TestPriceJobQueue(TestCase):
+    fixtures = ['sites.json']
+
+    def setUp(self):
+        self.site = Site.objects.first()
+
+    def test_enqueue_once(self):
+        job = PriceJob.enqueue(self.site.id)
+        self.assertEqual(PriceJob.enqueue(self.site.id), job)
+        self.assertIsNone(PriceJob.enqueue(-1))
+        with self.assertLogs('parsing.helpers', 'WARNING'):
+            self.assertIsNone(enqueue_price_task(-1))
+        self.assertTrue(Site.objects.with_job_state().get(id=self.site.id).is_running)
+
+    def test_dequeue(self):
+        job = PriceJob.enqueue(self.site.id)
+        taken = PriceJob.dequeue('worker-1')
+        self.assertEqual(taken.id, job.id)
+        self.assertEqual(taken.status, JobStatusEnum.Running)
+        self.assertEqual(taken.attempts, 1)
+        self.assertIsNone(PriceJob.dequeue('worker-2'))
+
+    def test_requeue_stale(self):
+        stale_time = timezone.now() - timedelta(seconds=PRICE_JOBS['stale_timeout'] + 1)
+        jobs = []
+        for site in Site.objects.all()[:2]:
+            PriceJob.enqueue(site.id)
+            jobs.append(PriceJob.dequeue('worker-1'))
+        PriceJob.objects.filter(id=jobs[1].id).update(attempts=jobs[1].max_attempts)
+        PriceJob.objects.update(locked_at=stale_time)
+        self.assertEqual(PriceJob.requeue_stale(), 1)
+        requeued, failed = (PriceJob.objects.get(id=job.id) for job in jobs)
+        self.assertEqual(requeued.status, JobStatusEnum.Pending)
+        self.assertEqual(failed.status, JobStatusEnum.Failed)
+        self.assertTrue(failed.error)
+        self.assertIsNotNone(failed.finished_at)
+
+    def test_worker_retries(self):
+        calls = []
+
+        def failing_task(site_id):
+            calls.append(site_id)
+            raise ValueError('Страница не загрузилась')
+
+        job = PriceJob.enqueue(self.site.id)
+        worker = PriceWorker('test', poll_interval=0, task=failing_task)
+        for attempt in range(job.max_attempts):
+            PriceJob.objects.filter(id=job.id).update(run_after=job.created_at)
+            self.assertTrue(worker.run_once())
+        job.refresh_from_db()
+        self.assertEqual(len(calls), job.max_attempts)
+        self.assertEqual(job.status, JobStatusEnum.Failed)
+        self.assertFalse(Site.objects.with_job_state().get(id=self.site.id).is_running)
+
+    def test_worker_fatal_error(self):
+        def missing_page(site_id):
+            raise PageNotOpened('404', retryable=False)
+
+        job = PriceJob.enqueue(self.site.id)
+        PriceWorker('test', poll_interval=0, task=missing_page).run_once()
+        job.refresh_from_db()
+        self.assertEqual(job.attempts, 1)
+        self.assertEqual(job.status, JobStatusEnum.Failed)
+
+    def test_worker_completes(self):
+        PriceJob.enqueue(self.site.id)
+        worker = PriceWorker('test', poll_interval=0, task=lambda site_id: None)
+        self.assertEqual(worker.run(burst=True), 1)
+        self.assertEqual(PriceJob.objects.get().status, JobStatusEnum.Done)
+
+
+class TestSitesListing(TestCase):
+    fixtures = ['sites.json']
+
+    def get_listing(self):
+        with self.assertNumQueries(1):
+            return list(get_sites_and_url_form()['sites'])
+
+    def test_query_count_is_constant(self):
+        sites = self.get_listing()
+        site = Site.objects.get(id=sites[0].id)
+        for i in range(20):
+            new_site = Site.objects.create(user=site.user, url=site.url)
+            Price.add(new_site, 100 + i)
+        self.assertEqual(len(self.get_listing()), len(sites) + 20)
+
+    def test_keyset_pagination(self):
+        ids = list(Site.objects.order_by('id').values_list('id', flat=True))
+        data = get_sites_and_url_form(limit=3)
+        self.assertEqual([s.id for s in data['sites']], ids[:3])
+        self.assertIn(f'after={ids[2]}', data['next_url'])
+        data = get_sites_and_url_form(after=ids[2], limit=3)
+        self.assertEqual([s.id for s in data['sites']], ids[3:6])
+        data = get_sites_and_url_form(after=ids[-2], limit=3)
+        self.assertEqual([s.id for s in data['sites']], ids[-1:])
+        self.assertIsNone(data['next_url'])
+
+    def test_filters(self):
+        data = get_sites_and_url_form(domain='www.lamoda.ru')
+        self.assertTrue(data['sites'])
+        self.assertTrue(all(s.domain == 'www.lamoda.ru' for s in data['sites']))
+        self.assertFalse(get_sites_and_url_form(user=999)['sites'])
+
+    def test_stream(self):
+        self.client.force_login(User.objects.get(username='admin'))
+        response = self.client.get('/show_goods/stream', {'limit': 2})
+        self.assertTrue(response.streaming)
+        content = b''.join(response.streaming_content).decode()
+        self.assertEqual(content.count('<tr>'), Site.objects.count() + 2)
+        self.assertIn('</html>', content)
+
+    def test_last_price(self):
+        site = Site.objects.first()
+        Price.add(site, 4321)
+        listed = {s.id: s for s in self.get_listing()}[site.id]
+        self.assertEqual(listed.price_rub, '4321 руб.')
+        self.assertTrue(listed.is_actual_price)
+        self.assertEqual(site.last_price.price, 4321)
+
+
+class TestBulkIngestion(TestCase):
+    fixtures = ['sites.json']
+
+    def test_apply_results(self):
+        sites = list(Site.objects.order_by('id'))
+        prices_count = Price.objects.count()
+        results = [(site, 1000 + site.id, f'static/goods_images/{site.id}.jpg')
+                   for site in sites]
+        results.append((sites[0], None, None))
+        # В каждой пачке из 4 сайтов: последние цены, новые цены, фото
+        with self.assertNumQueries(15):
+            saved = Site.apply_results(results, batch_size=4)
+        self.assertEqual(saved, len(sites))
+        self.assertEqual(Price.objects.count(), prices_count + len(sites))
+        site = Site.objects.get(id=sites[1].id)
+        self.assertEqual(site.last_price.price, 1000 + site.id)
+        self.assertEqual(site.photo_path, f'static/goods_images/{site.id}.jpg')
+
+    def test_add_price_and_photo(self):
+        site = Site.objects.first()
+        self.assertTrue(site.add_price_and_photo('250', 'static/goods_images/1.jpg'))
+        self.assertEqual(site.last_price.price, 250)
+        self.assertFalse(site.add_price_and_photo(None, 'static/goods_images/1.jpg'))
+
+    def test_unchanged_price(self):
+        site = Site.objects.first()
+        Price.add(site, 300)
+        first = site.last_price
+        prices_count = Price.objects.count()
+        Price.add(site, '300')
+        self.assertEqual(Price.objects.count(), prices_count)
+        last = site.last_price
+        self.assertEqual(last.id, first.id)
+        self.assertGreater(last.valid_until, first.valid_until)
+        self.assertEqual(last.date, first.date)
+        Price.add(site, 350)
+        self.assertNotEqual(site.last_price.id, first.id)
+        self.assertEqual(site.last_price.price, 350)
+
+
+class TestPriceHistory(TestCase):
+    fixtures = ['sites.json']
+
+    def setUp(self):
+        self.site = Site.objects.first()
+        Price.objects.all().delete()
+        self.now = timezone.now().replace(hour=12, minute=0, second=0, microsecond=0)
+
+    def add(self, days_ago, price, hours=0, checked_days=0):
+        date = self.now - timedelta(days=days_ago, hours=hours)
+        Price.objects.create(site=self.site, price=price, date=date,
+                             valid_until=date + timedelta(days=checked_days))
+
+    def compact(self, raw_days, daily_days):
+        return PriceAggregate.compact(self.now - timedelta(days=raw_days),
+                                      self.now - timedelta(days=daily_days))
+
+    def test_daily(self):
+        self.add(40, 100, hours=3)
+        self.add(40, 80, hours=2)
+        self.add(40, 90, hours=1, checked_days=5)
+        self.add(20, 120)
+        self.add(2, 110)
+        self.assertEqual(self.compact(raw_days=10, daily_days=365), (4, 0))
+        # Изменения за последние дни и последняя цена остаются
+        self.assertEqual(list(self.site.get_prices().values_list('price', flat=True)), [110])
+        days = PriceAggregate.objects.filter(site=self.site, period=PricePeriodEnum.Day)
+        self.assertEqual([(a.min_price, a.max_price, a.last_price) for a in days.order_by('start')],
+                         [(80, 100, 90), (120, 120, 120)])
+        first = days.order_by('start').first()
+        self.assertEqual(first.start, PriceAggregate.get_start(self.now - timedelta(days=40),
+                                                               PricePeriodEnum.Day))
+        self.assertEqual(first.valid_until, self.now - timedelta(days=35, hours=1))
+        # Повторное сжатие ничего не меняет
+        self.assertEqual(self.compact(raw_days=10, daily_days=365), (0, 0))
+
+    def test_weekly(self):
+        for days_ago, price in ((70, 200), (69, 150), (68, 180), (30, 170)):
+            self.add(days_ago, price)
+        self.add(1, 160)
+        self.assertEqual(self.compact(raw_days=10, daily_days=20), (4, 4))
+        self.assertFalse(PriceAggregate.objects.filter(period=PricePeriodEnum.Day).exists())
+        weeks = PriceAggregate.objects.filter(period=PricePeriodEnum.Week).order_by('start')
+        self.assertEqual(sum(1 for _ in weeks), len({
+            PriceAggregate.get_start(self.now - timedelta(days=d), PricePeriodEnum.Week)
+            for d in (70, 69, 68, 30)}))
+        self.assertEqual((weeks.last().min_price, weeks.last().last_price), (170, 170))
+        self.assertEqual(min(w.min_price for w in weeks), 150)
+        self.assertEqual(max(w.max_price for w in weeks), 200)
+
+    def test_history_range(self):
+        self.add(10, 100, checked_days=6)
+        self.add(4, 120, checked_days=4)
+        history = self.site.get_price_history(self.now - timedelta(days=5), self.now - timedelta(days=3))
+        # Цена 100 установлена раньше периода, но действовала в нем
+        self.assertEqual([p.price for p in history], [120, 100])
+
+    def test_compacted_history(self):
+        self.add(40, 100, hours=2)
+        self.add(40, 90, hours=1, checked_days=5)
+        self.add(20, 120, checked_days=5)
+        self.add(2, 110, checked_days=2)
+        self.compact(raw_days=10, daily_days=30)
+        history = self.site.get_price_history(self.now - timedelta(days=45), self.now)
+        self.assertEqual([type(p) for p in history], [Price, PriceAggregate, PriceAggregate])
+        self.assertEqual([p.price for p in history], [110, 120, 90])
+        self.assertEqual([p.period for p in history[1:]], [PricePeriodEnum.Day, PricePeriodEnum.Week])
+        self.assertEqual((history[-1].min_price, history[-1].max_price), (90, 100))
+        # Период, полностью покрытый записями Price, не требует сводок
+        with self.assertNumQueries(1):
+            recent = self.site.get_price_history(self.now - timedelta(days=1), self.now)
+        self.assertEqual([p.price for p in recent], [110])
+
+    def test_command(self):
+        self.add(200, 100)
+        self.add(1, 110)
+        out = io.StringIO()
+        call_command('compact_prices', stdout=out)
+        self.assertIn('по дням: 1;', out.getvalue())
+        self.assertEqual(PriceAggregate.objects.filter(site=self.site).count(), 1)
+        self.assertEqual(Price.objects.filter(site=self.site).count(), 1)
+
+
+class ConditionalPageHandler(BaseHTTPRequestHandler):
+    """Страница с ETag, на совпадающий If-None-Match отвечает 304"""
+
+    protocol_version = 'HTTP/1.1'
+    etag = '"v1"'
+    body = '<html><body><span class="final-cost">1 500 ₽</span></body></html>'.encode()
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(dict(self.headers))
+        if self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', self.etag)
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+class QuietHTTPServer(ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        # Клиент может прервать загрузку, например, из-за ограничения размера
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class LocalServerMixin:
+    """Запускает локальный HTTP-сервер с обработчиком handler_class"""
+
+    handler_class = None
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = QuietHTTPServer(('127.0.0.1', 0), cls.handler_class)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = f'http://127.0.0.1:{cls.server.server_port}'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+
+class TestConditionalRequests(LocalServerMixin, SimpleTestCase):
+    handler_class = ConditionalPageHandler
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.url = f'{cls.base_url}/item'
+
+    def open(self, validators=None):
+        parser = RequestsPageParser(self.url, validators)
+        parser.open()
+        return parser
+
+    def test_not_modified(self):
+        first = self.open()
+        self.assertFalse(first.not_modified)
+        self.assertEqual(first.validators.etag, '"v1"')
+        second = self.open(first.validators)
+        self.assertTrue(second.not_modified)
+        self.assertEqual(ConditionalPageHandler.requests[-1]['If-None-Match'], '"v1"')
+
+    def test_same_content_hash(self):
+        first = self.open()
+        validators = Validators('', '', first.validators.content_hash)
+        self.assertTrue(self.open(validators).not_modified)
+        changed = Validators('', '', 'other')
+        self.assertFalse(self.open(changed).not_modified)
+
+    def test_connection_reuse(self):
+        client = HttpClient(pool_maxsize=2)
+        for _ in range(3):
+            self.assertEqual(client.get(self.url).status_code, 200)
+        host = f'127.0.0.1:{self.server.server_port}'
+        stats = client.stats()[host]
+        self.assertEqual(stats['requests'], 3)
+        self.assertEqual(stats['connections'], 1)
+        self.assertEqual(stats['idle'], 1)
+        client.close()
+
+
+def make_image(width=1200, height=900, img_format='JPEG'):
+    buffer = io.BytesIO()
+    Image.effect_noise((width, height), 64).convert('RGB').save(buffer, img_format)
+    return buffer.getvalue()
+
+
+class ImageHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    image = make_image()
+
+    def do_GET(self):
+        if 'etag' in self.path and self.headers.get('If-None-Match') == '"img"':
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(self.image)))
+        self.send_header('ETag', '"img"' if 'etag' in self.path else '')
+        self.end_headers()
+        self.wfile.write(self.image)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestImageStore(LocalServerMixin, TestCase):
+    handler_class = ImageHandler
+    fixtures = ['sites.json']
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        patcher = mock.patch.object(PhotoDownloader, 'store', ImageStore(self.root))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def files(self):
+        return list(PhotoDownloader.store.iter_files())
+
+    def test_deduplication(self):
+        success, first = PhotoDownloader(f'{self.base_url}/a/1.jpg').download()
+        self.assertTrue(success)
+        self.assertTrue(first.startswith(self.root))
+        _, second = PhotoDownloader(f'{self.base_url}/a/1.jpg').download()
+        _, third = PhotoDownloader(f'{self.base_url}/b/etag.jpg').download()
+        self.assertEqual(first, second)
+        self.assertEqual(first, third)
+        self.assertEqual(sorted(self.files()),
+                         sorted([first] + Thumbnails().get_paths(first)))
+        with open(first, 'rb') as f:
+            self.assertEqual(f.read(), ImageHandler.image)
+
+    def test_size_limit(self):
+        PhotoDownloader.store.max_size = 1024
+        success, photo = PhotoDownloader(f'{self.base_url}/1.jpg').download()
+        self.assertFalse(success)
+        self.assertEqual(photo, DEFAULT_IMG_PATH)
+        self.assertEqual(self.files(), [])
+
+    def test_garbage_collection(self):
+        _, used = PhotoDownloader(f'{self.base_url}/1.jpg').download()
+        unused = os.path.join(self.root, 'img_1.jpg')
+        with open(unused, 'wb') as f:
+            f.write(b'1')
+        Site.objects.filter(id=Site.objects.first().id).update(photo_path=used)
+        call_command('gc_images', min_age=0, stdout=io.StringIO())
+        self.assertEqual(sorted(self.files()),
+                         sorted([used] + Thumbnails().get_paths(used)))
+
+    def test_thumbnails(self):
+        _, photo = PhotoDownloader(f'{self.base_url}/1.jpg').download()
+        thumbnails = Thumbnails()
+        small = thumbnails.get(photo, made=True)['small']
+        self.assertIn('webp', small)
+        with Image.open(small['webp']) as image:
+            self.assertEqual(image.size, (107, 80))
+        self.assertLess(os.path.getsize(small['jpeg']), len(ImageHandler.image) / 10)
+        self.assertEqual(thumbnails.get(DEFAULT_IMG_PATH, made=False)['small'],
+                         {'jpeg': DEFAULT_IMG_PATH})
+
+    def remove_thumbnails(self, photo):
+        for path in Thumbnails().get_paths(photo):
+            os.remove(path)
+
+    def test_thumbnails_not_modified(self):
+        url = f'{self.base_url}/etag.jpg'
+        _, photo = PhotoDownloader(url).download()
+        self.remove_thumbnails(photo)
+        # Изображение не изменилось (304), недостающие копии создаются заново
+        self.assertEqual(PhotoDownloader(url).download(), (True, photo))
+        self.assertTrue(Thumbnails().exist(photo))
+
+    def test_make_thumbnails_command(self):
+        _, photo = PhotoDownloader(f'{self.base_url}/1.jpg').download()
+        self.remove_thumbnails(photo)
+        site, missing = Site.objects.all()[:2]
+        Site.objects.filter(id=site.id).update(photo_path=photo)
+        Site.objects.filter(id=missing.id).update(photo_path=os.path.join(self.root, 'no.jpg'))
+        call_command('make_thumbnails', stdout=io.StringIO())
+        self.assertTrue(Thumbnails().exist(photo))
+        self.assertTrue(Site.objects.get(id=site.id).has_thumbnails)
+        self.assertFalse(Site.objects.get(id=missing.id).has_thumbnails)
+
+
+class TestImageStoreConcurrency(SimpleTestCase):
+    def test_parallel_saves(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        store = ImageStore(root)
+        images = [os.urandom(64 * 1024) for _ in range(8)]
+
+        def save(i):
+            image = images[i % len(images)]
+            chunks = (image[j:j + 4096] for j in range(0, len(image), 4096))
+            return store.save(chunks, 'jpg')
+
+        with ThreadPoolExecutor(16) as executor:
+            results = list(executor.map(save, range(200)))
+        paths = {path for _, path in results}
+        self.assertEqual(len(paths), len(images))
+        self.assertEqual(sorted(store.iter_files()), sorted(paths))
+        for content_hash, path in results:
+            with open(path, 'rb') as f:
+                self.assertEqual(hashlib.sha256(f.read()).hexdigest(), content_hash)
+
+
+class TestSiteRegistry(TestCase):
+    def test_lookup(self):
+        for url in ('https://www.wildberries.ru/catalog/1/detail.aspx',
+                    'https://wildberries.ru/catalog/1/detail.aspx',
+                    'https://m.wildberries.ru/catalog/1/',
+                    'https://WWW.Wildberries.RU:443/catalog/1/',
+                    'https://msk.wildberries.ru/catalog/1/'):
+            self.assertIs(SiteParsing.get_site_class(url), Wildberries, url)
+        self.assertIsInstance(SiteParsing.get_site('https://www.lamoda.ru/p/1/'), Lamoda)
+
+    def test_unsupported(self):
+        for url in ('https://www.ozon.ru/product/1/', 'https://ru/', 'not a url'):
+            self.assertFalse(SiteParsing.is_supported(url))
+            with self.assertRaises(UnsupportedSite):
+                SiteParsing.get_site(url)
+
+    def test_subclass_registration(self):
+        class Shop(Wildberries):
+            main_url = 'http://localhost:8000/'
+            aliases = ('shop.example.com',)
+
+        self.addCleanup(SiteParsing.registry.pop, 'localhost:8000')
+        self.addCleanup(SiteParsing.registry.pop, 'shop.example.com')
+        self.assertIs(SiteParsing.get_site_class('http://localhost:8000/p/1'), Shop)
+        self.assertIs(SiteParsing.get_site_class('https://www.shop.example.com/p/1'), Shop)
+
+
+class TestShopConfig(TestCase):
+    html = """
+    <html><body>
+        <div class="price"><b>Старая цена 900 ₽</b></div>
+        <div class="price"><b>750 ₽</b></div>
+        <a id="photo" href="/img/1.png">Фото</a>
+    </body></html>
+    """.encode('utf-8')
+
+    def setUp(self):
+        self.config = ShopConfig.objects.create(
+            name='Ozon', main_url='https://www.ozon.ru/', aliases='ozon.by',
+            price_src='[["xpath", "//div[@class=\'missing\']"], ["class_", "price"]]',
+            photo_src='[["id", "photo"]]', price_index=1, photo_attribute='href')
+        # Откат транзакции теста не вызывает сигналов, кеш сбрасывается явно
+        self.addCleanup(ShopConfig.invalidate)
+
+    def test_lookup_and_processing(self):
+        site = SiteParsing.get_site('https://ozon.by/product/1/')
+        self.assertEqual(site.config_id, self.config.id)
+        parser = RequestsPageParser(site.url)
+        parser.load_html(self.html)
+        self.assertEqual(site.process_price_element(
+            parser.get_page_elem(site.price_src)), '750')
+        photo = parser.get_page_elem(site.photo_src)
+        self.assertEqual(photo.get_attribute(site.photo_attribute),
+                         'https://ozon.by/img/1.png')
+
+    def test_compiled_once(self):
+        first = SiteParsing.get_site_class('https://www.ozon.ru/product/1/')
+        with self.assertNumQueries(0):
+            second = SiteParsing.get_site_class('https://www.ozon.ru/product/2/')
+        self.assertIs(first, second)
+
+    def test_invalidation(self):
+        first = SiteParsing.get_site_class('https://www.ozon.ru/product/1/')
+        self.config.price_index = 0
+        self.config.save()
+        second = SiteParsing.get_site_class('https://www.ozon.ru/product/1/')
+        self.assertIsNot(first, second)
+        self.assertEqual(second.price_index, 0)
+        self.config.delete()
+        self.assertFalse(SiteParsing.is_supported('https://www.ozon.ru/product/1/'))
+
+    def test_selector_timeout(self):
+        selectors = ShopConfig.parse_selectors('[["id", "price", 2], ["class_", "cost"]]')
+        self.assertEqual([s.timeout for s in selectors], [2, None])
+
+    def test_validation(self):
+        self.config.price_src = '[["css", ".price"]]'
+        with self.assertRaises(ValidationError):
+            self.config.full_clean()
+        self.config.price_src = '[["xpath", "//div["]]'
+        with self.assertRaises(ValidationError):
+            self.config.full_clean()
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class TestThrottle(SimpleTestCase):
+    limits = {'default': {'rps': 2, 'burst': 2},
+              'slow.test': {'rps': 0.5, 'burst': 1, 'respect_robots': True}}
+    backoff = {'min_factor': 0.25, 'recovery': 0.5, 'max_retry_after': 60}
+
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def get_scheduler(self, **kwargs):
+        return DomainScheduler(self.limits, self.backoff, clock=self.clock,
+                               sleep=self.clock.sleep, **kwargs)
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=2, burst=2, clock=self.clock)
+        self.assertEqual([bucket.reserve() for _ in range(4)], [0, 0, 0.5, 1.0])
+        self.clock.now = 10
+        self.assertEqual(bucket.reserve(), 0)
+
+    def test_rate_per_domain(self):
+        scheduler = self.get_scheduler()
+        for _ in range(10):
+            scheduler.acquire('https://a.test/p/1')
+        # 2 запроса сразу, остальные 8 - с частотой 2 запр./сек.
+        self.assertEqual(self.clock.now, 4)
+        self.assertEqual(scheduler.reserve('https://b.test/'), 0)
+
+    def test_backoff(self):
+        scheduler = self.get_scheduler()
+        scheduler.acquire('https://a.test/')
+        scheduler.report('https://a.test/', 429, retry_after='30')
+        self.assertEqual(scheduler.buckets['a.test'].rate, 1)
+        self.assertGreaterEqual(scheduler.reserve('https://a.test/'), 30)
+        scheduler.report('https://a.test/', 503, retry_after='Wed, 21 Oct 2015 07:28:00 GMT')
+        scheduler.report('https://a.test/', 503)
+        self.assertEqual(scheduler.buckets['a.test'].rate, 0.5)
+        scheduler.report('https://a.test/', 200)
+        scheduler.report('https://a.test/', 200)
+        self.assertEqual(scheduler.buckets['a.test'].rate, 2)
+        # Таймаут без кода ответа снижает частоту так же, как 503
+        scheduler.report_timeout('https://a.test/')
+        self.assertEqual(scheduler.buckets['a.test'].rate, 1)
+
+    def test_robots_crawl_delay(self):
+        fetched = []
+
+        def fetch(url):
+            fetched.append(url)
+            return 'User-agent: *\nCrawl-delay: 10\n'
+
+        scheduler = self.get_scheduler(robots_fetcher=fetch)
+        scheduler.acquire('https://slow.test/p/1')
+        scheduler.acquire('https://slow.test/p/2')
+        scheduler.acquire('https://a.test/p/1')
+        self.assertEqual(fetched, ['https://slow.test/robots.txt'])
+        self.assertEqual(self.clock.now, 10)
+
+    def test_interleave_by_domain(self):
+        urls = ['https://a.test/1', 'https://a.test/2', 'https://b.test/1',
+                'https://c.test/1', 'https://b.test/2']
+        self.assertEqual(interleave_by_domain(urls, lambda url: url),
+                         ['https://a.test/1', 'https://b.test/1', 'https://c.test/1',
+                          'https://a.test/2', 'https://b.test/2'])
+
+
+class FlakyPageHandler(BaseHTTPRequestHandler):
+    """/gone - 404, /flaky - 503 на первые два запроса, затем страница"""
+
+    protocol_version = 'HTTP/1.1'
+    counter = Counter()
+
+    def do_GET(self):
+        self.counter[self.path] += 1
+        status = 200
+        if self.path == '/gone':
+            status = 404
+        elif self.path == '/flaky' and self.counter[self.path] <= 2:
+            status = 503
+        body = ConditionalPageHandler.body if status == 200 else b'error'
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestRetry(LocalServerMixin, SimpleTestCase):
+    handler_class = FlakyPageHandler
+
+    def setUp(self):
+        FlakyPageHandler.counter.clear()
+        self.clock = FakeClock()
+        self.retrier = Retrier(attempts=3, base_delay=1, max_delay=4, budget_ratio=0.5,
+                               budget_max=2, failure_threshold=2, reset_timeout=60,
+                               clock=self.clock, sleep=self.clock.sleep)
+        scheduler = DomainScheduler(clock=self.clock, sleep=self.clock.sleep)
+        for target, value in (('parsing.parsers.get_retrier', self.retrier),
+                              ('parsing.http.get_scheduler', scheduler)):
+            patcher = mock.patch(target, return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def open(self, path):
+        parser = RequestsPageParser(f'{self.base_url}{path}')
+        parser.open()
+        return parser
+
+    def test_retryable_error(self):
+        parser = self.open('/flaky')
+        self.assertEqual(parser.response.status_code, 200)
+        self.assertEqual(FlakyPageHandler.counter['/flaky'], 3)
+        # Задержки повторов (не больше 1 и 2 сек.) и паузы планировщика
+        self.assertLessEqual(self.clock.now, 5)
+
+    def test_fatal_error(self):
+        with self.assertRaises(PageNotOpened) as cm:
+            self.open('/gone')
+        self.assertFalse(cm.exception.retryable)
+        self.assertEqual(FlakyPageHandler.counter['/gone'], 1)
+        # Отсутствующая страница не говорит о проблеме с сайтом
+        for _ in range(3):
+            with self.assertRaises(PageNotOpened):
+                self.open('/gone')
+        self.assertEqual(self.open('/item').response.status_code, 200)
+
+    def test_dns_error(self):
+        error = requests.ConnectionError(
+            urllib3.exceptions.MaxRetryError(None, '/', urllib3.exceptions.NewConnectionError(
+                None, 'Failed to establish a new connection')))
+        error.args[0].reason.__context__ = socket.gaierror(-2, 'Name or service not known')
+        self.assertFalse(is_retryable(error))
+        self.assertTrue(is_retryable(requests.Timeout()))
+
+    def test_retry_budget(self):
+        budget = RetryBudget(ratio=0.5, max_tokens=2)
+        self.assertTrue(budget.withdraw())
+        self.assertTrue(budget.withdraw())
+        self.assertFalse(budget.withdraw())
+        budget.deposit()
+        budget.deposit()
+        self.assertTrue(budget.withdraw())
+
+    def test_circuit_breaker(self):
+        FlakyPageHandler.counter['/flaky'] = -10
+        for _ in range(2):
+            with self.assertRaises(PageNotOpened) as cm:
+                self.open('/flaky')
+            self.assertTrue(cm.exception.retryable)
+        requests_sent = FlakyPageHandler.counter['/flaky']
+        # Бюджет повторов исчерпан: 3 попытки, затем 1 + 1 (пополнение за успехи нет)
+        self.assertEqual(requests_sent, -10 + 4)
+        with self.assertRaises(CircuitOpen):
+            self.open('/item')
+        self.assertEqual(FlakyPageHandler.counter['/item'], 0)
+        self.clock.now += 60
+        FlakyPageHandler.counter['/flaky'] = 10
+        self.assertEqual(self.open('/flaky').response.status_code, 200)
+        self.assertEqual(self.open('/item').response.status_code, 200)
+
+    def test_half_open_failure(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10, clock=self.clock)
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+        self.clock.now = 10
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+
+    def test_half_open_on_error_fails(self):
+        retrier = Retrier(attempts=3, base_delay=1, max_delay=4, budget_ratio=0.5,
+                          budget_max=10, failure_threshold=1, reset_timeout=60,
+                          clock=self.clock, sleep=self.clock.sleep)
+        url = 'https://www.lamoda.ru/p/1/'
+
+        def timeout():
+            raise requests.Timeout('Сайт не отвечает')
+
+        def no_session(error):
+            raise WebDriverPoolTimeout('Нет свободной сессии')
+
+        with self.assertRaises(PageNotOpened):
+            retrier.call(url, timeout)
+        self.clock.now += 61
+        # Пробная загрузка прервана ошибкой в on_error: прерыватель снова
+        # размыкается, а не остается в состоянии пробной загрузки
+        with self.assertRaises(WebDriverPoolTimeout):
+            retrier.call(url, timeout, on_error=no_session)
+        with self.assertRaises(CircuitOpen):
+            retrier.call(url, lambda: 'ok')
+        self.clock.now += 61
+        self.assertEqual(retrier.call(url, lambda: 'ok'), 'ok')
+
+
+class TestMetrics(MockShopMixin, TestCase):
+    def setUp(self):
+        metrics.reset()
+
+    def test_parse_stages(self):
+        url = self.get_url('https://www.lamoda.ru/p/re160ameeac8/')
+        with self.assertLogs('parsing.metrics') as logs:
+            price, photo = Parsing(url).parse_data()
+        self.assertIsNotNone(price)
+        self.assertEqual(metrics.get_counter('parsing_pages_total',
+                                             site='MockLamoda', outcome='ok'), 1)
+        for stage_name in ('open', 'lookup'):
+            total, count = metrics.get_histogram('parsing_stage_seconds',
+                                                 site='MockLamoda', stage=stage_name)
+            self.assertEqual(count, 1, stage_name)
+        # Фото загружается после освобождения страницы
+        self.assertEqual(metrics.get_histogram('parsing_stage_seconds',
+                                               site='MockLamoda', stage='download')[1], 1)
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(record['outcome'], 'ok')
+        self.assertEqual(set(record['stages']), {'open', 'lookup'})
+
+    def test_errors_and_nested_stages(self):
+        with self.assertRaises(ValueError), self.assertLogs('parsing.metrics'):
+            with trace_page('Shop', 'https://shop.test/'):
+                with stage('photo'):
+                    with stage('download'):
+                        time.sleep(0.02)
+                raise ValueError
+        photo, _ = metrics.get_histogram('parsing_stage_seconds', site='Shop', stage='photo')
+        download, _ = metrics.get_histogram('parsing_stage_seconds', site='Shop', stage='download')
+        self.assertLess(photo, 0.01)
+        self.assertGreaterEqual(download, 0.02)
+        self.assertEqual(metrics.get_counter('parsing_errors_total',
+                                             site='Shop', error='ValueError'), 1)
+        self.assertEqual(metrics.get_counter('parsing_pages_total',
+                                             site='Shop', outcome='error'), 1)
+
+    def test_update_write_error(self):
+        site = Site.objects.create(user=User.objects.create(username='shop'),
+                                   url=self.get_url('https://www.lamoda.ru/p/re160ameeac8/'))
+        with mock.patch.object(Site, 'apply_results', side_effect=DatabaseError('disk I/O error')), \
+                self.assertLogs('parsing.metrics') as logs, self.assertRaises(DatabaseError):
+            update_site_price(site.id)
+        self.assertEqual(metrics.get_counter('parsing_pages_total',
+                                             site='MockLamoda', outcome='error'), 1)
+        self.assertEqual(metrics.get_counter('parsing_pages_total',
+                                             site='MockLamoda', outcome='ok'), 0)
+        self.assertEqual(metrics.get_histogram('parsing_stage_seconds', site='MockLamoda',
+                                               stage='db_write')[1], 1)
+        record = json.loads(logs.records[-1].getMessage())
+        self.assertEqual(set(record['stages']), {'open', 'lookup', 'db_write'})
+
+    def test_view(self):
+        with stage('db_write', site='Shop'):
+            pass
+        metrics.inc('parsing_pages_total', site='Shop', outcome='ok')
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        text = response.content.decode()
+        self.assertIn('# TYPE parsing_stage_seconds histogram', text)
+        self.assertIn('parsing_stage_seconds_bucket{site="Shop",stage="db_write",le="+Inf"} 1', text)
+        self.assertIn('parsing_pages_total{outcome="ok",site="Shop"} 1.0', text)
+        response = self.client.get('/metrics', REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(response.status_code, 403)
+
+
+class TestImportTime(SimpleTestCase):
+    """Запуск веб-приложения не должен загружать библиотеки парсинга"""
+
+    heavy_modules = {'selenium', 'selenium.webdriver', 'bs4', 'requests', 'lxml', 'PIL'}
+    # Необязательная проверка времени импорта URL-конфигурации (сек.)
+    budget = os.environ.get('PARSING_IMPORT_BUDGET')
+
+    def import_web_app(self):
+        """Импортирует приложение в отдельном процессе с -X importtime и
+        получает пути копий изображения, как при выводе списка товаров
+        :return: Загруженные модули и {модуль: суммарное время импорта (сек.)}
+        """
+        code = ('import django, json, sys; django.setup(); import config.urls; '
+                'from parsing.images import thumbnails; '
+                'thumbnails.get("static/goods_images/img.jpg", made=True); '
+                'print(json.dumps(sorted(sys.modules)))')
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE='config.settings')
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                                cwd=settings.BASE_DIR, env=env, capture_output=True,
+                                text=True, check=True)
+        times = {}
+        for line in result.stderr.splitlines():
+            if not line.startswith('import time:') or '|' not in line:
+                continue
+            _, cumulative, name = line.split('|')
+            if cumulative.strip().isdigit():
+                times[name.strip()] = int(cumulative) / 10 ** 6
+        return set(json.loads(result.stdout)), times
+
+    def test_web_app_imports(self):
+        modules, times = self.import_web_app()
+        self.assertIn('parsing.views', modules)
+        self.assertFalse(modules & self.heavy_modules)
+        if self.budget:
+            self.assertLess(times['config.urls'], float(self.budget))
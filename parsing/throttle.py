@@ -0,0 +1,187 @@
+import threading
+import time
+from collections import defaultdict, deque
+from urllib import robotparser
+from urllib.parse import urlparse
+
+from config.settings import RATE_LIMITS, RATE_LIMIT_BACKOFF
+
+
+class TokenBucket:
+    """Ограничение частоты запросов: rate запросов в секунду в среднем
+    и не более burst запросов подряд.
+
+    Токен резервируется сразу, а вызывающему возвращается время ожидания,
+    поэтому одновременные запросы выстраиваются в очередь без опроса.
+    """
+
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = burst
+        self.updated = clock()
+
+    def reserve(self):
+        """Резервирует токен и возвращает время ожидания (сек.)"""
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return max(0, -self.tokens / self.rate)
+
+
+class DomainScheduler:
+    """Планировщик запросов к сайтам с отдельным ограничением частоты для
+    каждого домена (RATE_LIMITS).
+
+    При ответах 429 и 503 частота для домена уменьшается вдвое (и, если
+    указан Retry-After, запросы приостанавливаются на это время), после
+    успешных ответов постепенно восстанавливается. При respect_robots
+    частота дополнительно ограничивается Crawl-delay из robots.txt.
+    """
+
+    throttling_statuses = (429, 503)
+
+    def __init__(self, limits=RATE_LIMITS, backoff=RATE_LIMIT_BACKOFF,
+                 clock=time.monotonic, sleep=time.sleep, robots_fetcher=None):
+        """
+        :param limits: Ограничения по доменам и ограничение по умолчанию ('default')
+        :param backoff: Параметры снижения и восстановления частоты
+        :param robots_fetcher: Функция url -> текст robots.txt или None
+        """
+        self.limits = limits
+        self.backoff = backoff
+        self.clock = clock
+        self.sleep = sleep
+        self.robots_fetcher = robots_fetcher
+        self.buckets = {}
+        self.base_rates = {}
+        self.factors = defaultdict(lambda: 1.0)
+        self.paused_until = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_netloc(url):
+        return urlparse(url).netloc.lower()
+
+    def get_limit(self, netloc):
+        return self.limits.get(netloc, self.limits['default'])
+
+    def get_robots_rate(self, url):
+        """Частота по Crawl-delay из robots.txt, None - если ограничения нет"""
+        if not (self.robots_fetcher and self.get_limit(self.get_netloc(url)).get('respect_robots')):
+            return None
+        parsed = urlparse(url)
+        try:
+            text = self.robots_fetcher(f'{parsed.scheme}://{parsed.netloc}/robots.txt')
+        except Exception as e:
+            print(f'Не удалось загрузить robots.txt для {parsed.netloc}: {e}')
+            return None
+        if not text:
+            return None
+        parser = robotparser.RobotFileParser()
+        parser.parse(text.splitlines())
+        delay = parser.crawl_delay('*')
+        return 1 / float(delay) if delay else None
+
+    def _get_bucket(self, netloc, robots_rate):
+        bucket = self.buckets.get(netloc)
+        if bucket is None:
+            limit = self.get_limit(netloc)
+            rate = limit['rps'] if robots_rate is None else min(limit['rps'], robots_rate)
+            bucket = TokenBucket(rate, limit['burst'], self.clock)
+            self.buckets[netloc] = bucket
+            self.base_rates[netloc] = rate
+        return bucket
+
+    def reserve(self, url):
+        """Резервирует запрос к домену и возвращает время ожидания (сек.)"""
+        netloc = self.get_netloc(url)
+        robots_rate = None
+        if netloc not in self.buckets:
+            robots_rate = self.get_robots_rate(url)
+        with self._lock:
+            delay = self._get_bucket(netloc, robots_rate).reserve()
+            paused = self.paused_until.get(netloc, 0) - self.clock()
+            return max(delay, paused)
+
+    def acquire(self, url):
+        """Ожидает, пока запрос к домену станет разрешен"""
+        delay = self.reserve(url)
+        if delay > 0:
+            self.sleep(delay)
+
+    def report(self, url, status_code, retry_after=None):
+        """Учитывает ответ сайта для адаптивного изменения частоты"""
+        netloc = self.get_netloc(url)
+        with self._lock:
+            if netloc not in self.buckets:
+                return
+            if status_code in self.throttling_statuses:
+                pause = self.parse_retry_after(retry_after)
+                if pause:
+                    self.paused_until[netloc] = self.clock() + pause
+                self._slow_down(netloc, f'ограничивает запросы ({status_code})')
+            elif status_code < 400:
+                self._set_factor(netloc, min(1.0, self.factors[netloc] + self.backoff['recovery']))
+
+    def report_timeout(self, url):
+        """Сайт не ответил за отведенное время (код ответа неизвестен):
+        частота снижается так же, как при ответе 503"""
+        netloc = self.get_netloc(url)
+        with self._lock:
+            if netloc in self.buckets:
+                self._slow_down(netloc, 'не отвечает')
+
+    def _slow_down(self, netloc, reason):
+        """Вызывается под блокировкой"""
+        factor = max(self.backoff['min_factor'], self.factors[netloc] / 2)
+        self._set_factor(netloc, factor)
+        print(f'Сайт {netloc} {reason}, '
+              f'частота снижена до {self.base_rates[netloc] * factor:.2f} запр./сек.')
+
+    def _set_factor(self, netloc, factor):
+        self.factors[netloc] = factor
+        self.buckets[netloc].rate = self.base_rates[netloc] * factor
+
+    def parse_retry_after(self, value):
+        """Retry-After в секундах (формат с датой не поддерживается)"""
+        try:
+            return min(float(value), self.backoff['max_retry_after'])
+        except (TypeError, ValueError):
+            return None
+
+
+def interleave_by_domain(items, get_url):
+    """Переставляет элементы так, чтобы домены чередовались:
+    a1 a2 b1 c1 b2 -> a1 b1 c1 a2 b2"""
+    queues = defaultdict(deque)
+    for item in items:
+        queues[DomainScheduler.get_netloc(get_url(item))].append(item)
+    result = []
+    while queues:
+        for netloc in list(queues):
+            result.append(queues[netloc].popleft())
+            if not queues[netloc]:
+                del queues[netloc]
+    return result
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def fetch_robots(url):
+    from .http import get_http_client
+    response = get_http_client().get(url, throttle=False)
+    return response.text if response.status_code == 200 else None
+
+
+def get_scheduler():
+    """Общий для процесса планировщик запросов"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = DomainScheduler(robots_fetcher=fetch_robots)
+        return _scheduler
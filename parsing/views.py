@@ -1,7 +1,11 @@
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseForbidden, HttpResponseRedirect, StreamingHttpResponse
+from django.middleware.csrf import get_token
 from django.shortcuts import render, redirect
 
-from .helpers import add_message_to_context, get_sites_and_url_form, add_link, delete_site, price_task
+from .helpers import add_message_to_context, get_sites_and_url_form, add_link, delete_site, enqueue_price_task, \
+    stream_goods
+from config.settings import METRICS_ALLOWED_IPS
+from .metrics import metrics
 from . import forms
 
 
@@ -10,10 +14,20 @@ def index(request):
 
 
 def show_goods(request, *args, **kwargs):
-    data = get_sites_and_url_form()
+    params = forms.GoodsListForm(request.GET).get_params()
+    data = get_sites_and_url_form(**params)
     return render(request, 'show_goods.html', context=data)
 
 
+def show_goods_stream(request):
+    params = forms.GoodsListForm(request.GET).get_params()
+    # Токен нужно получить до начала ответа, иначе cookie не будет установлена
+    get_token(request)
+    return StreamingHttpResponse(
+        stream_goods(request, params['user'], params['domain'], params['limit']),
+        content_type='text/html; charset=utf-8')
+
+
 def add_ref(request):
     data = {'form': forms.LinkForm()}
     return render(request, 'add_ref.html', context=data)
@@ -32,5 +46,13 @@ def delete_link(request, site_id):
         return redirect('/show_goods')
 
 def run_price_task(request, site_id):
-    price_task(site_id)
-    return redirect('/show_goods')
\ No newline at end of file
+    enqueue_price_task(site_id)
+    return redirect('/show_goods')
+
+
+def metrics_view(request):
+    """Метрики обработки страниц в формате Prometheus"""
+    if request.META.get('REMOTE_ADDR') not in METRICS_ALLOWED_IPS:
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.render(),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,163 @@
+import threading
+import time
+from collections import deque
+
+from .exceptions import WebDriverPoolTimeout
+
+
+class PooledDriver:
+    """Сессия WebDriver, выданная пулом, со счетчиком использований"""
+
+    def __init__(self, driver):
+        self.driver = driver
+        self.uses = 0
+        self.created_at = self.last_used = time.monotonic()
+
+
+class WebDriverPool:
+    """Пул переиспользуемых сессий WebDriver.
+
+    Хранит не более size запущенных браузеров. Перед выдачей сессия
+    проверяется на работоспособность, после max_uses использований
+    сессия пересоздается, простаивающие дольше idle_timeout секунд
+    сессии закрываются.
+    """
+
+    def __init__(self, factory, size=2, max_uses=50, idle_timeout=300,
+                 acquire_timeout=None):
+        """
+        :param factory: Функция без аргументов, создающая новый WebDriver
+        :param size: Максимальное количество одновременно запущенных сессий
+        :param max_uses: Количество использований сессии до пересоздания
+        :param idle_timeout: Время простоя (сек.), после которого сессия закрывается
+        :param acquire_timeout: Время ожидания свободной сессии (сек.), None - без ограничения
+        """
+        self.factory = factory
+        self.size = size
+        self.max_uses = max_uses
+        self.idle_timeout = idle_timeout
+        self.acquire_timeout = acquire_timeout
+        self._idle = deque()
+        self._live = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    @property
+    def live(self):
+        """Количество запущенных сессий (свободных и выданных)"""
+        return self._live
+
+    @property
+    def idle(self):
+        """Количество свободных сессий"""
+        return len(self._idle)
+
+    @staticmethod
+    def is_healthy(item):
+        """Проверка, что браузер отвечает на команды"""
+        try:
+            item.driver.current_url
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _quit(item):
+        try:
+            item.driver.quit()
+        except Exception as e:
+            print(f'Не удалось закрыть сессию WebDriver: {e}')
+
+    def _pop_expired(self):
+        """Убирает из очереди простаивающие сессии. Вызывается под блокировкой"""
+        now = time.monotonic()
+        expired = [item for item in self._idle
+                   if now - item.last_used > self.idle_timeout]
+        for item in expired:
+            self._idle.remove(item)
+            self._live -= 1
+        return expired
+
+    def evict_idle(self):
+        """Закрывает сессии, простаивающие дольше idle_timeout"""
+        with self._cond:
+            expired = self._pop_expired()
+            if expired:
+                self._cond.notify_all()
+        for item in expired:
+            self._quit(item)
+        return len(expired)
+
+    def _checkout(self, deadline):
+        """Возвращает свободную сессию или None, если нужно создать новую"""
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise RuntimeError('Пул WebDriver закрыт')
+                expired = self._pop_expired()
+                if self._idle:
+                    item = self._idle.pop()
+                    break
+                if self._live < self.size:
+                    self._live += 1
+                    item = None
+                    break
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise WebDriverPoolTimeout(
+                        'Не удалось получить сессию WebDriver из пула')
+                self._cond.wait(remaining)
+        for expired_item in expired:
+            self._quit(expired_item)
+        return item
+
+    def acquire(self, timeout=None):
+        """Выдает рабочую сессию из пула, при необходимости создавая новую
+        :raise: WebDriverPoolTimeout
+        """
+        timeout = self.acquire_timeout if timeout is None else timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            item = self._checkout(deadline)
+            if item is None:
+                try:
+                    return PooledDriver(self.factory())
+                except Exception:
+                    self._discard_slot()
+                    raise
+            if self.is_healthy(item):
+                return item
+            print('Сессия WebDriver не отвечает и будет пересоздана')
+            self._quit(item)
+            self._discard_slot()
+
+    def _discard_slot(self):
+        with self._cond:
+            self._live -= 1
+            self._cond.notify()
+
+    def release(self, item, broken=False):
+        """Возвращает сессию в пул. Сломанные и исчерпавшие лимит
+        использований сессии закрываются"""
+        item.uses += 1
+        item.last_used = time.monotonic()
+        recycle = broken or self._closed or item.uses >= self.max_uses
+        if recycle:
+            self._quit(item)
+            self._discard_slot()
+            return
+        with self._cond:
+            self._idle.append(item)
+            self._cond.notify()
+
+    def close(self):
+        """Закрывает все свободные сессии. Выданные сессии будут закрыты
+        при возврате"""
+        with self._cond:
+            self._closed = True
+            items = list(self._idle)
+            self._idle.clear()
+            self._live -= len(items)
+            self._cond.notify_all()
+        for item in items:
+            self._quit(item)
@@ -0,0 +1,64 @@
+import logging
+import os
+import socket
+import time
+
+from django.db import close_old_connections
+
+from config.settings import PRICE_JOBS
+from .helpers import update_site_price
+from .models import PriceJob
+from .parsers import SeleniumPageParser
+
+logger = logging.getLogger(__name__)
+
+
+class PriceWorker:
+    """Обработчик очереди задач обновления цен. Запускается отдельным
+    процессом (manage.py price_worker), несколько обработчиков могут
+    работать с одной очередью одновременно"""
+
+    def __init__(self, name=None, poll_interval=None, task=update_site_price):
+        self.name = name or f'{socket.gethostname()}:{os.getpid()}'
+        self.poll_interval = (PRICE_JOBS['poll_interval']
+                              if poll_interval is None else poll_interval)
+        self.task = task
+
+    def process(self, job):
+        logger.info('[%s] %s: попытка %s из %s', self.name, job, job.attempts, job.max_attempts)
+        try:
+            self.task(job.site_id)
+        except Exception as e:
+            logger.warning('[%s] Произошла ошибка при выполнении задачи %s. %s', self.name, job.id, e)
+            # Ошибки, повтор которых не поможет (например, 404), завершают задачу
+            job.fail(e, retry=getattr(e, 'retryable', True))
+        else:
+            job.complete()
+
+    def run_once(self):
+        """Выполняет одну задачу из очереди. Возвращает False, если очередь пуста"""
+        job = PriceJob.dequeue(self.name)
+        if job is None:
+            return False
+        self.process(job)
+        return True
+
+    def run(self, max_jobs=None, burst=False):
+        """Обрабатывает задачи, пока не будет выполнено max_jobs задач.
+        В режиме burst завершается, когда очередь опустеет
+        :return: Количество выполненных задач
+        """
+        logger.info('[%s] Обработчик очереди запущен', self.name)
+        done = 0
+        while max_jobs is None or done < max_jobs:
+            close_old_connections()
+            PriceJob.requeue_stale()
+            if self.run_once():
+                done += 1
+            elif burst:
+                break
+            else:
+                # Пока очередь пуста, браузеры не должны простаивать
+                SeleniumPageParser.evict_idle_pools()
+                time.sleep(self.poll_interval)
+        return done